@@ -0,0 +1,478 @@
+"""
+Archival forms of the files of a closed month (see compaction.py).
+
+    csv/<day>.csv   ->  csv/<day>.parquet    columnar, zstd compressed
+                        csv/.<day>.csv.gz    the CSV bytes as uploaded
+    img/*.jpg       ->  img/<day>.zip        one uncompressed ZIP per day
+    log/<day>.log   ->  log/<day>.log.gz
+
+The Parquet table is for reading columns; a CSV regenerated from it would
+not have the uploaded float formatting and spacing, so the bytes are kept
+as well, in a hidden gzip whose length the Parquet footer records (so the
+table stays the commit point).  Tables packed before the raw copies were
+kept are read back as regenerated CSV.
+
+A .log.gz is a series of gzip members of LOG_MEMBER bytes of text each,
+and a hidden .<day>.log.gz.idx next to it keeps where each one starts and
+the length of the text, so log tails and cursors seek to the member they
+need (`open_log`) instead of decompressing the whole day.  The WARNING+
+line index stays in the log_index table, moved along by the compaction.
+
+A packed image keeps a path of its own, the pack followed by the member
+name (data/2025/05/img/2025-05-03.zip/2025-05-03T10-00-00.jpg), so the
+photo tables still hold one path per image.  The ZIP central directory is
+the index: opening a member is one seek, and members are stored, since
+JPEGs do not deflate.  `open_stored` reads any of these forms back as the
+original bytes and `original_path` gives the name the file had, which is
+all /download, the gallery and the thumbnails need.
+"""
+import bisect, gzip, io, json, os, shutil, threading, zipfile, zlib, datetime as _dt
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+from .utils import sniff_delimiter
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:              # CSVs stay as they are, images and logs still get packed
+    pa = None
+
+PACK_SUFFIX = ".zip"
+TABLE_SUFFIX = ".parquet"
+LOG_SUFFIX = ".gz"
+UNDATED = "undated"              # pack of the images without a YYYY-MM-DD name
+CHUNK_SIZE = 1024 * 1024
+LOG_MEMBER = 256 * 1024          # text per gzip member of a .log.gz: what a seek may inflate
+
+
+def pack_name(filename: str) -> str:
+    """The day pack an image goes to, from its YYYY-MM-DD name prefix."""
+    day = filename[:10]
+    try:
+        _dt.date.fromisoformat(day)
+    except ValueError:
+        return UNDATED + PACK_SUFFIX
+    return day + PACK_SUFFIX
+
+
+def is_pack(path: Path) -> bool:
+    return path.suffix == PACK_SUFFIX and path.parent.name == "img"
+
+
+def split_packed(path) -> tuple[Path, str] | None:
+    """(pack, member name) when *path* points into an image pack."""
+    path = Path(path)
+    if is_pack(path.parent):
+        return path.parent, path.name
+    return None
+
+
+def original_path(path: Path) -> Path:
+    """The path a stored file had before its month was compacted."""
+    packed = split_packed(path)
+    if packed:
+        return packed[0].parent / packed[1]
+    if path.suffix == TABLE_SUFFIX and path.parent.name == "csv":
+        return path.with_suffix(".csv")
+    if path.name.endswith(".log" + LOG_SUFFIX) and path.parent.name == "log":
+        return path.with_suffix("")
+    return path
+
+
+def expand_stored(path: Path) -> list[Path]:
+    """A pack as the paths of its members, any other file as itself."""
+    if not is_pack(path):
+        return [path]
+    with zipfile.ZipFile(path) as zf:
+        return [path / name for name in zf.namelist() if not name.endswith("/")]
+
+
+def stored_exists(path) -> bool:
+    packed = split_packed(path)
+    if packed is None:
+        return Path(path).is_file()
+    try:
+        with zipfile.ZipFile(packed[0]) as zf:
+            zf.getinfo(packed[1])
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return False
+    return True
+
+
+def compacted_form(path: Path) -> Path | None:
+    """Where a file that was compacted away lives now, or None."""
+    kind = path.parent.name
+    if kind == "csv" and path.suffix == ".csv":
+        candidate = path.with_suffix(TABLE_SUFFIX)
+    elif kind == "log" and path.suffix == ".log":
+        candidate = path.with_name(path.name + LOG_SUFFIX)
+    elif kind == "img":
+        candidate = path.parent / pack_name(path.name) / path.name
+        return candidate if stored_exists(candidate) else None
+    else:
+        return None
+    return candidate if candidate.is_file() else None
+
+
+def raw_table_path(path: Path) -> Path:
+    return path.with_name(f".{path.stem}.csv.gz")
+
+
+def _footer(path: Path, key: bytes) -> int | None:
+    """A length a day table's footer records: raw_size (of its raw copy) or text_size (of the CSV)."""
+    try:
+        return int((pq.read_schema(path).metadata or {})[key])
+    except (KeyError, ValueError):
+        return None
+
+
+def _raw_table(path: Path) -> Path | None:
+    """The raw copy of a day table, when it holds exactly the table's rows."""
+    raw = raw_table_path(path)
+    try:
+        size = raw.stat().st_size
+    except FileNotFoundError:
+        return None
+    return raw if _footer(path, b"raw_size") == size else None
+
+
+def read_table_text(path: Path) -> str:
+    """A day table as CSV text, whichever form it is stored in."""
+    if path.suffix != TABLE_SUFFIX:
+        return path.read_text(errors="ignore")
+    raw = _raw_table(path)
+    if raw is not None:
+        with gzip.open(raw, "rt", errors="ignore") as f:
+            return f.read()
+    table = pq.read_table(path)
+    sep = (table.schema.metadata or {}).get(b"delimiter", b",").decode()
+    return table.to_pandas(types_mapper=pd.ArrowDtype).to_csv(sep=sep, index=False)
+
+
+def open_stored(path):
+    """A binary reader of the original bytes of a stored file."""
+    path = Path(path)
+    packed = split_packed(path)
+    if packed:
+        pack, name = packed
+        with zipfile.ZipFile(pack) as zf:       # the member keeps the file open
+            try:
+                return zf.open(name)
+            except KeyError:
+                raise FileNotFoundError(path) from None
+    if path.suffix == TABLE_SUFFIX:
+        raw = _raw_table(path)
+        if raw is not None:
+            return gzip.open(raw, "rb")
+        return io.BytesIO(read_table_text(path).encode())
+    if path.suffix == LOG_SUFFIX:
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def stored_size(path) -> int:
+    """Size of the original bytes (a .log.gz's from its index, a table's from its footer)."""
+    path = Path(path)
+    packed = split_packed(path)
+    if packed:
+        with zipfile.ZipFile(packed[0]) as zf:
+            return zf.getinfo(packed[1]).file_size
+    if path.suffix == LOG_SUFFIX:
+        return log_index(path)["text"]
+    if path.suffix == TABLE_SUFFIX:
+        size = _footer(path, b"text_size") if _raw_table(path) is not None else None
+        return size if size is not None else len(read_table_text(path).encode())
+    return path.stat().st_size
+
+
+def read_stored(path) -> bytes:
+    with open_stored(path) as f:
+        return f.read()
+
+
+# Log archives ----------------------------------------------------------------
+
+_LOG_INDEXES: OrderedDict[str, dict] = OrderedDict()     # indexes rebuilt by a scan
+_LOG_INDEXES_LOCK = threading.Lock()
+_LOG_INDEXES_SIZE = 64
+
+
+def log_index_path(path: Path) -> Path:
+    return path.with_name(f".{path.name}.idx")
+
+
+def scan_log(path: Path) -> dict:
+    """
+    The index of a .log.gz read from the file itself, one pass over it:
+    {"size": file size, "text": text length, "members": [[text offset, file offset], …]}
+    """
+    members, text, at, d = [], 0, 0, None
+    with open(path, "rb") as f:
+        while data := f.read(64 * 1024):
+            while data:
+                if d is None:
+                    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    members.append([text, at])
+                text += len(d.decompress(data))
+                rest = d.unused_data if d.eof else b""
+                at += len(data) - len(rest)
+                data = rest
+                if d.eof:
+                    d = None
+    return {"size": at, "text": text, "members": members}
+
+
+def log_index(path: Path) -> dict:
+    """The index of a .log.gz: its sidecar, or a scan when that is missing or stale."""
+    size = path.stat().st_size
+    try:
+        index = json.loads(log_index_path(path).read_text())
+        if index["size"] == size:                # a merge always makes the archive longer
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    key = str(path)
+    with _LOG_INDEXES_LOCK:
+        index = _LOG_INDEXES.get(key)
+        if index is not None and index["size"] == size:
+            _LOG_INDEXES.move_to_end(key)
+            return index
+    index = scan_log(path)
+    with _LOG_INDEXES_LOCK:
+        _LOG_INDEXES[key] = index
+        while len(_LOG_INDEXES) > _LOG_INDEXES_SIZE:
+            _LOG_INDEXES.popitem(last=False)
+    return index
+
+
+class _LogArchive(io.RawIOBase):
+    """The text of a .log.gz, seekable: a seek only starts over at the member it lands in."""
+
+    def __init__(self, path: Path):
+        self.index = log_index(path)
+        self.starts = [m[0] for m in self.index["members"]]
+        self.file = open(path, "rb")
+        self.pos = 0
+        self.member: gzip.GzipFile | None = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.index["text"]
+        if offset != self.pos:
+            self.pos, self.member = max(0, offset), None
+        return self.pos
+
+    def readinto(self, buffer) -> int:
+        if self.pos >= self.index["text"]:
+            return 0
+        if self.member is None:
+            i = bisect.bisect_right(self.starts, self.pos) - 1
+            start, at = self.index["members"][i]
+            self.file.seek(at)
+            self.member = gzip.GzipFile(fileobj=self.file, mode="rb")   # reads on into the next members
+            skip = self.pos - start
+            while skip > 0:
+                skipped = len(self.member.read(min(skip, CHUNK_SIZE)))
+                if not skipped:
+                    return 0
+                skip -= skipped
+        n = self.member.readinto(buffer)
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+def open_log(path: Path):
+    """A seekable binary reader of a day log, compacted (.log.gz) or not."""
+    if path.suffix == LOG_SUFFIX:
+        return io.BufferedReader(_LogArchive(path), CHUNK_SIZE // 16)
+    return open(path, "rb")
+
+
+def zip_info(path: Path, arcname: str) -> zipfile.ZipInfo:
+    """ZipInfo for re-archiving a stored file under its original *arcname*."""
+    packed = split_packed(path)
+    if packed is None:
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.file_size = stored_size(path)     # what gets streamed, not the compacted file
+        return zinfo
+    with zipfile.ZipFile(packed[0]) as zf:
+        member = zf.getinfo(packed[1])
+    zinfo = zipfile.ZipInfo(arcname, member.date_time)
+    zinfo.external_attr = member.external_attr
+    zinfo.file_size = member.file_size
+    return zinfo
+
+
+# Writers -----------------------------------------------------------------
+#
+# Each one writes next to its target, fsyncs and renames, so a crash leaves
+# either the old file or the complete new one.
+
+def fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _tmp(target: Path) -> Path:
+    return target.with_name(f".{target.name}.tmp")
+
+
+def commit_file(tmp: Path, target: Path):
+    os.replace(tmp, target)
+    fsync_dir(target.parent)
+
+
+def _read_csv_table(path: Path):
+    """The CSV as an Arrow table: numeric columns typed, the rest kept as text."""
+    with open(path, errors="ignore") as f:
+        header = f.readline()
+    sep = sniff_delimiter(header)
+    parse = pa_csv.ParseOptions(delimiter=sep)
+    table = pa_csv.read_csv(path, parse_options=parse)
+    text = {f.name: pa.string() for f in table.schema
+            if not (pa.types.is_integer(f.type) or pa.types.is_floating(f.type)
+                    or pa.types.is_null(f.type))}
+    if text:                     # no timestamp parsing: they come back as written
+        table = pa_csv.read_csv(path, parse_options=parse,
+                                convert_options=pa_csv.ConvertOptions(column_types=text))
+    return table, sep
+
+
+def _write_raw_table(source: Path, out, base: Path | None) -> int:
+    """
+    The raw copy of *base* with *source*'s bytes gzipped after it (its
+    header dropped: the day has one).  Returns the length of the text.
+    """
+    text = 0
+    if base is not None:
+        size, raw = _footer(base, b"raw_size"), raw_table_path(base)
+        text = _footer(base, b"text_size")
+        if size is not None and text is not None and raw.exists() and raw.stat().st_size >= size:
+            with open(raw, "rb") as old:        # up to what the table holds: a crash may have left more
+                while size > 0 and (chunk := old.read(min(size, CHUNK_SIZE))):
+                    out.write(chunk)
+                    size -= len(chunk)
+        else:                                   # packed before raw copies were kept
+            data = read_table_text(base).encode()
+            out.write(gzip.compress(data, mtime=0))
+            text = len(data)
+    with open(source, "rb") as src, gzip.GzipFile(fileobj=out, mode="wb", mtime=0) as gz:
+        if base is not None:
+            src.readline()
+        while chunk := src.read(CHUNK_SIZE):
+            gz.write(chunk)
+            text += len(chunk)
+    return text
+
+
+def write_table(source: Path, target: Path, base: Path | None = None) -> tuple[Path, Path]:
+    """
+    *source* (a CSV) appended to *base* (an existing Parquet, or None) as a
+    zstd-compressed Parquet at a temporary path next to *target*, with its
+    raw copy.  Returns the temporary paths of both, the raw copy to commit
+    first.  Raises, and writes nothing, when the CSV has rows pyarrow
+    cannot parse.
+    """
+    table, sep = _read_csv_table(source)
+    tables = [table]
+    if base is not None:
+        old = pq.read_table(base)
+        sep = (old.schema.metadata or {}).get(b"delimiter", sep.encode()).decode()
+        tables.insert(0, old)
+    table = pa.concat_tables(tables, promote_options="permissive")
+    tmp, raw_tmp = _tmp(target), _tmp(raw_table_path(target))
+    try:
+        with open(raw_tmp, "wb") as out:
+            text_size = _write_raw_table(source, out, base)
+            out.flush()
+            os.fsync(out.fileno())
+            raw_size = out.tell()
+        table = table.replace_schema_metadata(
+            {"delimiter": sep, "raw_size": str(raw_size), "text_size": str(text_size)})
+        pq.write_table(table, tmp, compression="zstd")
+        with open(tmp, "rb+") as f:
+            os.fsync(f.fileno())
+        if pq.read_metadata(tmp).num_rows != table.num_rows:
+            raise ValueError(f"{target}: row count changed while packing")
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raw_tmp.unlink(missing_ok=True)
+        raise
+    return tmp, raw_tmp
+
+
+def write_pack(sources: list[tuple[Path, str]], target: Path, base: Path | None = None) -> Path:
+    """(image, member name) pairs added to *base* (an existing pack, or None)."""
+    tmp = _tmp(target)
+    try:
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED) as out:
+            if base is not None:
+                with zipfile.ZipFile(base) as old:
+                    for member in old.infolist():
+                        with old.open(member) as src, out.open(member, "w") as dst:
+                            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            for src, name in sources:
+                out.write(src, name)
+            out.testzip()
+        with open(tmp, "rb+") as f:
+            os.fsync(f.fileno())
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return tmp
+
+
+def write_log(source: Path, target: Path, base: Path | None = None) -> tuple[Path, Path]:
+    """
+    *source* gzipped after *base* (an existing .log.gz, copied as is: gzip
+    members concatenate), one member per LOG_MEMBER bytes.  Returns the
+    temporary paths of the archive and of its index, to commit in that order.
+    """
+    tmp, index_tmp = _tmp(target), _tmp(log_index_path(target))
+    index = log_index(base) if base is not None else {"size": 0, "text": 0, "members": []}
+    members, text = list(index["members"]), index["text"]
+    try:
+        with open(tmp, "wb") as raw:
+            if base is not None:
+                with open(base, "rb") as old:
+                    shutil.copyfileobj(old, raw, CHUNK_SIZE)
+            with open(source, "rb") as src:
+                while data := src.read(LOG_MEMBER):
+                    members.append([text, raw.tell()])
+                    raw.write(gzip.compress(data, mtime=0))
+                    text += len(data)
+            raw.flush()
+            os.fsync(raw.fileno())
+            size = raw.tell()
+        with open(index_tmp, "w") as out:
+            json.dump({"size": size, "text": text, "members": members}, out)
+            out.flush()
+            os.fsync(out.fileno())
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        index_tmp.unlink(missing_ok=True)
+        raise
+    return tmp, index_tmp
@@ -1,15 +1,34 @@
 from fastapi import Header, HTTPException, status, Query
 import os
 
+from .utils import DEFAULT_DEVICE, is_device_name
+
 API_TOKEN = os.getenv("API_TOKEN", "very-secret-and-difficult-token")
 
+def _device_tokens(spec: str) -> dict[str, str]:
+    """DEVICE_TOKENS="trap-01=token1,trap-02=token2"  ->  {token: device}"""
+    tokens = {}
+    for item in filter(None, (i.strip() for i in spec.split(","))):
+        device, _, token = item.partition("=")
+        if not is_device_name(device) or not token:
+            raise ValueError(f"bad DEVICE_TOKENS entry: {item!r}")
+        tokens[token] = device
+    return tokens
+
+DEVICE_TOKENS = _device_tokens(os.getenv("DEVICE_TOKENS", ""))
+
 async def verify_token(
     authorization: str | None = Header(None),
     token: str | None = Query(None),
-) -> None:
+    x_device_id: str | None = Header(None),
+) -> str:
     """
     Accept Bearer token in *either* the Authorization header
     or a `?token=…` query parameter (convenient for HTML links).
+
+    Returns the device the caller speaks for: the trap a per-device token
+    belongs to, else the X-Device-Id header sent with the shared token,
+    else "default".
     """
     if authorization and authorization.startswith("Bearer "):
         supplied = authorization.split()[1]
@@ -21,8 +40,25 @@ async def verify_token(
             detail="Missing token",
         )
 
+    device = DEVICE_TOKENS.get(supplied)
+    if device is not None:
+        if x_device_id and x_device_id != device:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Token belongs to another device",
+            )
+        return device
+
     if supplied != API_TOKEN:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Invalid token",
-        )
\ No newline at end of file
+        )
+    if x_device_id is None:
+        return DEFAULT_DEVICE
+    if not is_device_name(x_device_id):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid X-Device-Id",
+        )
+    return x_device_id
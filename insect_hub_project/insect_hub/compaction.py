@@ -0,0 +1,243 @@
+"""
+Background compaction of closed months.
+
+Once a month has been over for COMPACT_GRACE_DAYS, `Compactor` rewrites
+its day files into the archival forms of archive.py: each CSV becomes a
+Parquet file (and a raw copy), the images of a day one ZIP, each log a
+.log.gz and its member index.  A month folder then holds a few files per
+day instead of thousands, and directory walks, backups and the disk all
+get cheaper.  It runs every COMPACT_INTERVAL_H hours (0 turns it off), one
+data/YYYY/MM[/<device>] partition at a time:
+
+  1. write the compacted files aside, fsync, rename into place (threadpool)
+  2. point photos, uploads, logs, log_index and the catalog at them (one
+     transaction on the writer thread)
+  3. delete the originals
+
+A run that stops between 2 and 3 leaves originals older than their
+compacted file: the next run only finishes the switch for those.  Data a
+late upload adds to a compacted day lands in a fresh plain file, which is
+newer, and is merged in by the next run.  A file that changes while it is
+being packed is left alone until then.
+"""
+import asyncio, datetime as _dt, logging, os, zipfile
+from pathlib import Path
+
+from .archive import (pa, LOG_SUFFIX, PACK_SUFFIX, TABLE_SUFFIX, commit_file, fsync_dir,
+                      log_index_path, pack_name, raw_table_path, stored_size, write_log,
+                      write_pack, write_table)
+from .database import get_db, record_compaction
+from .utils import CATALOG_KINDS, catalog_entries, file_sha256
+
+logger = logging.getLogger(__name__)
+
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL_H", "24")) * 3600
+COMPACT_GRACE_DAYS = int(os.getenv("COMPACT_GRACE_DAYS", "7"))
+
+_ERRORS = (OSError, ValueError, zipfile.BadZipFile) + ((pa.ArrowException,) if pa is not None else ())
+
+
+def closed_partitions(data_dir: Path, today: _dt.date) -> list[Path]:
+    """data/YYYY/MM folders (and their per-trap subfolders) of the months that are closed."""
+    cutoff = today - _dt.timedelta(days=COMPACT_GRACE_DAYS)
+    parts = []
+    for month_dir in sorted(data_dir.glob("[0-9][0-9][0-9][0-9]/[0-9][0-9]")):
+        year, month = int(month_dir.parent.name), int(month_dir.name)
+        if not 1 <= month <= 12 or _dt.date(year + month // 12, month % 12 + 1, 1) > cutoff:
+            continue
+        parts.append(month_dir)
+        parts += sorted(d for d in month_dir.iterdir() if d.is_dir() and d.name not in CATALOG_KINDS)
+    return parts
+
+
+def _stamp(path: Path) -> tuple | None:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _already_in(src: Path, target: Path) -> bool:
+    """*src* is a leftover of a run that got as far as writing *target*, not later data."""
+    return target.exists() and src.stat().st_mtime_ns <= target.stat().st_mtime_ns
+
+
+class Job:
+    """One compacted file: the originals it takes in (stamped before they are read)
+    and where their rows point next."""
+
+    def __init__(self, target: Path):
+        self.target = target
+        self.tmp: Path | None = None            # the rewritten target, until it is in place
+        self.sidecars: list[tuple[Path, Path]] = []     # (tmp, path) committed before the target
+        self.sources: list[tuple[Path, tuple]] = []
+        self.moves: list[tuple[str, str, int]] = []
+
+    def add(self, src: Path, new: Path, shift: int = 0):
+        self.sources.append((src, _stamp(src)))
+        self.moves.append((str(src), str(new), shift))
+
+    def unchanged(self) -> bool:
+        return all(_stamp(p) == stamp for p, stamp in self.sources)
+
+
+def _table_job(src: Path) -> Job:
+    target = src.with_suffix(TABLE_SUFFIX)
+    job = Job(target)
+    job.add(src, target)
+    if not _already_in(src, target):
+        job.tmp, raw_tmp = write_table(src, target, base=target if target.exists() else None)
+        job.sidecars.append((raw_tmp, raw_table_path(target)))
+    return job
+
+
+def _log_job(src: Path) -> Job:
+    target = src.with_name(src.name + LOG_SUFFIX)
+    job = Job(target)
+    if _already_in(src, target):                # src is the last gzip member
+        job.add(src, target, stored_size(target) - src.stat().st_size)
+    else:
+        job.add(src, target, stored_size(target) if target.exists() else 0)
+        job.tmp, index_tmp = write_log(src, target, base=target if target.exists() else None)
+        job.sidecars.append((index_tmp, log_index_path(target)))
+    return job
+
+
+def _pack_job(target: Path, images: list[Path]) -> Job:
+    job = Job(target)
+    members = set()
+    if target.exists():
+        with zipfile.ZipFile(target) as zf:
+            members = set(zf.namelist())
+    new = []
+    for src in images:
+        name = src.name
+        if name in members and not _already_in(src, target):
+            # another image under a name the pack already has (cf. utils.store_image)
+            name = f"{src.stem}-{file_sha256(src)[:12]}{src.suffix}"
+        if name not in members:
+            members.add(name)
+            new.append((src, name))
+        job.add(src, target / name)
+    if new:
+        job.tmp = write_pack(new, target, base=target if target.exists() else None)
+    return job
+
+
+def _jobs(part: Path):
+    for kind in CATALOG_KINDS:
+        folder = part / kind
+        if not folder.is_dir():
+            continue
+        for tmp in folder.glob(".*.tmp"):       # aside files of an interrupted run
+            tmp.unlink(missing_ok=True)
+    if pa is not None:
+        for src in sorted((part / "csv").glob("*.csv")):
+            yield _table_job, (src,)
+    groups: dict[str, list[Path]] = {}
+    if (part / "img").is_dir():
+        for src in sorted((part / "img").iterdir()):
+            if src.is_file() and not src.name.startswith(".") and src.suffix != PACK_SUFFIX:
+                groups.setdefault(pack_name(src.name), []).append(src)
+    for name, images in groups.items():
+        yield _pack_job, (part / "img" / name, images)
+    for src in sorted((part / "log").glob("*.log")):
+        yield _log_job, (src,)
+
+
+def pack_partition(data_dir: Path, part: Path) -> tuple[list[Job], tuple]:
+    """
+    Step 1 for one partition: the compacted files written and in place.
+    Returns the jobs and the arguments of `database.record_compaction`.
+    """
+    jobs = []
+    for build, args in _jobs(part):
+        try:
+            job = build(*args)
+        except _ERRORS as exc:
+            logger.warning("not compacting %s: %s", args[0], exc)
+            continue
+        if not job.unchanged():
+            if job.tmp is not None:
+                job.tmp.unlink(missing_ok=True)
+            for tmp, _ in job.sidecars:
+                tmp.unlink(missing_ok=True)
+            continue
+        for tmp, path in job.sidecars:
+            commit_file(tmp, path)
+        if job.tmp is not None:
+            commit_file(job.tmp, job.target)
+        jobs.append(job)
+    moves = [m for job in jobs for m in job.moves]
+    removed = [Path(os.path.relpath(src, data_dir)).as_posix() for job in jobs for src, _ in job.sources]
+    added = catalog_entries(data_dir, [job.target for job in jobs])
+    return jobs, (moves, removed, added)
+
+
+def finish(jobs: list[Job]) -> tuple[int, int]:
+    """Step 3: delete the originals; returns their count and size."""
+    n = size = 0
+    folders = set()
+    for job in jobs:
+        for src, stamp in job.sources:
+            if _stamp(src) != stamp:
+                continue                        # written to meanwhile: merged next run
+            src.unlink()
+            folders.add(src.parent)
+            n += 1
+            size += stamp[0]
+    for folder in folders:
+        fsync_dir(folder)
+    return n, size
+
+
+class Compactor:
+    def __init__(self, data_dir: Path):
+        self.data_dir = data_dir
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return COMPACT_INTERVAL > 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        if pa is None:
+            logger.warning("pyarrow not installed, CSVs of closed months stay uncompacted")
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+
+    async def compact(self, part: Path):
+        loop = asyncio.get_running_loop()
+        jobs, changes = await loop.run_in_executor(None, pack_partition, self.data_dir, part)
+        if not jobs:
+            return
+        await get_db().write(record_compaction, *changes)
+        n, size = await loop.run_in_executor(None, finish, jobs)
+        logger.info("compacted %s: %d files (%.1f MB) into %d", part, n, size / 1e6, len(jobs))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            try:
+                parts = await loop.run_in_executor(
+                    None, closed_partitions, self.data_dir, _dt.date.today())
+                for part in parts:
+                    if self._stopping:
+                        break
+                    await self.compact(part)
+            except Exception:
+                logger.exception("compaction failed, retrying at the next run")
+            try:
+                await asyncio.wait_for(self._wake.wait(), COMPACT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
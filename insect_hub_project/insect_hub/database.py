@@ -1,7 +1,11 @@
-import sqlite3
+import sqlite3, asyncio, threading, os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import json, datetime as _dt
 
+from .metrics import SQLITE_SECONDS, on_behalf
+from .utils import DEFAULT_DEVICE, SERIES_STEPS
+
 DB_PATH = Path("data") / "insect_data.db"
 DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
@@ -11,12 +15,14 @@ CREATE TABLE IF NOT EXISTS uploads (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     day TEXT NOT NULL,
     csv_path TEXT NOT NULL,
-    created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    device TEXT NOT NULL DEFAULT 'default'
 );
 CREATE TABLE IF NOT EXISTS photos (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     upload_id INTEGER REFERENCES uploads(id) ON DELETE CASCADE,
-    file_path TEXT NOT NULL
+    file_path TEXT NOT NULL,
+    crop TEXT
 );
 CREATE TABLE IF NOT EXISTS health (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -39,32 +45,273 @@ CREATE TABLE IF NOT EXISTS logs (
     created_at TEXT DEFAULT (datetime('now'))
 );
 """
+_ROLLUP_TABLES = """
+CREATE TABLE IF NOT EXISTS rollup_days (
+    device  TEXT NOT NULL DEFAULT 'default',
+    day     TEXT NOT NULL,
+    rows    INTEGER NOT NULL DEFAULT 0,
+    insects INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (device, day)
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    device TEXT NOT NULL DEFAULT 'default',
+    day    TEXT NOT NULL,
+    name   TEXT NOT NULL,
+    count  INTEGER NOT NULL,
+    sum    REAL NOT NULL,
+    min    REAL NOT NULL,
+    max    REAL NOT NULL,
+    PRIMARY KEY (device, day, name)
+);
+"""
+_SCHEMA += _ROLLUP_TABLES
+_SCHEMA += """
+CREATE TABLE IF NOT EXISTS measurements (
+    upload_id INTEGER REFERENCES uploads(id) ON DELETE CASCADE,
+    ts        REAL NOT NULL,            -- POSIX seconds, UTC
+    name      TEXT NOT NULL,
+    value     REAL NOT NULL,
+    device    TEXT NOT NULL DEFAULT 'default'
+);
+CREATE INDEX IF NOT EXISTS measurements_name_ts ON measurements(name, ts);
+CREATE INDEX IF NOT EXISTS measurements_ts ON measurements(ts);
+"""
+_SCHEMA += """
+CREATE TABLE IF NOT EXISTS spool_applied (
+    entry TEXT PRIMARY KEY
+);
+"""
+_SCHEMA += """
+CREATE TABLE IF NOT EXISTS photo_hashes (
+    sha256    TEXT PRIMARY KEY,
+    file_path TEXT NOT NULL
+);
+"""
+_SCHEMA += """
+CREATE TABLE IF NOT EXISTS thumbnails (
+    photo_id INTEGER PRIMARY KEY REFERENCES photos(id) ON DELETE CASCADE,
+    ok       INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photos_upload ON photos(upload_id);
+CREATE INDEX IF NOT EXISTS uploads_day ON uploads(day);
+"""
+_SCHEMA += """
+CREATE TABLE IF NOT EXISTS catalog (
+    path  TEXT PRIMARY KEY,          -- relative to data/, '/' separated
+    kind  TEXT NOT NULL,             -- csv | img | log
+    size  INTEGER NOT NULL,
+    day   TEXT,
+    mtime REAL NOT NULL,
+    device TEXT NOT NULL DEFAULT 'default'
+);
+CREATE INDEX IF NOT EXISTS catalog_kind_day ON catalog(kind, day);
+CREATE TABLE IF NOT EXISTS catalog_version (
+    id      INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO catalog_version(id, version) VALUES (1, 0);
+-- the trees list file names, so only files appearing/disappearing count
+CREATE TRIGGER IF NOT EXISTS catalog_added AFTER INSERT ON catalog BEGIN
+    UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS catalog_removed AFTER DELETE ON catalog BEGIN
+    UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+END;
+"""
+_SCHEMA += """
+CREATE TABLE IF NOT EXISTS log_index (
+    path   TEXT NOT NULL,
+    offset INTEGER NOT NULL,         -- byte offset of the line
+    level  TEXT NOT NULL,            -- WARNING | ERROR | CRITICAL
+    PRIMARY KEY (path, offset)
+) WITHOUT ROWID;
+"""
+_SCHEMA += """
+CREATE TABLE IF NOT EXISTS series_rollups (
+    device TEXT NOT NULL,
+    name   TEXT NOT NULL,
+    step   INTEGER NOT NULL,         -- tier: 60 | 3600 | 86400 seconds
+    bucket INTEGER NOT NULL,         -- POSIX start of the bucket, UTC
+    count  INTEGER NOT NULL,
+    sum    REAL NOT NULL,
+    min    REAL NOT NULL,
+    max    REAL NOT NULL,
+    PRIMARY KEY (device, name, step, bucket)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS series_rollups_fleet ON series_rollups(name, step, bucket);
+"""
+# Databases created before multi-device support get the device columns here.
+_DEVICE_COLUMNS = ("uploads", "measurements", "catalog")
+_DEVICE_INDEXES = """
+CREATE INDEX IF NOT EXISTS uploads_device_day ON uploads(device, day);
+CREATE INDEX IF NOT EXISTS measurements_device_name_ts ON measurements(device, name, ts);
+CREATE INDEX IF NOT EXISTS catalog_device ON catalog(device);
+CREATE INDEX IF NOT EXISTS rollups_day ON rollups(day);
+"""
+
+def _columns(conn: sqlite3.Connection, table: str) -> set[str]:
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+def _migrate_devices(conn: sqlite3.Connection):
+    for table in _DEVICE_COLUMNS:
+        if "device" not in _columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN device TEXT NOT NULL DEFAULT 'default'")
+    if "device" not in _columns(conn, "rollups"):
+        # the primary keys change: copy the single-trap rollups over
+        conn.executescript(f"""
+            ALTER TABLE rollup_days RENAME TO rollup_days_old;
+            ALTER TABLE rollups RENAME TO rollups_old;
+            {_ROLLUP_TABLES}
+            INSERT INTO rollup_days(day, rows, insects) SELECT day, rows, insects FROM rollup_days_old;
+            INSERT INTO rollups(day, name, count, sum, min, max)
+                SELECT day, name, count, sum, min, max FROM rollups_old;
+            DROP TABLE rollup_days_old;
+            DROP TABLE rollups_old;
+        """)
+
+def _migrate_crops(conn: sqlite3.Connection):
+    # sidecar metadata of crop-mode photos (JSON), NULL for whole frames
+    if "crop" not in _columns(conn, "photos"):
+        conn.execute("ALTER TABLE photos ADD COLUMN crop TEXT")
+
 def init_db() -> None:
     with sqlite3.connect(DB_PATH) as conn:
+        had_series = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'series_rollups'").fetchone()
         conn.executescript(_SCHEMA)
+        _migrate_devices(conn)
+        _migrate_crops(conn)
+        conn.executescript(_DEVICE_INDEXES)
+        if not had_series:
+            rebuild_series(conn)         # chart tiers for the measurements already stored
         conn.commit()
 
-def get_db():
-    """FastAPI dependency that yields a *thread‑agnostic* SQLite connection.
-    `check_same_thread=False` is safe because we create **one connection per
-    request**, so it is never shared concurrently; it merely allows Starlette’s
-    background template‑rendering thread to reuse the same object.
-    """
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# Connection pool ---------------------------------------------------------
+#
+# SQLite allows one writer at a time, so all writes go through a single
+# dedicated thread (which also serialises them without a lock) while reads
+# fan out over a few reader threads.  Every thread keeps its own long-lived
+# connection, so sqlite3's per-connection statement cache means our queries
+# are prepared once and reused.  Handlers `await` the pool and never run
+# SQLite on the event loop.
+
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+
+def _connect(readonly: bool) -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA foreign_keys=ON")
+    if readonly:
+        conn.execute("PRAGMA query_only=1")
+    else:
+        conn.execute("PRAGMA synchronous=NORMAL")   # safe with WAL
+    return conn
+
+
+def _fn_name(fn) -> str:
+    return getattr(fn, "__name__", type(fn).__name__)
+
+
+class Database:
+    def __init__(self, readers: int = DB_READERS):
+        self._local = threading.local()
+        self._conns: list[sqlite3.Connection] = []
+        self._writer = ThreadPoolExecutor(
+            1, "db-writer", initializer=self._open, initargs=(False,))
+        self._readers = ThreadPoolExecutor(
+            readers, "db-reader", initializer=self._open, initargs=(True,))
+
+    def _open(self, readonly: bool):
+        self._local.conn = _connect(readonly)
+        self._conns.append(self._local.conn)
+
+    def _read(self, fn, args, kwargs):
+        with SQLITE_SECONDS.time("read", _fn_name(fn)):
+            return fn(self._local.conn, *args, **kwargs)
+
+    def _write(self, fn, args, kwargs):
+        conn = self._local.conn
+        name = _fn_name(fn)
+        try:
+            with SQLITE_SECONDS.time("write", name):
+                result = fn(conn, *args, **kwargs)
+            with SQLITE_SECONDS.time("commit", name):
+                conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+
+    async def read(self, fn, *args, **kwargs):
+        """Run fn(conn, *args, **kwargs) on a reader connection."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._readers, on_behalf(self._read), fn, args, kwargs)
+
+    async def write(self, fn, *args, **kwargs):
+        """Run fn(conn, *args, **kwargs) on the writer connection as one transaction."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._writer, on_behalf(self._write), fn, args, kwargs)
+
+    def close(self):
+        self._writer.shutdown()
+        self._readers.shutdown()
+        for conn in self._conns:
+            conn.close()
+        self._conns.clear()
+
+
+_DB: Database | None = None
+
+def get_db() -> Database:
+    """FastAPI dependency returning the process-wide connection pool."""
+    global _DB
+    if _DB is None:
+        _DB = Database()
+    return _DB
+
+def close_db():
+    global _DB
+    if _DB is not None:
+        _DB.close()
+        _DB = None
 
 # Helper insert functions ------------------------------------------------
 
-def insert_upload(conn: sqlite3.Connection, day: str, csv_path: str) -> int:
-    cur = conn.execute("INSERT INTO uploads(day, csv_path) VALUES (?, ?)", (day, csv_path))
+def insert_upload(conn: sqlite3.Connection, day: str, csv_path: str,
+                  device: str = DEFAULT_DEVICE) -> int:
+    cur = conn.execute("INSERT INTO uploads(day, csv_path, device) VALUES (?, ?, ?)",
+                       (day, csv_path, device))
     return cur.lastrowid
 
-def insert_photo(conn: sqlite3.Connection, upload_id: int, path: str):
-    conn.execute("INSERT INTO photos(upload_id, file_path) VALUES(?, ?)", (upload_id, path))
+def insert_photos(conn: sqlite3.Connection, upload_id: int,
+                  photos: list[tuple]) -> list[str]:
+    """Insert (path, sha256[, crop]) tuples. Content already in the photo-hash
+    index is skipped; returns the paths that were actually recorded."""
+    conn.executemany(
+        "INSERT OR IGNORE INTO photo_hashes(sha256, file_path) VALUES(?, ?)",
+        [(p[1], p[0]) for p in photos],
+    )
+    indexed = known_photo_hashes(conn, [p[1] for p in photos])
+    new = [p for p in photos if indexed.get(p[1]) == p[0]]
+    conn.executemany("INSERT INTO photos(upload_id, file_path, crop) VALUES(?, ?, ?)",
+                     [(upload_id, p[0], json.dumps(p[2]) if len(p) > 2 and p[2] else None)
+                      for p in new])
+    return [p[0] for p in new]
+
+def known_photo_hashes(conn: sqlite3.Connection, hashes: list[str]) -> dict[str, str]:
+    """sha256 -> stored path, for the hashes the hub already has."""
+    found: dict[str, str] = {}
+    for i in range(0, len(hashes), 500):           # stay under SQLite's variable limit
+        batch = hashes[i:i + 500]
+        rows = conn.execute(
+            f"SELECT sha256, file_path FROM photo_hashes WHERE sha256 IN ({','.join('?' * len(batch))})",
+            batch,
+        )
+        found.update((r[0], r[1]) for r in rows)
+    return found
 
 def insert_health(conn: sqlite3.Connection, upload_id: int, payload: dict):
     conn.execute("INSERT INTO health(upload_id, payload) VALUES(?, ?)", (upload_id, json.dumps(payload)))
@@ -74,4 +321,401 @@ def insert_error(conn: sqlite3.Connection, upload_id: int, payload: dict):
 
 def insert_log(conn: sqlite3.Connection, upload_id: int, path: str):
     conn.execute("INSERT INTO logs(upload_id, file_path) VALUES(?,?)",
-                 (upload_id, path))
\ No newline at end of file
+                 (upload_id, path))
+
+def record_upload(conn: sqlite3.Connection, day: str, csv_path: str, *,
+                  device: str = DEFAULT_DEVICE,
+                  rollup: dict | None = None,
+                  measurements: list | None = None,
+                  series: list[tuple] | None = None,
+                  photos: list[tuple] | None = None,
+                  health: dict | None = None,
+                  error: dict | None = None,
+                  log_path: str | None = None,
+                  log_levels: list[tuple[int, str]] | None = None,
+                  files: list[tuple] | None = None) -> tuple[int, list[str]]:
+    """
+    All rows of one /api/upload, meant to run as a single write transaction.
+    Returns the upload id and the stored photos that were not recorded because
+    another upload recorded the same content first: the caller deletes those.
+    """
+    upload_id = insert_upload(conn, day, csv_path, device)
+    skipped: list[str] = []
+    if rollup:
+        apply_rollup(conn, day, rollup, device)
+    if measurements:
+        insert_measurements(conn, upload_id, measurements, device)
+    if series:
+        apply_series(conn, series, device)
+    if photos:
+        recorded = set(insert_photos(conn, upload_id, photos))
+        skipped = [p[0] for p in photos if p[0] not in recorded]
+    if health is not None:
+        insert_health(conn, upload_id, health)
+    if error is not None:
+        insert_error(conn, upload_id, error)
+    if log_path:
+        insert_log(conn, upload_id, log_path)
+        if log_levels:
+            insert_log_levels(conn, log_path, log_levels)
+    if files:
+        gone = {Path(p).as_posix() for p in skipped}
+        upsert_catalog(conn, [f for f in files
+                              if not any(g.endswith("/" + f[0]) for g in gone)])
+    return upload_id, skipped
+
+# Write-behind spool bookkeeping (see ingest.py) --------------------------
+
+def spool_applied(conn: sqlite3.Connection, entries: list[str]) -> set[str]:
+    if not entries:
+        return set()
+    marks = ",".join("?" * len(entries))
+    rows = conn.execute(
+        f"SELECT entry FROM spool_applied WHERE entry IN ({marks})", entries)
+    return {r[0] for r in rows}
+
+def mark_spool_applied(conn: sqlite3.Connection, entries: list[str]):
+    conn.executemany("INSERT OR IGNORE INTO spool_applied(entry) VALUES(?)",
+                     [(e,) for e in entries])
+
+def prune_spool_applied(conn: sqlite3.Connection, queued: set[str]):
+    """Drop the rows of entries no longer in the spool queue: they were removed."""
+    gone = [r[0] for r in conn.execute("SELECT entry FROM spool_applied") if r[0] not in queued]
+    conn.executemany("DELETE FROM spool_applied WHERE entry = ?", [(e,) for e in gone])
+
+# Queries ---------------------------------------------------------------
+
+def latest_health(conn: sqlite3.Connection, device: str | None = None):
+    if device is None:
+        return conn.execute(
+            "SELECT payload, created_at FROM health ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+    return conn.execute(
+        """SELECT h.payload, h.created_at FROM health h JOIN uploads u ON u.id = h.upload_id
+           WHERE u.device = ? ORDER BY h.id DESC LIMIT 1""", (device,)
+    ).fetchone()
+
+def latest_log(conn: sqlite3.Connection, device: str | None = None):
+    if device is None:
+        return conn.execute(
+            "SELECT file_path, created_at FROM logs ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+    return conn.execute(
+        """SELECT l.file_path, l.created_at FROM logs l JOIN uploads u ON u.id = l.upload_id
+           WHERE u.device = ? ORDER BY l.id DESC LIMIT 1""", (device,)
+    ).fetchone()
+
+def device_overview(conn: sqlite3.Connection, days: list[str]) -> list[dict]:
+    """Every trap that ever uploaded: last upload and its totals over *days*."""
+    marks = ",".join("?" * len(days))
+    totals = {r[0]: (r[1], r[2]) for r in conn.execute(
+        f"""SELECT device, SUM(rows), SUM(insects) FROM rollup_days
+            WHERE day IN ({marks}) GROUP BY device""", days)}
+    return [
+        {"device": dev, "last_upload": last, "uploads": n,
+         "rows": totals.get(dev, (0, 0))[0], "insects": totals.get(dev, (0, 0))[1]}
+        for dev, last, n in conn.execute(
+            "SELECT device, MAX(created_at), COUNT(*) FROM uploads GROUP BY device ORDER BY device")
+    ]
+
+# File catalog ------------------------------------------------------------
+#
+# Rows are (path, kind, size, day, mtime, device) as built by utils.catalog_entry.
+
+def upsert_catalog(conn: sqlite3.Connection, files: list[tuple]):
+    conn.executemany(
+        """INSERT INTO catalog(path, kind, size, day, mtime, device) VALUES(?, ?, ?, ?, ?, ?)
+           ON CONFLICT(path) DO UPDATE SET
+               kind = excluded.kind, size = excluded.size,
+               day = excluded.day, mtime = excluded.mtime, device = excluded.device""",
+        files,
+    )
+
+def reconcile_catalog(conn: sqlite3.Connection, scanned: list[tuple]) -> dict:
+    """Make the catalog match a full scan of data/; returns what changed."""
+    current = {r[0]: (r[1], r[2]) for r in
+               conn.execute("SELECT path, size, mtime FROM catalog")}
+    changed = [f for f in scanned if current.get(f[0]) != (f[2], f[4])]
+    gone = current.keys() - {f[0] for f in scanned}
+    upsert_catalog(conn, changed)
+    conn.executemany("DELETE FROM catalog WHERE path = ?", [(p,) for p in gone])
+    return {"updated": len(changed), "removed": len(gone)}
+
+def record_compaction(conn: sqlite3.Connection, moves: list[tuple[str, str, int]],
+                      removed: list[str], added: list[tuple]):
+    """
+    Point every row that names a compacted file at its new form: *moves* are
+    (old path, new path, shift of its log offsets) as stored in the tables,
+    *removed*/*added* the catalog paths and entries that go and come.
+    """
+    # photos and photo_hashes have no index on the path: one pass each via a join
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS moved (old TEXT PRIMARY KEY, new TEXT NOT NULL)")
+    conn.execute("DELETE FROM temp.moved")
+    conn.executemany("INSERT OR REPLACE INTO temp.moved(old, new) VALUES(?, ?)",
+                     [(old, new) for old, new, _ in moves])
+    for table, column in (("photos", "file_path"), ("photo_hashes", "file_path"),
+                          ("uploads", "csv_path"), ("logs", "file_path")):
+        conn.execute(
+            f"""UPDATE {table} SET {column} = (SELECT new FROM temp.moved WHERE old = {column})
+                WHERE {column} IN (SELECT old FROM temp.moved)""")
+    conn.executemany("UPDATE log_index SET path = ?, offset = offset + ? WHERE path = ?",
+                     [(new, shift, old) for old, new, shift in moves if old.endswith(".log")])
+    conn.execute("DELETE FROM temp.moved")
+    conn.executemany("DELETE FROM catalog WHERE path = ?", [(p,) for p in removed])
+    upsert_catalog(conn, added)
+
+def catalog_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT version FROM catalog_version WHERE id = 1").fetchone()[0]
+
+def catalog_nested_tree(conn: sqlite3.Connection) -> dict:
+    """{year: {month: [csv names]}} for the data/YYYY/MM layout; other traps' as <device>/<name>."""
+    tree: dict[str, dict[str, list[str]]] = {}
+    for (path,) in conn.execute(
+            "SELECT path FROM catalog WHERE kind = 'csv' ORDER BY path"):
+        parts = path.split("/")
+        if len(parts) == 4:
+            year, month, _, name = parts
+        elif len(parts) == 5:
+            year, month, device, _, name = parts
+            name = f"{device}/{name}"
+        else:
+            continue
+        tree.setdefault(year, {}).setdefault(month, []).append(name)
+    return tree
+
+def catalog_day_tree(conn: sqlite3.Connection) -> list[dict]:
+    """[{name: day, path, files: [csv names]}], both layouts; other traps' as <device>/<name>."""
+    days: dict[str, list[str]] = {}
+    for day, path, device in conn.execute(
+            "SELECT day, path, device FROM catalog WHERE kind = 'csv' ORDER BY day, path"):
+        name = path.rsplit("/", 1)[-1]
+        if device != DEFAULT_DEVICE:
+            name = f"{device}/{name}"
+        days.setdefault(day or "unknown", []).append(name)
+    return [{"name": d, "path": f"/data/{d}", "files": files} for d, files in days.items()]
+
+# Gallery -----------------------------------------------------------------
+
+def photos_without_thumbnail(conn: sqlite3.Connection, limit: int):
+    return conn.execute(
+        """SELECT p.id, p.file_path FROM photos p
+           LEFT JOIN thumbnails t ON t.photo_id = p.id
+           WHERE t.photo_id IS NULL ORDER BY p.id LIMIT ?""",
+        (limit,),
+    ).fetchall()
+
+def mark_thumbnails(conn: sqlite3.Connection, results: list[tuple[int, bool]]):
+    conn.executemany("INSERT OR REPLACE INTO thumbnails(photo_id, ok) VALUES(?, ?)",
+                     [(pid, int(ok)) for pid, ok in results])
+
+def gallery_page(conn: sqlite3.Connection, day: str | None, before: int | None,
+                 limit: int, device: str | None = None):
+    """Newest first, keyset-paginated on photos.id (no OFFSET scans)."""
+    where, params = [], []
+    if day:
+        where.append("u.day = ?")
+        params.append(day)
+    if device:
+        where.append("u.device = ?")
+        params.append(device)
+    if before is not None:
+        where.append("p.id < ?")
+        params.append(before)
+    sql = """SELECT p.id, p.file_path, p.crop, u.day, u.device, t.ok AS thumb FROM photos p
+             JOIN uploads u ON u.id = p.upload_id
+             LEFT JOIN thumbnails t ON t.photo_id = p.id"""
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY p.id DESC LIMIT ?"
+    return conn.execute(sql, (*params, limit)).fetchall()
+
+def upload_photo_ids(conn: sqlite3.Connection, upload_ids: list[int]) -> list[int]:
+    if not upload_ids:
+        return []
+    marks = ",".join("?" * len(upload_ids))
+    rows = conn.execute(
+        f"SELECT id FROM photos WHERE upload_id IN ({marks}) ORDER BY id", upload_ids)
+    return [r[0] for r in rows]
+
+def photo_path(conn: sqlite3.Connection, photo_id: int) -> str | None:
+    row = conn.execute("SELECT file_path FROM photos WHERE id = ?", (photo_id,)).fetchone()
+    return row[0] if row else None
+
+# Log level index ---------------------------------------------------------
+
+def insert_log_levels(conn: sqlite3.Connection, path: str, levels: list[tuple[int, str]]):
+    conn.executemany(
+        "INSERT OR IGNORE INTO log_index(path, offset, level) VALUES(?, ?, ?)",
+        [(path, offset, level) for offset, level in levels],
+    )
+
+def log_levels(conn: sqlite3.Connection, path: str, level: str | None, limit: int):
+    """Newest indexed WARNING+ lines of one log, optionally a single level."""
+    sql = "SELECT offset, level FROM log_index WHERE path = ?"
+    params: list = [path]
+    if level:
+        sql += " AND level = ?"
+        params.append(level)
+    sql += " ORDER BY offset DESC LIMIT ?"
+    return conn.execute(sql, (*params, limit)).fetchall()
+
+# Per-day rollups ---------------------------------------------------------
+
+def apply_rollup(conn: sqlite3.Connection, day: str, agg: dict,
+                 device: str = DEFAULT_DEVICE):
+    """Merge the aggregates of one CSV chunk (see utils.aggregate_csv_text)."""
+    conn.execute(
+        """INSERT INTO rollup_days(device, day, rows, insects) VALUES(?, ?, ?, ?)
+           ON CONFLICT(device, day) DO UPDATE SET
+               rows    = rows + excluded.rows,
+               insects = insects + excluded.insects""",
+        (device, day, agg["rows"], agg["insects"]),
+    )
+    conn.executemany(
+        """INSERT INTO rollups(device, day, name, count, sum, min, max)
+           VALUES(?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT(device, day, name) DO UPDATE SET
+               count = count + excluded.count,
+               sum   = sum + excluded.sum,
+               min   = MIN(min, excluded.min),
+               max   = MAX(max, excluded.max)""",
+        [(device, day, name, *stat) for name, stat in agg["columns"].items()],
+    )
+
+def clear_rollups(conn: sqlite3.Connection):
+    conn.execute("DELETE FROM rollups")
+    conn.execute("DELETE FROM rollup_days")
+
+def rollup_summary(conn: sqlite3.Connection, days: list[str],
+                   device: str | None = None) -> dict:
+    """
+    {"insects": n, "averages": {column: mean}}, read from a handful of rows.
+    Fleet-wide unless *device* is given: counts and sums add up across
+    traps, so the fleet view is just the merge of the per-device rows.
+    """
+    where = f"day IN ({','.join('?' * len(days))})"
+    params = list(days)
+    if device is not None:
+        where += " AND device = ?"
+        params.append(device)
+    insects = conn.execute(
+        f"SELECT COALESCE(SUM(insects), 0) FROM rollup_days WHERE {where}",
+        params,
+    ).fetchone()[0]
+    rows = conn.execute(
+        f"""SELECT name, SUM(count), SUM(sum), MIN(min), MAX(max) FROM rollups
+            WHERE {where} GROUP BY name ORDER BY name""",
+        params,
+    ).fetchall()
+    return {
+        "insects": int(insects),
+        "averages": {r[0]: r[2] / r[1] for r in rows if r[1]},
+        "min": {r[0]: r[3] for r in rows},
+        "max": {r[0]: r[4] for r in rows},
+    }
+
+
+# Measurements ------------------------------------------------------------
+
+def insert_measurements(conn: sqlite3.Connection, upload_id: int | None,
+                        rows: list[tuple[float, str, float]],
+                        device: str = DEFAULT_DEVICE):
+    conn.executemany(
+        "INSERT INTO measurements(upload_id, ts, name, value, device) VALUES(?, ?, ?, ?, ?)",
+        [(upload_id, *r, device) for r in rows],
+    )
+
+def clear_measurements(conn: sqlite3.Connection):
+    conn.execute("DELETE FROM measurements")
+
+def query_measurements(conn: sqlite3.Connection, start: float, end: float,
+                       columns: list[str] | None = None,
+                       step: int | None = None,
+                       limit: int = 10_000,
+                       device: str | None = None) -> dict[str, list[tuple[float, float]]]:
+    """
+    Range scan over [start, end) using the (name, ts) index, or the
+    (device, name, ts) one for a single trap.
+    With *step* (seconds) rows are averaged into buckets server-side and
+    each point is stamped with the start of its bucket.  *limit* applies to
+    each column, so one busy column cannot crowd the others out.
+    """
+    where = "ts >= ? AND ts < ?"
+    params: list = [start, end]
+    if device is not None:
+        where += " AND device = ?"
+        params.append(device)
+    if columns:
+        where += f" AND name IN ({','.join('?' * len(columns))})"
+        params += columns
+
+    if step:
+        points = f"""SELECT name, CAST(ts / ? AS INTEGER) * ? AS bucket, AVG(value) AS value
+                     FROM measurements WHERE {where} GROUP BY name, bucket"""
+        params = [step, step, *params]
+    else:
+        points = f"SELECT name, ts AS bucket, value FROM measurements WHERE {where}"
+    sql = f"""SELECT name, bucket, value FROM (
+                  SELECT *, ROW_NUMBER() OVER (PARTITION BY name ORDER BY bucket) AS n
+                  FROM ({points}))
+              WHERE n <= ? ORDER BY name, bucket"""
+    params.append(limit)
+
+    series: dict[str, list[tuple[float, float]]] = {}
+    for name, ts, value in conn.execute(sql, params):
+        series.setdefault(name, []).append((ts, value))
+    return series
+
+# Chart series (see utils.series_rollup) ----------------------------------
+
+def apply_series(conn: sqlite3.Connection, rows: list[tuple],
+                 device: str = DEFAULT_DEVICE):
+    """Merge the (name, step, bucket, count, sum, min, max) of one upload."""
+    conn.executemany(
+        """INSERT INTO series_rollups(device, name, step, bucket, count, sum, min, max)
+           VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT(device, name, step, bucket) DO UPDATE SET
+               count = count + excluded.count,
+               sum   = sum + excluded.sum,
+               min   = MIN(min, excluded.min),
+               max   = MAX(max, excluded.max)""",
+        [(device, *r) for r in rows],
+    )
+
+def rebuild_series(conn: sqlite3.Connection):
+    """Recompute every tier from the measurements table."""
+    conn.execute("DELETE FROM series_rollups")
+    for step in SERIES_STEPS:
+        conn.execute(
+            """INSERT INTO series_rollups(device, name, step, bucket, count, sum, min, max)
+               SELECT device, name, ?, CAST(ts / ? AS INTEGER) * ? AS bucket,
+                      COUNT(*), SUM(value), MIN(value), MAX(value)
+               FROM measurements GROUP BY device, name, bucket""",
+            (step, step, step),
+        )
+
+def query_series(conn: sqlite3.Connection, start: float, end: float, step: int,
+                 columns: list[str] | None = None,
+                 device: str | None = None) -> dict[str, list[tuple]]:
+    """
+    (bucket, count, sum, min, max) per name for the buckets of one tier
+    overlapping [start, end), merged across traps unless *device* is given.
+    """
+    where = "step = ? AND bucket >= ? AND bucket < ?"
+    params: list = [step, int(start // step) * step, end]
+    if device is not None:
+        where += " AND device = ?"
+        params.append(device)
+    if columns:
+        where += f" AND name IN ({','.join('?' * len(columns))})"
+        params += columns
+
+    series: dict[str, list[tuple]] = {}
+    for name, *row in conn.execute(
+        f"""SELECT name, bucket, SUM(count), SUM(sum), MIN(min), MAX(max)
+            FROM series_rollups WHERE {where}
+            GROUP BY name, bucket ORDER BY name, bucket""",
+        params,
+    ):
+        series.setdefault(name, []).append(tuple(row))
+    return series
@@ -0,0 +1,96 @@
+"""
+Compressed upload parts.
+
+A trap may send its CSV and log parts compressed, with the coding named in
+the part's own `Content-Encoding` header (multipart) or in the session's
+"encoding" (resumable uploads).  It only does so after the hub advertised
+what it accepts: every upload response carries
+
+    Accept-Encoding: zstd, gzip
+
+(RFC 7694), so older traps, which never look, keep sending plain parts.
+
+Parts are decoded as streams: `decoded()` wraps the received part in a
+reader that inflates on demand, so ingest reads the same 1 MiB chunks it
+reads from a plain part and never holds a whole payload in memory.  A part
+that inflates past MAX_DECODED_MB is refused with 413, so a small
+compressed bomb cannot fill the disk or the memory of the hub.
+"""
+import gzip, os, zlib
+
+from fastapi import HTTPException, UploadFile
+
+try:
+    import zstandard
+except ImportError:              # gzip only
+    zstandard = None
+
+_CODERS = {"gzip": lambda f: gzip.GzipFile(fileobj=f, mode="rb")}
+if zstandard is not None:
+    _CODERS["zstd"] = lambda f: zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+
+MAX_DECODED = int(os.getenv("MAX_DECODED_MB", "256")) * 1024 * 1024
+
+# preferred first
+ACCEPT_ENCODING = ", ".join(sorted(_CODERS, key=lambda c: c != "zstd"))
+ADVERTISE = {"Accept-Encoding": ACCEPT_ENCODING}
+
+_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def check_encoding(encoding: str | None) -> str | None:
+    """The coding to decode with (None for a plain part), or 415."""
+    encoding = (encoding or "").strip().lower() or None
+    if encoding in (None, "identity"):
+        return None
+    if encoding not in _CODERS:
+        raise HTTPException(status_code=415, detail=f"unsupported Content-Encoding {encoding!r}",
+                            headers=ADVERTISE)
+    return encoding
+
+
+class _Decoder:
+    """File-like reader over a decompressor; corrupt input becomes a 400, too much output a 413."""
+    def __init__(self, encoding: str, raw, limit: int = MAX_DECODED):
+        self.encoding = encoding
+        self.reader = _CODERS[encoding](raw)
+        self.limit = limit
+        self.total = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(1024 * 1024), b""))
+        try:
+            # never inflates more than one byte past the limit
+            data = self.reader.read(min(size, self.limit - self.total + 1))
+        except _ERRORS as exc:
+            raise HTTPException(status_code=400, detail=f"corrupt {self.encoding} part: {exc}")
+        self.total += len(data)
+        if self.total > self.limit:
+            raise HTTPException(status_code=413,
+                                detail=f"part larger than {self.limit // (1024 * 1024)} MB once decoded")
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # UploadFile.seek(0) before a first read, nothing else is supported
+        if offset or whence:
+            raise OSError("decoded parts can only be read forward")
+        return 0
+
+    def close(self):
+        self.reader.close()
+
+
+def decoded(part: UploadFile | None, encoding: str | None = None) -> UploadFile | None:
+    """
+    *part* as it was before compression.  The coding comes from *encoding*
+    or else from the part's Content-Encoding header; plain parts are
+    returned as they are.
+    """
+    if part is None:
+        return None
+    encoding = check_encoding(encoding or part.headers.get("content-encoding"))
+    if encoding is None:
+        return part
+    part.file.seek(0)
+    return UploadFile(_Decoder(encoding, part.file), filename=part.filename)
@@ -0,0 +1,61 @@
+"""
+In-process pub/sub for the live dashboard.
+
+Ingest publishes one small event per commit (rows and insects added, new
+photo ids, the refreshed 3-day summary).  Each event is encoded as an SSE
+frame once and kept in a short ring, so a connected browser costs a cursor
+and one waiting coroutine: every viewer is sent the same bytes and nothing
+is aggregated per viewer.
+"""
+import json, time
+from collections import deque
+
+from .logtail import Notifier
+
+RING_SIZE = 256
+KEEPALIVE = 15.0
+
+
+class EventBus:
+    def __init__(self, size: int = RING_SIZE):
+        self._ring: deque[tuple[int, bytes]] = deque(maxlen=size)
+        # ids keep growing across restarts, so an old Last-Event-ID reads as "missed some"
+        self._next = time.time_ns() // 1000
+        self.last_id = self._next - 1
+        self._changed = Notifier()
+
+    def publish(self, kind: str, payload: dict):
+        eid, self._next = self._next, self._next + 1
+        data = json.dumps(payload, separators=(",", ":"))
+        self._ring.append((eid, f"id: {eid}\nevent: {kind}\ndata: {data}\n\n".encode()))
+        self.last_id = eid
+        self._changed.notify()
+
+    def since(self, cursor: int) -> tuple[list[bytes], bool]:
+        """
+        Frames after *cursor*, and whether some are lost: older ones already
+        left the ring, or the cursor is ahead of us (from a hub whose clock
+        was ahead), so nothing after it can be told apart.
+        """
+        if cursor > self.last_id:
+            return [], True
+        if cursor == self.last_id:
+            return [], False
+        lost = not self._ring or cursor < self._ring[0][0] - 1
+        return [frame for eid, frame in self._ring if eid > cursor], lost
+
+    async def stream(self, cursor: int | None = None):
+        """SSE bytes from *cursor* (default: only what comes next)."""
+        if cursor is None:
+            cursor = self.last_id
+        while True:
+            frames, lost = self.since(cursor)
+            cursor = self.last_id                          # clamped, should it have been ahead
+            if lost:
+                yield b"event: reset\ndata: {}\n\n"       # refetch the summary
+            if frames:
+                yield b"".join(frames)
+            if lost or frames:
+                continue                                   # more may have come meanwhile
+            if not await self._changed.wait(KEEPALIVE):
+                yield b": keep-alive\n\n"
@@ -0,0 +1,349 @@
+"""
+Write-behind ingest for /api/upload (enabled with INGEST_MODE=spool).
+
+The request handler only streams the multipart parts into a spool entry
+    data/spool/<entry>/{meta.json, csv, log, img-0, img-1, …}
+(meta.json names the day and the device, so each entry lands in its trap's files)
+fsyncs it, renames it into place and acks.  `SpoolWriter.run` then applies
+entries in batches: CSV/log appends and image moves first, then every DB row
+of the batch in one transaction (group commit), then the entries are removed.
+
+Crash recovery is simply "apply whatever is still in the spool" on start-up:
+  * before touching the day files an entry writes `applied.json` with their
+    sizes, so a replay truncates back to them before appending again;
+  * the entry id is stored in `spool_applied` inside the DB transaction, so
+    an entry that was committed but not yet removed is never recorded twice;
+  * a committed entry is renamed to `<entry>.done` before it is deleted, so
+    once it is gone from the queue it stays gone, and its `spool_applied`
+    row is dropped by the next batch (any row whose entry is no longer
+    queued is one that was removed, before a restart or not).
+An entry that cannot be applied has its day-file appends truncated away and
+its images moved back before it is parked as `<entry>.failed`.  When the
+group commit fails, the batch is undone and its entries are applied and
+recorded one at a time, so only the one the DB rejects gets parked.
+"""
+import asyncio, functools, hashlib, json, logging, os, shutil, time, uuid
+from pathlib import Path
+
+import aiofiles
+from fastapi import UploadFile
+
+from .database import get_db, record_upload, spool_applied, mark_spool_applied, prune_spool_applied, known_photo_hashes
+from .logtail import scan_levels
+from .metrics import run_in_threadpool
+from .utils import DEFAULT_DEVICE, CsvStream, crop_meta, ensure_day_dirs, series_rollup, file_sha256, store_image, catalog_entries
+
+logger = logging.getLogger(__name__)
+
+INGEST_MODE = os.getenv("INGEST_MODE", "direct")   # "direct" | "spool"
+BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+GROUP_COMMIT_DELAY = 0.05                          # s to wait for more entries
+
+
+def _fsync_path(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _append(dst: Path, offset: int, data_src: Path | None = None, stream: CsvStream | None = None):
+    """Truncate *dst* back to *offset* (a replay) and append *data_src* to it, through *stream* for a CSV."""
+    with open(dst, "r+b" if dst.exists() else "wb") as out:
+        out.truncate(offset)
+        out.seek(offset)
+        if stream is not None:
+            with open(data_src, "rb") as src:
+                while chunk := src.read(1024 * 1024):
+                    out.write(stream.feed(chunk).encode())
+            out.write(stream.close().encode())
+        else:
+            with open(data_src, "rb") as src:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+        out.flush()
+        os.fsync(out.fileno())
+
+
+def _image_candidates(img_dir: Path, filename: str, sha: str) -> list[Path]:
+    # the names utils.store_image may have picked
+    dst = img_dir / Path(filename).name
+    return [dst, img_dir / f"{dst.stem}-{sha[:12]}{dst.suffix}"]
+
+
+class SpoolWriter:
+    def __init__(self, data_dir: Path, on_commit=None):
+        self.data_dir = data_dir
+        self.on_commit = on_commit          # awaited with [(upload_id, rec)] after each group commit
+        self.spool = data_dir / "spool"
+        self.spool.mkdir(parents=True, exist_ok=True)
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+
+    # request side ------------------------------------------------------
+
+    async def put(self, day: str, csv: UploadFile | None, images: list[UploadFile],
+                  log: UploadFile | None, health: dict | None, error: dict | None,
+                  device: str = DEFAULT_DEVICE, crops: dict | None = None):
+        entry = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        tmp = self.spool / f"{entry}.tmp"
+        tmp.mkdir()
+
+        meta = {"day": day, "device": device, "health": health, "error": error,
+                "csv": csv is not None, "log": log is not None, "images": [],
+                "crops": crops}
+        try:
+            if csv is not None:
+                await self._spool_part(csv, tmp / "csv")
+            for i, img in enumerate(images):
+                sha = await self._spool_part(img, tmp / f"img-{i}")
+                meta["images"].append([f"img-{i}", Path(img.filename or f"{entry}-{i}.jpg").name, sha])
+            if log is not None:
+                await self._spool_part(log, tmp / "log")
+            async with aiofiles.open(tmp / "meta.json", "w") as out:
+                await out.write(json.dumps(meta))
+        except BaseException:
+            # a refused part (413, 400): nothing was acknowledged
+            await run_in_threadpool(shutil.rmtree, tmp, True)
+            raise
+
+        await run_in_threadpool(self._commit_entry, tmp, self.spool / entry)
+        self._wake.set()
+
+    @staticmethod
+    async def _spool_part(part: UploadFile, dst: Path) -> str:
+        digest = hashlib.sha256()
+        async with aiofiles.open(dst, "wb") as out:
+            while chunk := await part.read(1024 * 1024):
+                digest.update(chunk)
+                await out.write(chunk)
+        await part.close()
+        return digest.hexdigest()
+
+    def _commit_entry(self, tmp: Path, final: Path):
+        for f in tmp.iterdir():
+            _fsync_path(f)
+        os.rename(tmp, final)
+        _fsync_path(self.spool)
+
+    # writer side -------------------------------------------------------
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Finish the current batch and exit; the rest stays spooled."""
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+
+    def _queued(self) -> list[str]:
+        return sorted(p.name for p in self.spool.iterdir()
+                      if p.is_dir() and "." not in p.name)
+
+    def _pending(self) -> list[Path]:
+        return [self.spool / n for n in self._queued()[:BATCH_SIZE]]
+
+    def _drop_incomplete(self):
+        # never acknowledged, the device will resend them; .done ones are committed
+        for p in [*self.spool.glob("*.tmp"), *self.spool.glob("*.done")]:
+            shutil.rmtree(p, ignore_errors=True)
+
+    async def run(self):
+        await run_in_threadpool(self._drop_incomplete)
+        while not self._stopping:
+            self._wake.clear()
+            entries = await run_in_threadpool(self._pending)
+            if not entries:
+                await self._wake.wait()
+                await asyncio.sleep(GROUP_COMMIT_DELAY)
+                continue
+            try:
+                await self._apply_batch(entries)
+            except Exception:
+                logger.exception("spool batch failed, retrying")
+                await asyncio.sleep(1)
+
+    async def _apply_batch(self, entries: list[Path]):
+        db = get_db()
+        done = await db.read(spool_applied, [e.name for e in entries])
+        hashes = await run_in_threadpool(self._image_hashes, entries)
+        known = set(await db.read(known_photo_hashes, hashes))
+
+        records, undo = [], []
+        for entry in entries:
+            if entry.name in done:
+                continue
+            try:
+                rec, roll_back = await run_in_threadpool(self._apply_files, entry, known)
+            except Exception:
+                logger.exception("cannot apply spool entry %s, parking it", entry.name)
+                entry.rename(entry.with_name(entry.name + ".failed"))
+                continue
+            records.append((entry.name, rec))
+            undo.append(roll_back)
+
+        queued = set(await run_in_threadpool(self._queued))
+        try:
+            recorded = await db.write(self._record_batch, records, queued)
+        except Exception:
+            logger.exception("spool group commit failed, applying its %d entries one at a time", len(records))
+            for roll_back in reversed(undo):     # later appends first, back to the batch's offsets
+                await run_in_threadpool(roll_back)
+            known = set(await db.read(known_photo_hashes, hashes))
+            names = {name for name, _ in records}
+            records, recorded = await self._apply_singly(
+                [e for e in entries if e.name in names], known, queued)
+        for (_, rec), (_, skipped) in zip(records, recorded):
+            for path in skipped:             # content another upload recorded first
+                Path(path).unlink(missing_ok=True)
+            rec["photos"] = [p for p in rec["photos"] if p[0] not in skipped]
+        if records and self.on_commit is not None:
+            try:
+                await self.on_commit([(uid, rec) for (uid, _), (_, rec) in zip(recorded, records)])
+            except Exception:
+                logger.exception("on_commit hook failed")
+        # their spool_applied rows are dropped with the next batch
+        await run_in_threadpool(self._remove, entries)
+
+    async def _apply_singly(self, entries: list[Path], known: set[str], queued: set[str]):
+        """Apply and record each entry in a transaction of its own; the ones that fail are parked."""
+        db = get_db()
+        records, recorded = [], []
+        for entry in entries:
+            try:
+                rec, roll_back = await run_in_threadpool(self._apply_files, entry, known)
+            except Exception:
+                logger.exception("cannot apply spool entry %s, parking it", entry.name)
+                entry.rename(entry.with_name(entry.name + ".failed"))
+                continue
+            try:
+                recorded += await db.write(self._record_batch, [(entry.name, rec)], queued)
+            except Exception:
+                logger.exception("cannot record spool entry %s, parking it", entry.name)
+                await run_in_threadpool(roll_back)
+                entry.rename(entry.with_name(entry.name + ".failed"))
+                continue
+            records.append((entry.name, rec))
+        return records, recorded
+
+    @staticmethod
+    def _record_batch(conn, records: list[tuple[str, dict]], queued: set[str]) -> list[tuple[int, list[str]]]:
+        prune_spool_applied(conn, queued)
+        recorded = [record_upload(conn, **rec) for _, rec in records]
+        mark_spool_applied(conn, [entry for entry, _ in records])
+        return recorded
+
+    def _remove(self, entries: list[Path]):
+        done = []
+        for e in entries:
+            if e.exists():                   # not parked
+                done.append(e.rename(e.with_name(e.name + ".done")))
+        _fsync_path(self.spool)              # out of the queue for good
+        for e in done:
+            shutil.rmtree(e, ignore_errors=True)
+
+    @staticmethod
+    def _image_hashes(entries: list[Path]) -> list[str]:
+        hashes = []
+        for entry in entries:
+            try:
+                meta = json.loads((entry / "meta.json").read_text())
+            except (OSError, ValueError):
+                continue
+            hashes += [img[2] for img in meta["images"] if len(img) > 2]
+        return hashes
+
+    def _apply_files(self, entry: Path, known: set[str]) -> tuple[dict, functools.partial]:
+        """The entry's DB record, and how to undo its files should that not commit."""
+        meta = json.loads((entry / "meta.json").read_text())
+        day = meta["day"]
+        device = meta.get("device", DEFAULT_DEVICE)   # entries spooled before devices existed
+        day_dir = ensure_day_dirs(self.data_dir, day, device)
+        day_csv = day_dir / "csv" / f"{day}.csv"
+        day_log = day_dir / "log" / f"{day}.log"
+
+        marker = entry / "applied.json"
+        if marker.exists():
+            offsets = json.loads(marker.read_text())
+        else:
+            offsets = {
+                key: dst.stat().st_size if dst.exists() else 0
+                for key, dst in (("csv", day_csv), ("log", day_log)) if meta[key]
+            }
+            marker.write_text(json.dumps(offsets))
+            _fsync_path(marker)
+
+        moved: list[tuple[Path, Path, str]] = []      # (spooled part, stored image, sha)
+        roll_back = functools.partial(self._roll_back, entry, day_csv, day_log, offsets, known, moved)
+        try:
+            return self._write_files(entry, meta, day_dir, day_csv, day_log, offsets, known, moved), roll_back
+        except Exception:
+            roll_back()
+            raise
+
+    @staticmethod
+    def _roll_back(entry: Path, day_csv: Path, day_log: Path, offsets: dict,
+                   known: set[str], moved: list[tuple[Path, Path, str]]):
+        """Undo what an entry did to the day files, before it is parked or applied again."""
+        for key, dst in (("csv", day_csv), ("log", day_log)):
+            if key in offsets and dst.exists():
+                with open(dst, "r+b") as out:
+                    out.truncate(offsets[key])
+                    os.fsync(out.fileno())
+        for src, dst, sha in moved:
+            if dst.exists():
+                os.replace(dst, src)
+            known.discard(sha)
+        # a parked entry that is queued again measures the day files afresh
+        (entry / "applied.json").unlink(missing_ok=True)
+
+    def _write_files(self, entry: Path, meta: dict, day_dir: Path, day_csv: Path, day_log: Path,
+                     offsets: dict, known: set[str], moved: list) -> dict:
+        day, device = meta["day"], meta.get("device", DEFAULT_DEVICE)
+        rec: dict = {"day": day, "device": device, "csv_path": "",
+                     "health": meta["health"], "error": meta["error"]}
+        if meta["csv"]:
+            stream = CsvStream(is_new=offsets["csv"] == 0)
+            _append(day_csv, offsets["csv"], data_src=entry / "csv", stream=stream)
+            rec["rollup"], rec["measurements"] = stream.rollup, stream.measurements
+            rec["series"] = series_rollup(rec["measurements"])
+            rec["csv_path"] = str(day_csv)
+
+        photos = []
+        crops = meta.get("crops") or {}
+        for part, filename, *rest in meta["images"]:
+            src = entry / part
+            if src.exists():
+                sha = rest[0] if rest else file_sha256(src)
+                if sha in known:
+                    continue
+                taken = {p for p in _image_candidates(day_dir / "img", filename, sha) if p.exists()}
+                dst = store_image(src, day_dir / "img", filename, sha)
+                if dst not in taken:
+                    moved.append((src, dst, sha))
+            elif rest:
+                # moved by an earlier, interrupted run: find where it went
+                sha = rest[0]
+                dst = next((p for p in _image_candidates(day_dir / "img", filename, sha)
+                            if p.exists() and file_sha256(p) == sha), None)
+                if dst is None or sha in known:
+                    continue
+                moved.append((src, dst, sha))
+            else:
+                continue
+            known.add(sha)
+            photos.append((str(dst), sha, crop_meta(crops, filename)))
+        if photos:
+            _fsync_path(day_dir / "img")
+        rec["photos"] = photos
+
+        if meta["log"]:
+            _append(day_log, offsets["log"], data_src=entry / "log")
+            rec["log_path"] = str(day_log)
+            rec["log_levels"] = scan_levels(day_log, offsets["log"])
+        rec["files"] = catalog_entries(
+            self.data_dir, [rec["csv_path"], *(p[0] for p in photos), rec.get("log_path")], day)
+        return rec
@@ -0,0 +1,124 @@
+"""
+Helpers for the Pi's daily logs (data/YYYY/MM/log/<day>.log, or <day>.log.gz
+once the month is compacted).
+
+The logs only ever grow, so everything here works from byte offsets:
+tails seek from the end, live streaming sends the bytes after a cursor, and
+`scan_levels` indexes WARNING+ lines of each freshly appended chunk so the
+maintenance page can jump to them without reading the file.  Offsets are
+always those of the plain text: a compacted log is opened through
+`archive.open_log`, which seeks by its member index and inflates only the
+member a read lands in, and the WARNING+ index moves along with it.
+"""
+import asyncio, os, re
+from pathlib import Path
+
+from .archive import open_log
+
+BLOCK = 64 * 1024
+INDEXED_LEVELS = ("WARNING", "ERROR", "CRITICAL")
+# matches the Pi's "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+_LEVEL = re.compile(rb"\[(WARNING|ERROR|CRITICAL)\]")
+
+
+def log_day(path: Path) -> str:
+    """YYYY-MM-DD of a day log, compacted or not."""
+    return path.name.split(".", 1)[0]
+
+
+def log_size(path: Path) -> int:
+    """Length of the log text: the cursor of its current end."""
+    with open_log(path) as f:
+        return f.seek(0, os.SEEK_END)
+
+
+def tail_bytes(path: Path, n: int) -> str:
+    """Last *n* bytes, starting at a line boundary."""
+    with open_log(path) as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - n))
+        data = f.read()
+    if size > n and b"\n" in data:
+        data = data.split(b"\n", 1)[1]
+    return data.decode(errors="ignore")
+
+
+def tail_lines(path: Path, n: int) -> tuple[str, int]:
+    """Last *n* lines and the file size (the cursor to stream from)."""
+    with open_log(path) as f:
+        size = pos = f.seek(0, os.SEEK_END)
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(BLOCK, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.splitlines(keepends=True)[-n:]
+    return b"".join(lines).decode(errors="ignore"), size
+
+
+def read_delta(path: Path, offset: int, limit: int = BLOCK) -> tuple[str, int]:
+    """
+    Complete lines after *offset* (at most *limit* bytes) and the new
+    cursor.  A cursor past the end means the file was replaced: restart at 0.
+    """
+    with open_log(path) as f:
+        size = f.seek(0, os.SEEK_END)
+        if offset > size:
+            offset = 0
+        f.seek(offset)
+        data = f.read(min(limit, size - offset))
+    if b"\n" in data:
+        data = data[: data.rindex(b"\n") + 1]
+    elif len(data) < limit:
+        data = b""                   # wait for the rest of the line
+    return data.decode(errors="ignore"), offset + len(data)
+
+
+def read_around(path: Path, offset: int, before: int = 10, after: int = 40) -> str:
+    """A few lines of context around the line that starts at *offset*."""
+    with open_log(path) as f:
+        pos = max(0, offset - BLOCK)
+        f.seek(pos)
+        head = f.read(offset - pos).splitlines(keepends=True)
+        if pos > 0:
+            head = head[1:]          # first one is probably cut
+        lines = head[-before:] if before else []
+        for _ in range(after):
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+    return b"".join(lines).decode(errors="ignore")
+
+
+def scan_levels(path: Path, start: int) -> list[tuple[int, str]]:
+    """(offset, level) of WARNING+ lines from *start* (a line boundary) on."""
+    found = []
+    with open_log(path) as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            m = _LEVEL.search(line, 0, 80)
+            if m:
+                found.append((pos, m.group(1).decode()))
+            pos += len(line)
+    return found
+
+
+class Notifier:
+    """Wake every waiter at once; each notify() starts a new generation."""
+
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    def notify(self):
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
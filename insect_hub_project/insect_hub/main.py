@@ -1,130 +1,549 @@
-from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, Query
 from fastapi.responses import HTMLResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from pathlib import Path
-import shutil, aiofiles, datetime as _dt, json, typing as _t
+import asyncio, shutil, aiofiles, datetime as _dt, json, hashlib, uuid, typing as _t
 from .auth import verify_token, API_TOKEN
-from .database import init_db, get_db, insert_upload, insert_photo, insert_health, insert_error, insert_log
-from .utils import ensure_day_dirs, stats_last_3_days, build_tree, monthly_recap, build_nested_tree
-import sqlite3
+from .database import Database, init_db, get_db, close_db, record_upload, rollup_summary, query_measurements, query_series, latest_health, latest_log, log_levels, upload_photo_ids, device_overview, known_photo_hashes, gallery_page, photo_path, catalog_version, catalog_day_tree, catalog_nested_tree, reconcile_catalog
+from .zipstream import iter_zip
+from .ingest import INGEST_MODE, SpoolWriter
+from .resumable import ResumableStore, SessionError
+from .encoding import ADVERTISE, check_encoding, decoded
+from .thumbnails import ThumbnailWorker
+from .compaction import Compactor
+from .archive import compacted_form, expand_stored, original_path, read_stored, split_packed, stored_exists
+from .events import EventBus
+from . import metrics
+from .metrics import UPLOAD_BYTES, MetricsMiddleware, SlowRequestProfiler, iter_on_behalf, run_in_threadpool
+from .logtail import Notifier, log_day, log_size, tail_bytes, tail_lines, read_delta, read_around, scan_levels
+from .utils import DEFAULT_DEVICE, crop_meta, is_device_name, day_partition, file_device, ensure_day_dirs, monthly_recap, range_recap, CsvStream, last_days, parse_timestamp, parse_interval, store_image, series_rollup, series_step, lttb, catalog_entries, scan_catalog
+from contextlib import asynccontextmanager
+from pydantic import BaseModel
 from starlette.requests import Request
-import io, zipfile, os
+import os
 
 
 
 DATA_DIR = Path("data")
 init_db()
+thumbs = ThumbnailWorker(DATA_DIR)
+compactor = Compactor(DATA_DIR)  # packs closed months, see compaction.py
+log_events = Notifier()          # wakes /api/logs/stream when a log is appended
+bus = EventBus()                 # live dashboard feed, see /api/events
+profiler = (SlowRequestProfiler(DATA_DIR / "profiles", metrics.PROFILE_SLOW_MS / 1000)
+            if metrics.PROFILE_SLOW_MS else None)
+
+async def announce(uploads: list[tuple[int, dict]]):
+    """
+    Run after every ingest commit: wake the background workers and publish
+    what was added.  The summary is computed here once, not per viewer.
+    """
+    recs = [rec for _, rec in uploads]
+    if any(rec.get("photos") for rec in recs):
+        thumbs.notify()
+    if any(rec.get("log_path") for rec in recs):
+        log_events.notify()
+
+    db = get_db()
+    rollups = [rec["rollup"] for rec in recs if rec.get("rollup")]
+    event = {
+        "days": sorted({rec["day"] for rec in recs}),
+        "devices": sorted({rec.get("device", DEFAULT_DEVICE) for rec in recs}),
+        "rows": sum(r["rows"] for r in rollups),
+        "insects": sum(r["insects"] for r in rollups),
+        "photos": await db.read(upload_photo_ids, [uid for uid, rec in uploads if rec.get("photos")]),
+    }
+    if event["rows"]:
+        event["summary"] = await db.read(rollup_summary, last_days(3))
+    bus.publish("upload", event)
+
+spool = SpoolWriter(DATA_DIR, on_commit=announce) if INGEST_MODE == "spool" else None
+resumable = ResumableStore(DATA_DIR / "incoming")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if spool is not None:
+        spool.start()          # also replays entries left by a crash
+    thumbs.start()
+    compactor.start()
+    resumable.start()
+    if profiler is not None:
+        profiler.start()
+    reconcile = asyncio.create_task(reconcile_files())   # catch files changed while down
+    yield
+    await reconcile
+    if spool is not None:
+        await spool.stop()
+    await thumbs.stop()
+    await compactor.stop()
+    await resumable.stop()
+    if profiler is not None:
+        profiler.stop()
+    close_db()
 
 app = FastAPI(title="Insect Hub",
-              root_path=os.getenv("ROOT_PATH", "/allinon"))
+              root_path=os.getenv("ROOT_PATH", "/allinon"),
+              lifespan=lifespan)
+app.add_middleware(MetricsMiddleware, profiler=profiler)
 
 templates = Jinja2Templates(directory=str(Path(__file__).parent / "templates"))
 app.mount("/static", StaticFiles(directory=str(Path(__file__).parent / "static")), name="static")
 
-@app.post("/api/upload", dependencies=[Depends(verify_token)])
+def device_filter(device: str | None = None) -> str | None:
+    """Optional ?device= narrowing a fleet-wide view to one trap."""
+    if device is not None and not is_device_name(device):
+        raise HTTPException(status_code=400, detail="Invalid device")
+    return device
+
+def _json_or_none(text: str | None) -> dict | None:
+    if not text:
+        return None
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+@app.post("/api/upload")
 async def upload(
+    response: Response,
     csv: UploadFile | None = File(None),
     images: list[UploadFile] = File(default=[]),
     log: UploadFile | None = File(None),           
     health: str | None = Form(None),
     error: str | None = Form(None),
-    db: sqlite3.Connection = Depends(get_db),
+    crops: str | None = Form(None),                # {"<image name>": sidecar} from crop-mode traps
+    device: str = Depends(verify_token),
+    db: Database = Depends(get_db),
 ):
-    day = _dt.date.today().isoformat()
-    day_dir = ensure_day_dirs(DATA_DIR, day)
+    response.headers.update(ADVERTISE)                 # parts may come compressed next time
+    if csv is None and not images and log is None:
+        raise HTTPException(400, "upload must contain csv ,images or logs")
+    for part, files in (("csv", [csv]), ("images", images), ("log", [log])):
+        UPLOAD_BYTES.inc(sum(f.size or 0 for f in files if f is not None), part)
+    # bytes on the wire are counted above, ingest sees the decoded parts
+    await ingest(db, decoded(csv), [decoded(img) for img in images], decoded(log),
+                 _json_or_none(health), _json_or_none(error), device, _json_or_none(crops))
+    return {"ack": True}
 
-    csv_path = ""
-    if csv is not None:
-        day_csv = day_dir / "csv" / f"{day}.csv"
-        is_new  = not day_csv.exists()
+def _receive_image(src, dst: Path) -> str:
+    """Copy an image part to *dst*, hashing it on the way; returns its sha256."""
+    digest = hashlib.sha256()
+    with open(dst, "wb") as out:
+        while chunk := src.read(1024 * 1024):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+async def ingest(db: Database, csv: UploadFile | None, images: list[UploadFile],
+                 log: UploadFile | None, health: dict | None = None,
+                 error: dict | None = None, device: str = DEFAULT_DEVICE,
+                 crops: dict | None = None):
+    """Store one upload, whether it came as multipart or as resumable parts."""
+    day = _dt.date.today().isoformat()
+    if spool is not None:
+        # write-behind: persist the raw parts, the spool writer does the rest
+        await spool.put(day, csv, images, log, health, error, device, crops)
+        return
 
-        # read entire incoming CSV into memory (usually < 50 kB)
-        raw_text = (await csv.read()).decode()
+    day_dir = ensure_day_dirs(DATA_DIR, day, device)
 
-        # drop the first line (header) if today's file already exists
-        if not is_new:
-            raw_text = "\n".join(raw_text.splitlines()[1:])
+    csv_path = ""
+    rollup = measurements = series = None
+    log_path = levels = None
+    day_csv = day_dir / "csv" / f"{day}.csv"
+    # one log file per day  ->   data/YYYY/MM/log/2025-06-04.log
+    log_dst = day_dir / "log" / f"{day}.log"
+    starts = {p: p.stat().st_size if p.exists() else None for p in (day_csv, log_dst)}
+    appended, received, parts = [], [], []
+    try:
+        if csv is not None:
+            # aggregated and appended 1 MiB at a time; the header is dropped
+            # if today's file already exists
+            stream = CsvStream(is_new=starts[day_csv] is None)
+            appended.append(day_csv)
+            async with aiofiles.open(day_csv, "ab") as out:
+                while chunk := await csv.read(1024 * 1024):
+                    await out.write(stream.feed(chunk).encode())
+                await out.write(stream.close().encode())
+            rollup, measurements = stream.rollup, stream.measurements
+            series = series_rollup(measurements)
+            csv_path = str(day_csv)
+            await csv.close()
+
+        # images: hash while writing, keep only content the hub does not have yet
+        for img in images:
+            tmp = day_dir / "img" / f".{uuid.uuid4().hex}.part"
+            parts.append(tmp)
+            sha = await run_in_threadpool(_receive_image, img.file, tmp)
+            received.append((tmp, img.filename or tmp.name, sha))
+
+        if log is not None:
+            # append if it already exists, otherwise create
+            appended.append(log_dst)
+            async with aiofiles.open(log_dst, "ab") as out:     # ← "a" for append
+                while chunk := await log.read(1024 * 1024):
+                    await out.write(chunk)
+            await log.close()
+            log_path = str(log_dst)
+            levels = await run_in_threadpool(scan_levels, log_dst, starts[log_dst] or 0)
+    except BaseException:
+        # a refused part (413, 400) leaves the day files as they were
+        for path in appended:
+            if starts[path] is None:
+                path.unlink(missing_ok=True)
+            elif path.exists():
+                os.truncate(path, starts[path])
+        for tmp in parts:
+            tmp.unlink(missing_ok=True)
+        raise
+
+    known = set(await db.read(known_photo_hashes, [r[2] for r in received]))
+    photos = []
+    for tmp, filename, sha in received:
+        if sha in known:
+            tmp.unlink(missing_ok=True)
+            continue
+        known.add(sha)
+        dst = await run_in_threadpool(store_image, tmp, day_dir / "img", filename, sha)
+        photos.append((str(dst), sha, crop_meta(crops, filename)))
+
+    files = await run_in_threadpool(
+        catalog_entries, DATA_DIR, [csv_path, *(p[0] for p in photos), log_path], day)
+
+    # every row of this upload in one transaction on the writer thread
+    upload_id, skipped = await db.write(
+        record_upload, day, csv_path,
+        device=device,
+        rollup=rollup,
+        measurements=measurements,
+        series=series,
+        photos=photos,
+        health=health,
+        error=error,
+        log_path=log_path,
+        log_levels=levels,
+        files=files,
+    )
+    for path in skipped:            # an identical upload racing this one recorded it first
+        Path(path).unlink(missing_ok=True)
+    photos = [p for p in photos if p[0] not in skipped]
+    await announce([(upload_id, {"day": day, "device": device, "rollup": rollup,
+                                 "photos": photos, "log_path": log_path})])
 
-        # append (or create) in binary mode
-        async with aiofiles.open(day_csv, "ab") as out:
-            await out.write(raw_text.encode())
+# Resumable uploads (see resumable.py) -----------------------------------
 
-        csv_path = str(day_csv)
-        await csv.close() 
+def _session(fn, *args):
+    try:
+        return fn(*args)
+    except SessionError as exc:
+        raise HTTPException(status_code=exc.status, detail=exc.detail)
+
+class NewSession(BaseModel):
+    kind: str
+    filename: str
+    size: int
+    crop: dict | None = None        # sidecar of a crop-mode image
+    encoding: str | None = None     # coding of the bytes sent, size and offsets count those
+
+@app.post("/api/uploads")
+async def create_upload(body: NewSession, response: Response, device: str = Depends(verify_token)):
+    response.headers.update(ADVERTISE)
+    encoding = check_encoding(body.encoding)
+    return await run_in_threadpool(_session, resumable.create, body.kind, body.filename,
+                                   body.size, device, body.crop, encoding)
+
+@app.get("/api/uploads/{sid}")
+async def upload_status(sid: str, device: str = Depends(verify_token)):
+    _session(resumable.check_owner, sid, device)
+    return _session(resumable.status, sid)
+
+@app.put("/api/uploads/{sid}")
+async def upload_chunk(sid: str, request: Request, offset: int = Query(..., ge=0),
+                       device: str = Depends(verify_token)):
+    _session(resumable.check_owner, sid, device)
+    lock = resumable.lock(sid)
+    if lock.locked():
+        raise HTTPException(status_code=409, detail="chunk already in flight")
+    async with lock:
+        part, meta = _session(resumable.check_append, sid, offset)
+        end = offset
+        async with aiofiles.open(part, "ab") as out:
+            async for chunk in request.stream():
+                end += len(chunk)
+                if end > meta["size"]:
+                    raise HTTPException(status_code=400, detail="chunk exceeds declared size")
+                await out.write(chunk)
+            await out.flush()
+            await run_in_threadpool(os.fsync, out.fileno())
+    UPLOAD_BYTES.inc(end - offset, "images" if meta["kind"] == "image" else meta["kind"])
+    return _session(resumable.status, sid)
+
+@app.post("/api/uploads/{sid}/finalize")
+async def finalize_upload(sid: str, device: str = Depends(verify_token),
+                          db: Database = Depends(get_db)):
+    _session(resumable.check_owner, sid, device)
+    async with resumable.lock(sid):
+        part, meta = await run_in_threadpool(_session, resumable.ready, sid)
+        if not meta["done"]:
+            kind = meta["kind"]
+            f = await run_in_threadpool(open, part, "rb")
+            try:
+                file = decoded(UploadFile(f, filename=meta["filename"]), meta.get("encoding"))
+                await ingest(
+                    db,
+                    file if kind == "csv" else None,
+                    [file] if kind == "image" else [],
+                    file if kind == "log" else None,
+                    device=device,
+                    crops={meta["filename"]: meta["crop"]} if meta.get("crop") else None,
+                )
+            finally:
+                f.close()
+            await run_in_threadpool(resumable.mark_done, sid)
+        resumable.drop_lock(sid)
+    return {"ack": True, "sid": sid}
+
+class Manifest(BaseModel):
+    hashes: list[str]
+
+@app.post("/api/images/missing", dependencies=[Depends(verify_token)])
+async def missing_images(body: Manifest, db: Database = Depends(get_db)):
+    """Image handshake: of these sha256 hashes, which must still be uploaded?"""
+    hashes = [h.lower() for h in body.hashes]
+    known = await db.read(known_photo_hashes, hashes)
+    return {"missing": [h for h in hashes if h not in known]}
+
+# Gallery -----------------------------------------------------------------
+
+IMMUTABLE = {"Cache-Control": "private, max-age=31536000, immutable"}
+
+@app.get("/api/gallery", dependencies=[Depends(verify_token)])
+async def gallery(
+    request: Request,
+    day: str | None = None,
+    before: int | None = None,
+    limit: int = Query(60, ge=1, le=500),
+    device: str | None = Depends(device_filter),
+    db: Database = Depends(get_db),
+):
+    """
+    Photos newest first. Pass the returned `next` as `before` for the
+    following page; `day` (YYYY-MM-DD) and `device` narrow the listing.
+    """
+    rows = await db.read(gallery_page, day, before, limit, device)
+    items = [
+        {
+            "id": r["id"],
+            "name": Path(r["file_path"]).name,
+            "day": r["day"],
+            "device": r["device"],
+            "crop": _json_or_none(r["crop"]),
+            "thumb": str(request.url_for("gallery_thumb", photo_id=r["id"])),
+            "image": str(request.url_for("gallery_image", photo_id=r["id"])),
+            "thumb_ready": bool(r["thumb"]),
+        }
+        for r in rows
+    ]
+    return {"items": items, "next": items[-1]["id"] if len(items) == limit else None}
+
+@app.get("/api/gallery/{photo_id}/thumb", dependencies=[Depends(verify_token)])
+async def gallery_thumb(photo_id: int, db: Database = Depends(get_db)):
+    thumb = thumbs.path(photo_id)
+    if not thumb.exists():
+        src = await db.read(photo_path, photo_id)
+        if src is None or not thumbs.enabled or not await thumbs.render(photo_id, src):
+            raise HTTPException(status_code=404, detail="no thumbnail")
+    return FileResponse(thumb, media_type="image/jpeg", headers=IMMUTABLE)
+
+@app.get("/api/gallery/{photo_id}/image", dependencies=[Depends(verify_token)])
+async def gallery_image(photo_id: int, db: Database = Depends(get_db)):
+    src = await db.read(photo_path, photo_id)
+    if src is not None and split_packed(src):
+        # in the day pack of a compacted month
+        try:
+            data = await run_in_threadpool(read_stored, src)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="photo not found")
+        return Response(data, media_type="image/jpeg", headers=IMMUTABLE)
+    if src is None or not Path(src).exists():
+        raise HTTPException(status_code=404, detail="photo not found")
+    return FileResponse(src, media_type="image/jpeg", headers=IMMUTABLE)
+
+@app.get("/api/events", dependencies=[Depends(verify_token)])
+async def events(request: Request, after: int | None = None):
+    """
+    Server-sent events for the dashboard: one "upload" event per ingest
+    commit. `after` (or Last-Event-ID on reconnect) is the last id seen; a
+    "reset" event means some were missed and the summary should be refetched.
+    """
+    last_id = request.headers.get("last-event-id", "")
+    cursor = int(last_id) if last_id.isdigit() else after
+    return StreamingResponse(bus.stream(cursor), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
 
-    upload_id = insert_upload(db, day, csv_path)
+@app.get("/api/summary/3d", dependencies=[Depends(verify_token)])
+async def last_three_days(device: str | None = Depends(device_filter),
+                          db: Database = Depends(get_db)):
+    return await db.read(rollup_summary, last_days(3), device)
 
-    for img in images:
-        img_dst = day_dir / "img" / img.filename
-        async with aiofiles.open(img_dst, "wb") as out:
-            while chunk := await img.read(1024 * 1024):
-                await out.write(chunk)
-        insert_photo(db, upload_id, str(img_dst))
+@app.get("/api/devices", dependencies=[Depends(verify_token)])
+async def devices(db: Database = Depends(get_db)):
+    """The fleet: every trap with its last upload and 3-day totals."""
+    return {"devices": await db.read(device_overview, last_days(3))}
 
-    if health:
-        try:
-            insert_health(db, upload_id, json.loads(health))
-        except json.JSONDecodeError:
-            pass
-    if error:
-        try:
-            insert_error(db, upload_id, json.loads(error))
-        except json.JSONDecodeError:
-            pass
-    if csv is None and not images and log is None:
-        raise HTTPException(400, "upload must contain csv ,images or logs")
-    
-    if log is not None:
-        # one log file per day  ->   data/YYYY/MM/log/2025-06-04.log
-        log_dst = day_dir / "log" / f"{day}.log"
-    
-        # append if it already exists, otherwise create
-        async with aiofiles.open(log_dst, "ab") as out:     # ← "a" for append
-            while chunk := await log.read(1024 * 1024):
-                await out.write(chunk)
-        await log.close()
-    
-        # store the path once (OPTIONAL)
-        insert_log(db, upload_id, str(log_dst))
+# Trees are rendered from the file catalog; its version counter is the ETag.
+BOOT = f"{_dt.datetime.now().timestamp():.0f}"     # new templates after a deploy
 
-    db.commit()
-    return {"ack": True}
+async def _catalog_etag(request: Request, db: Database) -> tuple[str, Response | None]:
+    etag = f'W/"catalog-{await db.read(catalog_version)}-{BOOT}"'
+    if request.headers.get("if-none-match") == etag:
+        return etag, Response(status_code=304, headers={"ETag": etag})
+    return etag, None
 
-@app.get("/api/summary/3d", dependencies=[Depends(verify_token)])
-async def last_three_days():
-    return stats_last_3_days(DATA_DIR)
+async def reconcile_files() -> dict:
+    """Bring the catalog in line with what is really under data/."""
+    scanned = await run_in_threadpool(scan_catalog, DATA_DIR)
+    return await get_db().write(reconcile_catalog, scanned)
 
 @app.get("/api/tree", dependencies=[Depends(verify_token)])
-async def data_tree():
-    return build_tree(DATA_DIR)
+async def data_tree(request: Request, db: Database = Depends(get_db)):
+    etag, not_modified = await _catalog_etag(request, db)
+    if not_modified:
+        return not_modified
+    return JSONResponse(await db.read(catalog_day_tree), headers={"ETag": etag})
+
+@app.post("/api/catalog/reconcile", dependencies=[Depends(verify_token)])
+async def catalog_reconcile():
+    return await reconcile_files()
 
 @app.get("/api/monthly/{year_month}", dependencies=[Depends(verify_token)])
-async def monthly(year_month: str):
+async def monthly(year_month: str, device: str | None = Depends(device_filter)):
     try:
         _ = _dt.datetime.strptime(year_month, "%Y-%m")
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid YYYY-MM format")
-    return monthly_recap(DATA_DIR, year_month)
+    return await run_in_threadpool(monthly_recap, DATA_DIR, year_month, device)
+
+@app.get("/api/range/{first}/{last}", dependencies=[Depends(verify_token)])
+async def month_range(first: str, last: str, device: str | None = Depends(device_filter)):
+    try:
+        if _dt.datetime.strptime(first, "%Y-%m") > _dt.datetime.strptime(last, "%Y-%m"):
+            raise ValueError
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid YYYY-MM range")
+    return await run_in_threadpool(range_recap, DATA_DIR, first, last, device)
+
+@app.get("/api/measurements", dependencies=[Depends(verify_token)])
+async def measurements(
+    start: str = Query(..., alias="from"),
+    end: str = Query(..., alias="to"),
+    columns: str | None = None,
+    resample: str | None = None,
+    limit: int = Query(10_000, ge=1, le=100_000),
+    device: str | None = Depends(device_filter),
+    db: Database = Depends(get_db),
+):
+    """
+    Range query over the measurements table (all traps, or `device`), e.g.
+        /api/measurements?from=2025-06-01&to=2025-06-02T12:00&columns=Humidity&resample=15min
+    `from`/`to` are ISO-8601 (naive = UTC), `columns` is comma separated,
+    `limit` caps the points of each column.
+    """
+    t0, t1 = parse_timestamp(start), parse_timestamp(end)
+    if t0 is None or t1 is None:
+        raise HTTPException(status_code=400, detail="Invalid from/to timestamp")
+    try:
+        step = parse_interval(resample) if resample else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid resample interval")
+    names = [c.strip() for c in columns.split(",") if c.strip()] if columns else None
+
+    series = await db.read(query_measurements, t0, t1, names, step, limit, device)
+    utc = _dt.timezone.utc
+    return {
+        "from": start,
+        "to": end,
+        "resample": resample,
+        "series": {
+            name: [[_dt.datetime.fromtimestamp(ts, utc).isoformat(), v] for ts, v in pts]
+            for name, pts in series.items()
+        },
+    }
+
+SERIES_MAX_POINTS = 2000
+SERIES_RAW_LIMIT = 200_000
+_SERIES_VALUE = {                 # bucket (count, sum, min, max) -> plotted value
+    "mean": lambda c, s, lo, hi: s / c,
+    "sum": lambda c, s, lo, hi: s,
+    "min": lambda c, s, lo, hi: lo,
+    "max": lambda c, s, lo, hi: hi,
+    "count": lambda c, s, lo, hi: c,
+}
+
+def _chart_series(rows: dict[str, list[tuple]], step: int | None, agg: str,
+                  width: int) -> dict[str, list[list]]:
+    value = _SERIES_VALUE[agg]
+    utc = _dt.timezone.utc
+    out = {}
+    for name, pts in rows.items():
+        if step is not None:
+            pts = [(b, value(*stats)) for b, *stats in pts]
+        elif agg == "count":
+            pts = [(ts, 1) for ts, _ in pts]
+        out[name] = [[_dt.datetime.fromtimestamp(ts, utc).isoformat(), v]
+                     for ts, v in lttb(pts, width)]
+    return out
+
+@app.get("/api/series", dependencies=[Depends(verify_token)])
+async def series(
+    start: str = Query(..., alias="from"),
+    end: str = Query(..., alias="to"),
+    columns: str | None = None,
+    width: int = Query(1000, ge=10, le=SERIES_MAX_POINTS),
+    agg: str = Query("mean", pattern="^(mean|sum|min|max|count)$"),
+    device: str | None = Depends(device_filter),
+    db: Database = Depends(get_db),
+):
+    """
+    Chart data for any span, at most `width` points per column, e.g.
+        /api/series?from=2025-01-01&to=2025-07-01&columns=Temperature,insects&width=1200
+    Short spans come from the raw rows, longer ones from the minute, hour or
+    day rollups (`step` in the reply, seconds); `agg` picks the bucket mean,
+    sum, min, max or count.  LTTB then keeps the shape of the line.
+    """
+    t0, t1 = parse_timestamp(start), parse_timestamp(end)
+    if t0 is None or t1 is None or t1 <= t0:
+        raise HTTPException(status_code=400, detail="Invalid from/to timestamp")
+    names = [c.strip() for c in columns.split(",") if c.strip()] if columns else None
+
+    step = series_step(t1 - t0, width)
+    if step is None:
+        rows = await db.read(query_measurements, t0, t1, names, None, SERIES_RAW_LIMIT, device)
+    else:
+        rows = await db.read(query_series, t0, t1, step, names, device)
+    return {
+        "from": start,
+        "to": end,
+        "step": step,
+        "agg": agg,
+        "series": await run_in_threadpool(_chart_series, rows, step, agg, width),
+    }
 
 @app.get("/api/maintenance", dependencies=[Depends(verify_token)])
-async def maintenance(db: sqlite3.Connection = Depends(get_db)):
+async def maintenance(device: str | None = Depends(device_filter),
+                      db: Database = Depends(get_db)):
     # latest health JSON (kept for completeness)
-    health_row = db.execute(
-        "SELECT payload, created_at FROM health ORDER BY id DESC LIMIT 1"
-    ).fetchone()
+    health_row = await db.read(latest_health, device)
 
     # latest log file
-    log_row = db.execute(
-        "SELECT file_path, created_at FROM logs ORDER BY id DESC LIMIT 1"
-    ).fetchone()
+    log_row = await db.read(latest_log, device)
 
     log_text = ""
     if log_row:
         try:
-            with open(log_row["file_path"], "r", errors="ignore") as f:
-                log_text = f.read()[-20_000:]   # show last 20 KB
+            log_text = await run_in_threadpool(tail_bytes, Path(log_row["file_path"]), 20_000)
         except FileNotFoundError:
             pass
 
@@ -135,65 +554,191 @@ async def maintenance(db: sqlite3.Connection = Depends(get_db)):
         "log_time": log_row["created_at"] if log_row else None,
     }
 
+# Logs ------------------------------------------------------------------------
+
+MAINTENANCE_LINES = 2000
+SSE_KEEPALIVE = 15.0
+
+async def _log_file(db: Database, day: str | None, device: str | None) -> Path:
+    """The log of *day* (YYYY-MM-DD), or the most recently uploaded one."""
+    if day:
+        try:
+            _dt.date.fromisoformat(day)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid YYYY-MM-DD day")
+        path = day_partition(DATA_DIR, day, device or DEFAULT_DEVICE) / "log" / f"{day}.log"
+        if not path.exists():
+            path = compacted_form(path) or path
+    else:
+        row = await db.read(latest_log, device)
+        if row is None:
+            raise HTTPException(status_code=404, detail="no log uploaded yet")
+        path = Path(row["file_path"])
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="log not found")
+    return path
+
+@app.get("/api/logs/delta", dependencies=[Depends(verify_token)])
+async def log_delta(offset: int = Query(0, ge=0), day: str | None = None,
+                    device: str | None = Depends(device_filter),
+                    db: Database = Depends(get_db)):
+    """Lines appended after byte *offset*; pass the returned offset next time."""
+    path = await _log_file(db, day, device)
+    text, new_offset = await run_in_threadpool(read_delta, path, offset)
+    return {"day": log_day(path), "offset": new_offset, "text": text}
+
+@app.get("/api/logs/levels", dependencies=[Depends(verify_token)])
+async def log_level_index(level: str | None = None, day: str | None = None,
+                          limit: int = Query(100, ge=1, le=1000),
+                          device: str | None = Depends(device_filter),
+                          db: Database = Depends(get_db)):
+    path = await _log_file(db, day, device)
+    rows = await db.read(log_levels, str(path), level.upper() if level else None, limit)
+    return {"day": log_day(path), "lines": [{"offset": r[0], "level": r[1]} for r in rows]}
+
+@app.get("/api/logs/at", dependencies=[Depends(verify_token)])
+async def log_at(offset: int = Query(..., ge=0), day: str | None = None,
+                 device: str | None = Depends(device_filter),
+                 db: Database = Depends(get_db)):
+    path = await _log_file(db, day, device)
+    return {"day": log_day(path), "offset": offset,
+            "text": await run_in_threadpool(read_around, path, offset)}
+
+@app.get("/api/logs/stream", dependencies=[Depends(verify_token)])
+async def log_stream(request: Request, offset: int | None = Query(None, ge=0),
+                     device: str | None = Depends(device_filter),
+                     db: Database = Depends(get_db)):
+    """
+    Server-sent events with the lines appended to the latest log. Each event
+    id is "<day>:<offset>", so a reconnecting EventSource resumes from its
+    Last-Event-ID (which wins over ?offset=); without a cursor the stream
+    starts at the current end.
+    """
+    path = await _log_file(db, None, device)
+    device = device or file_device(DATA_DIR, path)      # follow that trap's log only
+    day, _, pos = request.headers.get("last-event-id", "").partition(":")
+    if day == log_day(path) and pos.isdigit():
+        offset = int(pos)
+    if offset is None:
+        offset = await run_in_threadpool(log_size, path)
+
+    async def events():
+        nonlocal path, offset
+        while not await request.is_disconnected():
+            row = await db.read(latest_log, device)
+            if row and Path(row["file_path"]) != path:   # next day's log
+                path, offset = Path(row["file_path"]), 0
+            text, offset = await run_in_threadpool(read_delta, path, offset)
+            if text:
+                data = "".join(f"data: {line}\n" for line in text.splitlines())
+                yield f"id: {log_day(path)}:{offset}\nevent: log\n{data}\n"
+                continue
+            if not await log_events.wait(SSE_KEEPALIVE):
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+@app.get("/metrics", dependencies=[Depends(verify_token)])
+async def prometheus_metrics():
+    """Prometheus text exposition; scrape with `authorization: {credentials: <API_TOKEN>}`."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/", response_class=HTMLResponse)
-async def root(request: Request):
-    summary = stats_last_3_days(DATA_DIR)
-    return templates.TemplateResponse("dashboard.html", {"request": request, "summary": summary})
+async def root(request: Request, db: Database = Depends(get_db)):
+    last_id = bus.last_id                 # stream from what this render shows
+    summary = await db.read(rollup_summary, last_days(3))
+    token = os.getenv("API_TOKEN", "very-secret-and-difficult-token")
+    return templates.TemplateResponse(
+        request, "dashboard.html",
+        {"summary": summary, "token": token, "last_id": last_id},
+    )
 
 
 
 @app.get("/data", response_class=HTMLResponse)
-async def data_view(request: Request):
-    tree  = build_nested_tree(DATA_DIR)
+async def data_view(request: Request, db: Database = Depends(get_db)):
+    etag, not_modified = await _catalog_etag(request, db)
+    if not_modified:
+        return not_modified
+    tree  = await db.read(catalog_nested_tree)
     token = os.getenv("API_TOKEN", "very-secret-and-difficult-token")   # server’s current token
     return templates.TemplateResponse(
-        "data_tree.html",
-        {"request": request, "tree": tree, "token": token},
+        request, "data_tree.html",
+        {"tree": tree, "token": token},
+        headers={"ETag": etag},
     )
 
 @app.get("/maintenance", response_class=HTMLResponse)
-async def maintenance_view(request: Request, db: sqlite3.Connection = Depends(get_db)):
-    health_row = db.execute(
-        "SELECT payload, created_at FROM health ORDER BY id DESC LIMIT 1"
-    ).fetchone()
-
-    log_row = db.execute(
-        "SELECT file_path, created_at FROM logs ORDER BY id DESC LIMIT 1"
-    ).fetchone()
+async def maintenance_view(request: Request, device: str | None = Depends(device_filter),
+                           db: Database = Depends(get_db)):
+    health_row = await db.read(latest_health, device)
+    log_row = await db.read(latest_log, device)
 
-    log_text = ""
+    log_text, log_offset, levels = "", 0, []
     if log_row:
         try:
-            with open(log_row["file_path"], "r", errors="ignore") as f:
-                log_text = f.read().replace("\r\n", "\n").replace("\r", "\n")
+            log_text, log_offset = await run_in_threadpool(
+                tail_lines, Path(log_row["file_path"]), MAINTENANCE_LINES)
+            log_text = log_text.replace("\r\n", "\n").replace("\r", "\n")
         except FileNotFoundError:
             pass
+        levels = await db.read(log_levels, log_row["file_path"], None, 100)
 
     data = {
         "health": json.loads(health_row[0]) if health_row else {},
         "health_time": health_row[1] if health_row else None,
         "log_text": log_text,
         "log_time": log_row["created_at"] if log_row else None,
+        "log_day": log_day(Path(log_row["file_path"])) if log_row else None,
+        "log_device": file_device(DATA_DIR, Path(log_row["file_path"])) if log_row else None,
+        "log_offset": log_offset,
+        "levels": [{"offset": r[0], "level": r[1]} for r in levels],
     }
-    return templates.TemplateResponse("maintenance.html", {"request": request, "data": data})
+    token = os.getenv("API_TOKEN", "very-secret-and-difficult-token")
+    return templates.TemplateResponse(
+        request, "maintenance.html", {"data": data, "token": token})
 
 
+def _walk_files(root: Path):
+    # generator, so the walk itself also runs in the response's threadpool
+    for p in sorted(root.rglob("*")):
+        if p.is_file() and not p.name.startswith("."):     # hub-internal (log indexes, aside files)
+            yield p
+
+def _stored_files(files, base: Path):
+    """(stored path, arcname) pairs; compacted files go in as the originals they replaced."""
+    for p in files:
+        for src in expand_stored(p):
+            yield src, str(original_path(src).relative_to(base))
+
+def _zip_response(files, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        iter_on_behalf(iter_zip(files)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
 @app.get("/download/{day}", dependencies=[Depends(verify_token)])
 async def download_day(day: str):
     day_dir = DATA_DIR / day
-    if not day_dir.exists() or not day_dir.is_dir():
-        raise HTTPException(status_code=404, detail="day not found")
-
-    # in-memory ZIP so we don’t clutter the disk
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for path in day_dir.rglob("*"):
-            zf.write(path, arcname=path.relative_to(DATA_DIR))
-    zip_buffer.seek(0)
-
-    filename = f"{day}.zip"
-    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-    return StreamingResponse(zip_buffer, media_type="application/zip", headers=headers)
+    if day_dir.is_dir():
+        # legacy per-day folder, or a whole year of the new layout
+        files = _walk_files(day_dir)
+    else:
+        # new layout: data/YYYY/MM[/<device>]/{csv,img,log}/<day>…
+        try:
+            _dt.date.fromisoformat(day)
+        except ValueError:
+            raise HTTPException(status_code=404, detail="day not found")
+        year, month, _ = day.split("-")
+        month_dir = DATA_DIR / year / month
+        matches = sorted([*month_dir.glob(f"*/{day}*"), *month_dir.glob(f"*/*/{day}*")])
+        if not matches:
+            raise HTTPException(status_code=404, detail="day not found")
+        files = (p for p in matches if p.is_file())
+
+    return _zip_response(_stored_files(files, DATA_DIR), f"{day}.zip")
 
 @app.get("/download/{path:path}", dependencies=[Depends(verify_token)])
 async def download_path(path: str):
@@ -202,22 +747,16 @@ async def download_path(path: str):
 
     if base not in full.parents and full != base:
         raise HTTPException(status_code=403, detail="Forbidden")
-
-    zbuf = io.BytesIO()
-    with zipfile.ZipFile(zbuf, "w", zipfile.ZIP_DEFLATED) as zf:
-        if full.is_file():
-            # <-- here
-            zf.write(full, arcname=full.relative_to(base))
-        else:
-            for file in full.rglob("*"):
-                if file.is_file():
-                    # <-- and here
-                    zf.write(file, arcname=file.relative_to(base))
-
-    zbuf.seek(0)
-    fname = f"{full.relative_to(base)}.zip".replace(os.sep, "-")
-    return StreamingResponse(
-        zbuf,
-        media_type="application/zip",
-        headers={"Content-Disposition": f'attachment; filename="{fname}"'},
-    )
\ No newline at end of file
+    if not full.exists():
+        # a file of a compacted month, by its old name or inside a day pack
+        full = compacted_form(full) or full
+        if not stored_exists(full):
+            raise HTTPException(status_code=404, detail="not found")
+
+    if full.is_dir():
+        files = _walk_files(full)
+    else:
+        files = iter([full])
+
+    fname = f"{original_path(full).relative_to(base)}.zip".replace(os.sep, "-")
+    return _zip_response(_stored_files(files, base), fname)
@@ -0,0 +1,127 @@
+"""
+Maintenance commands, run from the directory that holds `data/`:
+
+    python -m insect_hub.manage rebuild-rollups
+    python -m insect_hub.manage rebuild-measurements
+    python -m insect_hub.manage rebuild-series
+    python -m insect_hub.manage index-photos
+    python -m insect_hub.manage reconcile-catalog
+    python -m insect_hub.manage compact
+"""
+import argparse, datetime as _dt, hashlib, sqlite3
+from pathlib import Path
+
+from .database import DB_PATH, init_db, apply_rollup, clear_rollups, insert_measurements, clear_measurements, rebuild_series, reconcile_catalog, record_compaction
+from .archive import expand_stored, read_stored, read_table_text, split_packed
+from .compaction import closed_partitions, finish, pack_partition
+from .utils import aggregate_csv_text, iter_csv_files, csv_measurements, file_sha256, scan_catalog
+
+
+def rebuild_rollups(data_dir: Path) -> int:
+    """Recreate the per-day rollup tables from the CSV files on disk."""
+    init_db()
+    n = 0
+    with sqlite3.connect(DB_PATH) as conn:
+        clear_rollups(conn)
+        for device, day, f in iter_csv_files(data_dir):
+            apply_rollup(conn, day, aggregate_csv_text(read_table_text(f)), device)
+            n += 1
+        conn.commit()
+    return n
+
+
+def rebuild_measurements(data_dir: Path) -> int:
+    """Reload the measurements table from the CSV files on disk."""
+    init_db()
+    n = 0
+    with sqlite3.connect(DB_PATH) as conn:
+        clear_measurements(conn)
+        for device, _, f in iter_csv_files(data_dir):
+            insert_measurements(conn, None, csv_measurements(read_table_text(f)), device)
+            n += 1
+        rebuild_series(conn)             # the chart tiers follow the rows
+        conn.commit()
+    return n
+
+
+def rebuild_chart_series() -> int:
+    """Recompute the minute/hour/day chart tiers from the measurements table."""
+    init_db()
+    with sqlite3.connect(DB_PATH) as conn:
+        rebuild_series(conn)
+        conn.commit()
+        return conn.execute("SELECT COUNT(*) FROM series_rollups").fetchone()[0]
+
+
+def index_photos(data_dir: Path) -> int:
+    """Add images already on disk to the photo-hash index (first copy wins)."""
+    init_db()
+    n = 0
+    with sqlite3.connect(DB_PATH) as conn:
+        for f in sorted([*data_dir.glob("*/*/img/*"), *data_dir.glob("*/*/*/img/*"),
+                         *data_dir.glob("*/img/*")]):
+            if not f.is_file() or f.suffix == ".part":
+                continue
+            for src in expand_stored(f):           # the images of a day pack one by one
+                sha = (hashlib.sha256(read_stored(src)).hexdigest() if split_packed(src)
+                       else file_sha256(src))
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO photo_hashes(sha256, file_path) VALUES(?, ?)",
+                    (sha, str(src)),
+                )
+                n += cur.rowcount
+        conn.commit()
+    return n
+
+
+def reconcile(data_dir: Path) -> dict:
+    """Sync the file catalog with a full scan of data/."""
+    init_db()
+    with sqlite3.connect(DB_PATH) as conn:
+        changes = reconcile_catalog(conn, scan_catalog(data_dir))
+        conn.commit()
+    return changes
+
+
+def compact(data_dir: Path) -> int:
+    """Compact every closed month now, as the hub's background job would."""
+    init_db()
+    n = 0
+    with sqlite3.connect(DB_PATH) as conn:
+        for part in closed_partitions(data_dir, _dt.date.today()):
+            jobs, changes = pack_partition(data_dir, part)
+            if jobs:
+                record_compaction(conn, *changes)
+                conn.commit()
+                n += finish(jobs)[0]
+    return n
+
+
+def main(argv: list[str] | None = None) -> None:
+    ap = argparse.ArgumentParser(prog="python -m insect_hub.manage")
+    ap.add_argument("--data-dir", type=Path, default=Path("data"))
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("rebuild-rollups", help="recompute per-day rollups from CSVs")
+    sub.add_parser("rebuild-measurements", help="reload measurements from CSVs")
+    sub.add_parser("rebuild-series", help="recompute chart rollup tiers from measurements")
+    sub.add_parser("index-photos", help="hash existing images into the photo index")
+    sub.add_parser("reconcile-catalog", help="sync the file catalog with data/")
+    sub.add_parser("compact", help="pack the files of closed months now")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "rebuild-rollups":
+        print(f"rebuilt rollups from {rebuild_rollups(args.data_dir)} CSV files")
+    elif args.cmd == "rebuild-measurements":
+        print(f"reloaded measurements from {rebuild_measurements(args.data_dir)} CSV files")
+    elif args.cmd == "rebuild-series":
+        print(f"rebuilt {rebuild_chart_series()} chart rollup rows")
+    elif args.cmd == "index-photos":
+        print(f"indexed {index_photos(args.data_dir)} new images")
+    elif args.cmd == "reconcile-catalog":
+        print("catalog: {updated} updated, {removed} removed".format(**reconcile(args.data_dir)))
+    elif args.cmd == "compact":
+        print(f"compacted {compact(args.data_dir)} files of closed months")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Prometheus metrics for the hub's hot paths, and a slow-request profiler.
+
+Counters and histograms are a few lines each instead of pulling in
+prometheus_client: an update is one lock, one bisect and two additions, so
+they stay on in production.  `render()` produces the text exposition format
+served at /metrics.
+
+`SlowRequestProfiler` (opt-in, PROFILE_SLOW_MS=<ms>) samples the stack of
+every thread at a fixed interval into a short ring, each sample tagged with
+the request that thread was working for: on the event loop the request
+whose task is running, elsewhere the request that handed the work over
+through `run_in_threadpool`, `on_behalf` or `iter_on_behalf` (the DB pool
+does this for its helpers).  When a request takes longer than the threshold,
+its own samples are written as collapsed stacks ("frame;frame;frame count",
+the input of flamegraph.pl, speedscope and inferno) to data/profiles/.  The
+requests that were fast cost nothing beyond the sampling thread.
+"""
+import asyncio, functools, itertools, logging, os, re, sys, threading, time
+from bisect import bisect_left
+from collections import Counter as _Tally, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from starlette.concurrency import run_in_threadpool as _run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))          # 0 = profiler off
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "10")) / 1000
+PROFILE_WINDOW = 60.0          # s of samples kept in memory
+PROFILE_KEEP = 50              # newest profile files kept on disk
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SQLITE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+SIZE_BUCKETS = (1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                out.append(f"{self.name}{_labels(self.labels, key)} {value:g}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}       # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._series.items())
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _labels(self.labels, key, f'le="{bound:g}"')
+                out.append(f"{self.name}_bucket{le} {cumulative}")
+            inf = _labels(self.labels, key, 'le="+Inf"')
+            out.append(f"{self.name}_bucket{inf} {count}")
+            out.append(f"{self.name}_sum{_labels(self.labels, key)} {total:g}")
+            out.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return out
+
+
+HTTP_SECONDS = Histogram(
+    "hub_http_request_duration_seconds", "Request latency by route template.",
+    ("method", "route", "status"))
+UPLOAD_BYTES = Counter(
+    "hub_upload_bytes_total", "Bytes received by upload part.", ("part",))
+SQLITE_SECONDS = Histogram(
+    "hub_sqlite_seconds", "Time spent in SQLite per helper; phase is read, write or commit.",
+    ("phase", "fn"), SQLITE_BUCKETS)
+PANDAS_SECONDS = Histogram(
+    "hub_pandas_parse_seconds", "pandas CSV parse time per file.", ("fn",))
+ZIP_SECONDS = Histogram(
+    "hub_zip_build_seconds", "Time spent building a download archive (excluding waits on the client).")
+ZIP_BYTES = Histogram(
+    "hub_zip_bytes", "Size of the download archives.", buckets=SIZE_BUCKETS)
+
+REGISTRY = [HTTP_SECONDS, UPLOAD_BYTES, SQLITE_SECONDS, PANDAS_SECONDS, ZIP_SECONDS, ZIP_BYTES]
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# Slow-request profiler ---------------------------------------------------
+
+# Which request a thread works for.  Only set while the profiler is on.
+_REQUEST: ContextVar[int | None] = ContextVar("profiled_request", default=None)
+_SERVING: dict[int, int] = {}            # thread ident -> request id
+
+
+@contextmanager
+def _serving(request: int | None):
+    if request is None:
+        yield
+        return
+    tid = threading.get_ident()
+    _SERVING[tid] = request
+    try:
+        yield
+    finally:
+        _SERVING.pop(tid, None)
+
+
+def on_behalf(fn):
+    """*fn*, counted as work of the calling request in whichever thread it runs."""
+    request = _REQUEST.get()
+    if request is None:
+        return fn
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        with _serving(request):
+            return fn(*args, **kwargs)
+    return run
+
+
+def iter_on_behalf(iterator):
+    """A sync iterator (stepped in the threadpool) counted as work of the calling request."""
+    request = _REQUEST.get()
+    if request is None:
+        yield from iterator
+        return
+    while True:
+        with _serving(request):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    """starlette's run_in_threadpool, with the work counted for the calling request."""
+    return await _run_in_threadpool(on_behalf(func), *args, **kwargs)
+
+
+# innermost frames of a thread that is only waiting; skipped like py-spy does
+_IDLE = {("threading.py", "wait"), ("selectors.py", "select"),
+         ("queue.py", "get"), ("thread.py", "_worker")}
+
+
+class SlowRequestProfiler:
+    def __init__(self, out_dir: Path, threshold: float,
+                 interval: float = PROFILE_INTERVAL, window: float = PROFILE_WINDOW):
+        self.out_dir = out_dir
+        self.threshold = threshold
+        self.interval = interval
+        self._samples: deque[tuple[float, int, int | None, tuple]] = deque(maxlen=int(window / interval))
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._ids = itertools.count(1)
+        self._tasks: dict[asyncio.Task, int] = {}     # request tasks on the loop -> request id
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: int | None = None
+
+    def start(self):
+        """Called on the event loop, whose thread is then told apart by task."""
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def begin(self) -> int:
+        """Tag the running request (its task and the work it hands out); returns its id."""
+        request = next(self._ids)
+        _REQUEST.set(request)
+        self._tasks[asyncio.current_task()] = request
+        return request
+
+    def end(self):
+        self._tasks.pop(asyncio.current_task(), None)
+
+    def _working_for(self, tid: int) -> int | None:
+        if tid == self._loop_thread:
+            return self._tasks.get(asyncio.current_task(self._loop))
+        return _SERVING.get(tid)
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE:
+                    continue
+                # code objects only; turned into names when a profile is written
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                self._samples.append((now, tid, self._working_for(tid), tuple(stack)))
+
+    def collapsed(self, start: float, end: float, request: int | None = None) -> list[str]:
+        """
+        Samples between *start* and *end* as folded stacks, root first: those
+        of *request* only, or of every thread when it is None.
+        """
+        names = {t.ident: t.name for t in threading.enumerate()}
+        tally = _Tally()
+        for t, tid, rid, stack in list(self._samples):
+            if start <= t <= end and (request is None or rid == request):
+                frames = [f"{c.co_name} ({os.path.basename(c.co_filename)}:{c.co_firstlineno})"
+                          for c in reversed(stack)]
+                tally[";".join([names.get(tid, f"thread-{tid}"), *frames])] += 1
+        return [f"{stack} {n}" for stack, n in tally.most_common()]
+
+    def dump(self, start: float, end: float, method: str, route: str,
+             request: int | None = None) -> Path | None:
+        lines = self.collapsed(start, end, request)
+        if not lines:
+            return None
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", route).strip("-") or "root"
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{method}-{slug}-{(end - start) * 1000:.0f}ms.folded"
+        path = self.out_dir / name
+        path.write_text("\n".join(lines) + "\n")
+        for old in sorted(self.out_dir.glob("*.folded"))[:-PROFILE_KEEP]:
+            old.unlink(missing_ok=True)
+        return path
+
+
+class MetricsMiddleware:
+    """Times every HTTP request by route template; hands slow ones to the profiler."""
+
+    def __init__(self, app, profiler: SlowRequestProfiler | None = None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status, streaming = 500, False
+
+        async def send_wrapper(message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                streaming = any(k == b"content-type" and v.startswith(b"text/event-stream")
+                                for k, v in message.get("headers", ()))
+            await send(message)
+
+        request = self.profiler.begin() if self.profiler is not None else None
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            t1 = time.perf_counter()
+            if self.profiler is not None:
+                self.profiler.end()
+            # the template ("/api/monthly/{year_month}"), never the raw path
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_SECONDS.observe(t1 - t0, scope["method"], route, status)
+            # live streams are slow by design
+            if self.profiler is not None and not streaming and t1 - t0 >= self.profiler.threshold:
+                try:
+                    path = await run_in_threadpool(
+                        self.profiler.dump, t0, t1, scope["method"], route, request)
+                    if path is not None:
+                        logger.info("slow request %s %s (%.0f ms) profiled to %s",
+                                    scope["method"], route, (t1 - t0) * 1000, path)
+                except OSError:
+                    logger.exception("could not write profile")
@@ -0,0 +1,171 @@
+"""
+Resumable, chunked uploads (one session per file).
+
+    POST  /api/uploads                      {"kind", "filename", "size"[, "crop", "encoding"]} -> session
+    GET   /api/uploads/{sid}                -> {"offset", "size", …}
+    PUT   /api/uploads/{sid}?offset=N       raw bytes, appended at N
+    POST  /api/uploads/{sid}/finalize       hand the file to the normal ingest
+
+Sessions live in data/incoming/ as <sid>.part (the bytes received so far,
+whose size *is* the acknowledged offset) and <sid>.json (metadata, including
+the device that opened it; other devices cannot see the session).  Every
+chunk is fsynced before it is acknowledged, and the json is replaced whole
+and fsynced too.  A finalized session keeps its json with "done": true for
+SESSION_TTL, so a finalize whose response was
+lost can be retried safely.  `start()` purges expired sessions at startup
+and then every PURGE_INTERVAL, off the request path.
+"""
+import asyncio, json, logging, os, re, time, uuid
+from pathlib import Path
+
+from .utils import DEFAULT_DEVICE
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("csv", "image", "log")
+SESSION_TTL = 7 * 24 * 3600
+PURGE_INTERVAL = 3600
+_SID = re.compile(r"[0-9a-f]{32}")
+
+
+class SessionError(Exception):
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status, self.detail = status, detail
+
+
+class ResumableStore:
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+
+    def _paths(self, sid: str) -> tuple[Path, Path]:
+        if not _SID.fullmatch(sid):
+            raise SessionError(404, "unknown upload session")
+        return self.root / f"{sid}.part", self.root / f"{sid}.json"
+
+    def lock(self, sid: str) -> asyncio.Lock:
+        return self._locks.setdefault(sid, asyncio.Lock())
+
+    def create(self, kind: str, filename: str, size: int, device: str = DEFAULT_DEVICE,
+               crop: dict | None = None, encoding: str | None = None) -> dict:
+        if kind not in KINDS:
+            raise SessionError(400, f"kind must be one of {', '.join(KINDS)}")
+        if size < 0:
+            raise SessionError(400, "size must be >= 0")
+        sid = uuid.uuid4().hex
+        part, meta_path = self._paths(sid)
+        part.touch()
+        meta = {"kind": kind, "filename": Path(filename).name, "size": size,
+                "device": device, "created": time.time(), "done": False}
+        if crop is not None and kind == "image":
+            meta["crop"] = crop
+        if encoding is not None:
+            meta["encoding"] = encoding      # decoded at finalize (see encoding.py)
+        self._write_meta(meta_path, meta)
+        return self.status(sid)
+
+    def meta(self, sid: str) -> dict:
+        _, meta_path = self._paths(sid)
+        try:
+            return json.loads(meta_path.read_text())
+        except FileNotFoundError:
+            raise SessionError(404, "unknown upload session")
+
+    def check_owner(self, sid: str, device: str):
+        if self.meta(sid).get("device", DEFAULT_DEVICE) != device:
+            raise SessionError(404, "unknown upload session")
+
+    def status(self, sid: str) -> dict:
+        meta = self.meta(sid)
+        part, _ = self._paths(sid)
+        offset = meta["size"] if meta["done"] else part.stat().st_size
+        return {"sid": sid, "offset": offset, "size": meta["size"],
+                "kind": meta["kind"], "done": meta["done"]}
+
+    def check_append(self, sid: str, offset: int) -> tuple[Path, dict]:
+        meta = self.meta(sid)
+        part, _ = self._paths(sid)
+        current = part.stat().st_size
+        if meta["done"] or offset != current:
+            raise SessionError(409, f"offset mismatch, expected {current}")
+        return part, meta
+
+    @staticmethod
+    def sync(fd) -> None:
+        fd.flush()
+        os.fsync(fd.fileno())
+
+    def _write_meta(self, meta_path: Path, meta: dict):
+        """A crash leaves the old json or the new one, and an acknowledged "done" stays done."""
+        tmp = meta_path.with_suffix(".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+            self.sync(f)
+        os.replace(tmp, meta_path)
+
+    def ready(self, sid: str) -> tuple[Path, dict]:
+        meta = self.meta(sid)
+        part, _ = self._paths(sid)
+        if not meta["done"] and part.stat().st_size != meta["size"]:
+            raise SessionError(409, "upload incomplete")
+        return part, meta
+
+    def mark_done(self, sid: str):
+        part, meta_path = self._paths(sid)
+        meta = self.meta(sid)
+        meta["done"] = True
+        self._write_meta(meta_path, meta)
+        part.unlink(missing_ok=True)
+
+    def drop_lock(self, sid: str):
+        self._locks.pop(sid, None)
+
+    def purge(self):
+        """Drop sessions (finished or abandoned) older than SESSION_TTL."""
+        cutoff = time.time() - SESSION_TTL
+        for meta_path in self.root.glob("*.json"):
+            try:
+                if json.loads(meta_path.read_text())["created"] < cutoff:
+                    meta_path.with_suffix(".part").unlink(missing_ok=True)
+                    meta_path.unlink(missing_ok=True)
+            except (OSError, ValueError, KeyError):
+                continue
+        for tmp in self.root.glob("*.json.tmp"):    # left by a crash mid-write
+            try:
+                if tmp.stat().st_mtime < cutoff:
+                    tmp.unlink()
+            except OSError:
+                continue
+
+    def _drop_locks(self):
+        """Forget the locks of sessions that are gone (runs on the loop, where they are taken)."""
+        for sid in [s for s, lock in self._locks.items()
+                    if not lock.locked() and not (self.root / f"{s}.json").exists()]:
+            del self._locks[sid]
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            try:
+                await loop.run_in_executor(None, self.purge)
+                self._drop_locks()
+            except Exception:
+                logger.exception("purging upload sessions failed")
+            try:
+                await asyncio.wait_for(self._wake.wait(), PURGE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
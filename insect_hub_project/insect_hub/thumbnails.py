@@ -0,0 +1,101 @@
+"""
+Background thumbnail pipeline for the gallery.
+
+`ThumbnailWorker` picks photos that have no row in `thumbnails` yet, renders
+them in a small process pool (Pillow decoding is CPU bound and would
+otherwise compete with ingest for the GIL) and records the result.  Ingest
+only calls `notify()` after its commit, so uploads never wait for it.
+Thumbnails live in data/thumbs/<id // 1000>/<id>.jpg and never change, so
+they can be cached by browsers for good.
+"""
+import asyncio, logging, os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:              # gallery still lists photos, without thumbs
+    Image = None
+
+from .archive import open_stored
+from .database import get_db, photos_without_thumbnail, mark_thumbnails
+from .utils import process_pool
+
+logger = logging.getLogger(__name__)
+
+THUMB_SIZE = (320, 240)
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+BATCH_SIZE = 32
+
+
+def make_thumbnail(src: str, dst: str, size: tuple[int, int] = THUMB_SIZE) -> bool:
+    """Render one thumbnail (runs in the process pool); *src* may be in an image pack."""
+    out = Path(dst)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_suffix(".tmp")
+    try:
+        with open_stored(src) as f, Image.open(f) as im:
+            im.draft("RGB", size)          # let libjpeg downscale while decoding
+            im = im.convert("RGB")
+            im.thumbnail(size)
+            im.save(tmp, "JPEG", quality=75, optimize=True)
+    except (OSError, ValueError):
+        tmp.unlink(missing_ok=True)
+        return False
+    os.replace(tmp, out)
+    return True
+
+
+class ThumbnailWorker:
+    def __init__(self, data_dir: Path):
+        self.root = data_dir / "thumbs"
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+        self._pool: ProcessPoolExecutor | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    def path(self, photo_id: int) -> Path:
+        return self.root / str(photo_id // 1000) / f"{photo_id}.jpg"
+
+    def notify(self):
+        self._wake.set()
+
+    def start(self):
+        if not self.enabled:
+            logger.warning("Pillow not installed, thumbnails disabled")
+            return
+        self._pool = process_pool(THUMB_WORKERS)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    async def render(self, photo_id: int, src: str) -> bool:
+        loop = asyncio.get_running_loop()
+        if self._pool is None:
+            return await loop.run_in_executor(None, make_thumbnail, src, str(self.path(photo_id)))
+        return await loop.run_in_executor(self._pool, make_thumbnail, src, str(self.path(photo_id)))
+
+    async def run(self):
+        db = get_db()
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                todo = await db.read(photos_without_thumbnail, BATCH_SIZE)
+                if not todo:
+                    await self._wake.wait()
+                    continue
+                done = await asyncio.gather(*(self.render(r[0], r[1]) for r in todo))
+                await db.write(mark_thumbnails, [(r[0], ok) for r, ok in zip(todo, done)])
+            except Exception:
+                logger.exception("thumbnail batch failed, retrying")
+                await asyncio.sleep(5)
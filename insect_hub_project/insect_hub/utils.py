@@ -1,125 +1,567 @@
 from pathlib import Path
-import csv, datetime as _dt, statistics, json, typing as _t
+from concurrent.futures import ProcessPoolExecutor
+import csv, datetime as _dt, hashlib, multiprocessing, json, os, re, threading, time, typing as _t
 import pandas as pd
 from pandas.errors import EmptyDataError
 
-from collections import defaultdict
-from typing import Dict, List
+from collections import OrderedDict, defaultdict
 
-def ensure_day_dirs(base: Path, day: str) -> Path:
+from .metrics import PANDAS_SECONDS
+
+DEFAULT_DEVICE = "default"          # the original single trap
+_DEVICE_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]{0,63}")
+
+
+def is_device_name(name: str) -> bool:
+    # device folders sit next to csv/img/log, so those names are taken
+    return bool(_DEVICE_NAME.fullmatch(name)) and name not in CATALOG_KINDS
+
+
+def day_partition(base: Path, day: str, device: str = DEFAULT_DEVICE) -> Path:
+    year, month, _ = day.split("-")
+    month_dir = base / year / month
+    return month_dir if device == DEFAULT_DEVICE else month_dir / device
+
+
+def ensure_day_dirs(base: Path, day: str, device: str = DEFAULT_DEVICE) -> Path:
     """
-    Store files as   data/<YEAR>/<MONTH>/{csv,img}/…
+    Store files as   data/<YEAR>/<MONTH>/{csv,img}/…           (default device)
+                 or  data/<YEAR>/<MONTH>/<device>/{csv,img}/…  (any other trap)
     Example day == '2025-04-28'  →  data/2025/04/csv/
+    Every trap appends to its own files, so writers never share one.
     """
-    year, month, _ = day.split("-")
-    month_dir = base / year / month
+    month_dir = day_partition(base, day, device)
     (month_dir / "csv").mkdir(parents=True, exist_ok=True)
     (month_dir / "img").mkdir(exist_ok=True)
     (month_dir / "log").mkdir(exist_ok=True) 
     return month_dir        # month level type directory
 
 
-def build_tree(data_dir: Path) -> list[dict]:
-    tree = []
-    for day in sorted(p.name for p in data_dir.iterdir() if p.is_dir()):
-        day_dir = data_dir / day
-        node = {"name": day, "path": f"/data/{day}", "files": []}
-        for sub in (day_dir / "csv").glob("*.csv"):
-            node["files"].append(sub.name)
-        tree.append(node)
-    return tree
+def file_device(data_dir: Path, path: Path) -> str:
+    """The trap a stored file belongs to, from its place under data/."""
+    parts = Path(os.path.relpath(path, data_dir)).parts
+    return parts[2] if len(parts) == 5 else DEFAULT_DEVICE
 
-def monthly_recap(data_dir: Path, year_month: str) -> dict:
-    target = _dt.datetime.strptime(year_month, "%Y-%m")
-    start = _dt.date(target.year, target.month, 1)
-    next_month = (start.replace(day=28) + _dt.timedelta(days=4)).replace(day=1)
-    days = [(start + _dt.timedelta(days=i)).isoformat() 
-            for i in range((next_month - start).days)]
-    insects = 0
-    numeric: dict[str, list[float]] = {}
-    for d in days:
-        csv_folder = data_dir / d / "csv"
-        if not csv_folder.exists():
-            continue
-        for f in csv_folder.glob("*.csv"):
-            df = pd.read_csv(f)
-            insect_cols = [c for c in df.columns if "insect" in c.lower()]
-            if insect_cols:
-                insects += int(df[insect_cols[0]].sum())
-            for col in df.select_dtypes(include=["number"]).columns:
-                numeric.setdefault(col, []).extend(df[col].dropna().tolist())
-    averages = {col: statistics.mean(vals) for col, vals in numeric.items() if vals}
-    return {"insects": insects, "averages": averages}
+
+def sniff_delimiter(header: str) -> str:
+    """The Pi writes `;`-separated CSVs, the simulator `,`-separated ones."""
+    return ";" if header.count(";") > header.count(",") else ","
+
+
+def _to_float(value: str) -> float | None:
+    try:
+        v = float(value)
+    except ValueError:
+        return None
+    return v if v == v else None        # drop NaN
+
+
+def read_csv_chunk(text: str) -> tuple[list[str], list[list[str]]]:
+    """Split one CSV chunk (header line included) into header and rows."""
+    lines = [l for l in text.splitlines() if l.strip()]
+    if not lines:
+        return [], []
+    reader = csv.reader(lines, delimiter=sniff_delimiter(lines[0]))
+    header = [h.strip() for h in next(reader)]
+    return header, list(reader)
+
+
+def aggregate_csv_text(text: str) -> dict:
+    """
+    Reduce one CSV chunk (header line included) to running aggregates:
+        {"rows": n, "insects": n, "columns": {name: [count, sum, min, max]}}
+    Only cells that parse as numbers are counted, so ragged rows and the
+    timestamp column are simply ignored.
+    """
+    agg: dict = {"rows": 0, "insects": 0, "columns": {}}
+    header, rows = read_csv_chunk(text)
+    insect_idx = next(
+        (i for i, h in enumerate(header) if "insect" in h.lower()), None
+    )
+    columns: dict[str, list[float]] = agg["columns"]
+
+    for row in rows:
+        agg["rows"] += 1
+        for i, cell in enumerate(row[: len(header)]):
+            v = _to_float(cell)
+            if v is None:
+                continue
+            if i == insect_idx:
+                agg["insects"] += int(v)
+            stat = columns.get(header[i])
+            if stat is None:
+                columns[header[i]] = [1, v, v, v]
+            else:
+                stat[0] += 1
+                stat[1] += v
+                stat[2] = min(stat[2], v)
+                stat[3] = max(stat[3], v)
+    return agg
+
+
+def parse_timestamp(value: str) -> float | None:
+    """ISO-8601 text -> POSIX seconds. Naive timestamps are taken as UTC."""
+    try:
+        ts = _dt.datetime.fromisoformat(value.strip())
+    except ValueError:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=_dt.timezone.utc)
+    return ts.timestamp()
 
 
-def build_nested_tree(data_dir: Path) -> dict:
+def csv_measurements(text: str) -> list[tuple[float, str, float]]:
     """
-    Return  {year: {month: [file-names]}}
+    Flatten one CSV chunk into (ts, column, value) triples.
+    The timestamp is the first column whose name contains "time"
+    (falling back to the first column); rows without one are dropped.
     """
-    tree: dict[str, dict[str, list[str]]] = {}
-    for year_dir in data_dir.glob("*"):
-        if not year_dir.is_dir():
+    header, rows = read_csv_chunk(text)
+    if not header:
+        return []
+    ts_idx = next((i for i, h in enumerate(header) if "time" in h.lower()), 0)
+
+    out = []
+    for row in rows:
+        if len(row) <= ts_idx:
+            continue
+        ts = parse_timestamp(row[ts_idx])
+        if ts is None:
             continue
-        for month_dir in year_dir.glob("*"):
-            if not month_dir.is_dir():
+        for i, cell in enumerate(row[: len(header)]):
+            if i == ts_idx:
                 continue
-            csv_files = sorted((month_dir / "csv").glob("*.csv"))
-            if csv_files:
-                tree.setdefault(year_dir.name, {})[month_dir.name] = [
-                    f.name for f in csv_files
-                ]
-    return dict(sorted(tree.items()))
+            v = _to_float(cell)
+            if v is not None:
+                out.append((ts, header[i], v))
+    return out
+
+
+class CsvStream:
+    """
+    An uploaded CSV taken in pieces of any size, so it is never held whole.
+    `feed()` returns the complete lines received so far as the text to
+    append to the day file and folds them into `rollup` and `measurements`;
+    `close()` does the same for the rest.  The header is kept only when the
+    day file is new, and the text always ends with a newline so the next
+    append starts on its own line.
+    """
+
+    def __init__(self, is_new: bool):
+        self.is_new = is_new
+        self.header: str | None = None          # first non-blank line
+        self.first = True
+        self.pending = b""
+        self.rollup: dict = {"rows": 0, "insects": 0, "columns": {}}
+        self.measurements: list[tuple[float, str, float]] = []
+
+    def feed(self, data: bytes) -> str:
+        data = self.pending + data
+        cut = data.rfind(b"\n") + 1             # a line break never splits a UTF-8 character
+        self.pending = data[cut:]
+        return self._lines(data[:cut].decode())
+
+    def close(self) -> str:
+        rest, self.pending = self.pending, b""
+        text = self._lines(rest.decode())
+        return text if not text or text.endswith("\n") else text + "\n"
+
+    def _lines(self, text: str) -> str:
+        if not text:
+            return ""
+        if self.header is None:
+            chunk = text
+            self.header = next((l for l in text.splitlines() if l.strip()), None)
+        else:
+            chunk = self.header + "\n" + text
+        self._fold(aggregate_csv_text(chunk))
+        self.measurements += csv_measurements(chunk)
+        if self.first:
+            self.first = False
+            if not self.is_new:                 # the day file has its header already
+                text = "".join(text.splitlines(keepends=True)[1:])
+        return text
+
+    def _fold(self, agg: dict):
+        self.rollup["rows"] += agg["rows"]
+        self.rollup["insects"] += agg["insects"]
+        for name, (n, total, low, high) in agg["columns"].items():
+            stat = self.rollup["columns"].get(name)
+            if stat is None:
+                self.rollup["columns"][name] = [n, total, low, high]
+            else:
+                stat[0] += n
+                stat[1] += total
+                stat[2] = min(stat[2], low)
+                stat[3] = max(stat[3], high)
+
+
+# Chart series -------------------------------------------------------------
+#
+# Measurements are also kept pre-aggregated per minute, hour and day
+# (database.series_rollups), updated with every upload.  /api/series reads
+# the finest tier that keeps the read under SERIES_READ_FACTOR x the points
+# asked for, then LTTB brings it down to exactly that many.
+
+SERIES_STEPS = (60, 3600, 86400)
+SERIES_READ_FACTOR = 8
+
 
-def stats_last_3_days(data_dir: Path) -> dict:
-    """Aggregate insect count & numeric averages over the last three calendar days.
+def series_rollup(measurements: list[tuple[float, str, float]]) -> list[tuple]:
+    """(name, step, bucket, count, sum, min, max) of one upload, for every tier."""
+    agg: dict[tuple, list] = {}
+    for ts, name, value in measurements:
+        for step in SERIES_STEPS:
+            key = (name, step, int(ts // step) * step)
+            a = agg.get(key)
+            if a is None:
+                agg[key] = [1, value, value, value]
+            else:
+                a[0] += 1
+                a[1] += value
+                a[2] = min(a[2], value)
+                a[3] = max(a[3], value)
+    return [(*key, *a) for key, a in agg.items()]
 
-    Works with both folder layouts:
-        new  -> data/YYYY/MM/csv/…
-        old  -> data/YYYY-MM-DD/csv/…
+
+def series_step(span: float, points: int) -> int | None:
+    """Rollup tier (seconds) to chart *span* seconds on *points* points; None = raw rows."""
+    if span / SERIES_STEPS[0] <= points:
+        return None
+    for step in SERIES_STEPS:
+        if span / step <= SERIES_READ_FACTOR * points:
+            return step
+    return SERIES_STEPS[-1]
+
+
+def lttb(points: list[tuple[float, float]], threshold: int) -> list[tuple[float, float]]:
+    """
+    Largest-Triangle-Three-Buckets downsampling (Steinarsson, 2013): keeps
+    the first and last point and, from each of threshold - 2 buckets, the
+    point forming the largest triangle with the previous pick and the mean
+    of the next bucket, so peaks and dips survive.
+    """
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return points
+    every = (n - 2) / (threshold - 2)
+    out = [points[0]]
+    a = 0
+    for i in range(threshold - 2):
+        start, end = int((i + 1) * every) + 1, min(int((i + 2) * every) + 1, n)
+        avg_x = sum(p[0] for p in points[start:end]) / (end - start)
+        avg_y = sum(p[1] for p in points[start:end]) / (end - start)
+        ax, ay = points[a]
+        best, best_area = start - 1, -1.0
+        for j in range(int(i * every) + 1, start):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        out.append(points[best])
+        a = best
+    out.append(points[-1])
+    return out
+
+
+_INTERVAL_UNITS = {"s": 1, "min": 60, "m": 60, "h": 3600, "d": 86400}
+
+def parse_interval(text: str) -> int:
+    """'30s', '5min', '1h', '1d' -> seconds (ValueError if malformed)."""
+    text = text.strip().lower()
+    for unit in sorted(_INTERVAL_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            number = text[: -len(unit)] or "1"
+            seconds = int(number) * _INTERVAL_UNITS[unit]
+            if seconds <= 0:
+                break
+            return seconds
+    raise ValueError(f"invalid interval: {text!r}")
+
+
+# a day's rows: the CSV as uploaded, or its Parquet form once the month is compacted
+TABLE_SUFFIXES = (".csv", ".parquet")
+
+
+def _tables(folder: Path) -> list[Path]:
+    return sorted(f for suffix in TABLE_SUFFIXES for f in folder.glob(f"*{suffix}"))
+
+
+def iter_csv_files(data_dir: Path):
+    """
+    Yield (device, day, path) for every CSV (or compacted Parquet) on disk, in all layouts:
+        new     -> data/YYYY/MM/csv/<day>.csv
+        device  -> data/YYYY/MM/<device>/csv/<day>.csv
+        old     -> data/YYYY-MM-DD/csv/…
     """
+    for folder in sorted(data_dir.glob("*/*/csv")):
+        for f in _tables(folder):
+            yield DEFAULT_DEVICE, f.stem, f
+    for folder in sorted(data_dir.glob("*/*/*/csv")):
+        for f in _tables(folder):
+            yield folder.parent.name, f.stem, f
+    for folder in sorted(data_dir.glob("*/csv")):
+        for f in _tables(folder):
+            yield DEFAULT_DEVICE, folder.parent.name, f
+
+
+def last_days(n: int = 3) -> list[str]:
     today = _dt.date.today()
-    days  = [(today - _dt.timedelta(days=i)).isoformat() for i in range(3)]
+    return [(today - _dt.timedelta(days=i)).isoformat() for i in range(n)]
 
-    numeric_cols: Dict[str, List[float]] = defaultdict(list)
-    insects_total = 0
 
-    for d in days:
-        year, month, _ = d.split("-")
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
 
-        for csv_folder in (
-            data_dir / year / month / "csv",  # new layout
-            data_dir / d / "csv",             # legacy layout
-        ):
-            if not csv_folder.exists():
-                continue
 
-            for csv_file in csv_folder.glob("*.csv"):
-                # Skip zero-byte files outright
-                if csv_file.stat().st_size == 0:
-                    continue
-
-                try:
-                    df = pd.read_csv(
-                        csv_file,
-                        engine="python",       # tolerant of ragged rows
-                        on_bad_lines="skip",   # pandas ≥1.3
-                    )
-                except EmptyDataError:
-                    # File has no rows / only whitespace
-                    continue
-
-                # 1) insect count  (first column containing “insect”)
-                insect_cols = [c for c in df.columns if "insect" in c.lower()]
-                if insect_cols:
-                    insects_total += int(df[insect_cols[0]].sum())
-
-                # 2) numeric averages
-                for col in df.select_dtypes(include=["number"]).columns:
-                    numeric_cols[col].extend(df[col].dropna().tolist())
-
-    # Final averages
-    averages = {
-        col: statistics.mean(vals) for col, vals in numeric_cols.items() if vals
+def crop_meta(crops: dict | None, filename: str) -> dict | None:
+    """The sidecar a crop-mode trap sent for *filename*, if any."""
+    crop = crops.get(Path(filename).name) if isinstance(crops, dict) else None
+    return crop if isinstance(crop, dict) else None
+
+
+def store_image(src: Path, img_dir: Path, filename: str, sha: str) -> Path:
+    """
+    Move a received image into img_dir under its own name. If that name is
+    already taken it gets a content-hash suffix instead of overwriting.
+    """
+    dst = img_dir / Path(filename).name
+    if dst.exists():
+        dst = img_dir / f"{dst.stem}-{sha[:12]}{dst.suffix}"
+        if dst.exists():            # the name carries the hash: same bytes
+            src.unlink(missing_ok=True)
+            return dst
+    os.replace(src, dst)
+    return dst
+
+
+CATALOG_KINDS = ("csv", "img", "log")
+
+
+def catalog_entry(data_dir: Path, path: Path, day: str | None = None) -> tuple | None:
+    """
+    (path relative to data/, kind, size, day, mtime, device) for the file catalog.
+    The day comes from a YYYY-MM-DD file-name prefix when there is one,
+    else from the legacy day folder, else from *day*.
+    """
+    kind = path.parent.name
+    if kind not in CATALOG_KINDS or path.name.startswith("."):
+        return None
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    for candidate in (path.name[:10], path.parent.parent.name):
+        try:
+            _dt.date.fromisoformat(candidate)
+            day = candidate
+            break
+        except ValueError:
+            continue
+    rel = Path(os.path.relpath(path, data_dir)).as_posix()
+    return (rel, kind, st.st_size, day, st.st_mtime, file_device(data_dir, path))
+
+
+def catalog_entries(data_dir: Path, paths: list, day: str | None = None) -> list[tuple]:
+    entries = (catalog_entry(data_dir, Path(p), day) for p in paths if p)
+    return [e for e in entries if e is not None]
+
+
+def scan_catalog(data_dir: Path) -> list[tuple]:
+    """Full walk for the reconcile job: data/YYYY/MM[/<device>]/<kind>/* and data/<day>/<kind>/*."""
+    files = []
+    for kind in CATALOG_KINDS:
+        files += data_dir.glob(f"*/*/{kind}/*")
+        files += data_dir.glob(f"*/*/*/{kind}/*")
+        files += data_dir.glob(f"*/{kind}/*")
+    return catalog_entries(data_dir, [f for f in files if f.is_file()])
+
+
+# Recap engine ------------------------------------------------------------
+#
+# Every CSV is reduced to a *partial* {"insects": n, "columns": {col: [count, sum]}}
+# with vectorised pandas ops, in a process pool for cache misses.  Partials
+# are cached by (path, mtime, size) so a closed month is only parsed once;
+# the cache keeps the PARTIALS_CACHE_SIZE most recently used files.
+
+PARTIALS_CACHE_SIZE = int(os.getenv("PARTIALS_CACHE_SIZE", "4096"))
+_PARTIALS: OrderedDict[str, tuple[int, int, dict]] = OrderedDict()
+_PARTIALS_LOCK = threading.Lock()        # recaps run in the threadpool, several at once
+_POOL: ProcessPoolExecutor | None = None
+
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Workers are forked from a clean fork server, not from the hub: a plain
+    fork while requests are in flight hands their sockets to the workers,
+    and those uploads then hang until the client gives up.
+    """
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context("forkserver"))
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        _POOL = process_pool(min(4, os.cpu_count() or 1))
+    return _POOL
+
+
+def csv_partial(path: Path) -> dict:
+    """Vectorised count/sum per numeric column (+ insect total) of one CSV (or Parquet)."""
+    partial: dict = {"insects": 0, "columns": {}}
+    if path.suffix == ".parquet":
+        df = pd.read_parquet(path)
+    else:
+        with open(path, errors="ignore") as f:
+            header = f.readline()
+        if not header.strip():
+            return partial
+        try:
+            df = pd.read_csv(path, sep=sniff_delimiter(header), on_bad_lines="skip")
+        except EmptyDataError:
+            return partial
+    df.columns = [str(c).strip() for c in df.columns]
+
+    insect_cols = [c for c in df.columns if "insect" in c.lower()]
+    if insect_cols:
+        insects = pd.to_numeric(df[insect_cols[0]], errors="coerce").sum()
+        partial["insects"] = int(insects)
+
+    num = df.select_dtypes(include=["number"])
+    counts, sums = num.count(), num.sum()
+    partial["columns"] = {
+        col: [int(counts[col]), float(sums[col])] for col in num.columns if counts[col]
+    }
+    return partial
+
+
+def csv_files_for_days(data_dir: Path, days: list[str],
+                       device: str | None = None) -> list[Path]:
+    """CSV files of the given days (of one device, or all), in every layout."""
+    wanted = set(days)
+    files: list[Path] = []
+    for ym in sorted({d[:7] for d in days}):
+        year, month = ym.split("-")
+        month_dir = data_dir / year / month
+        if device is None:
+            folders = [month_dir / "csv", *sorted(month_dir.glob("*/csv"))]
+        else:
+            folders = [(month_dir if device == DEFAULT_DEVICE else month_dir / device) / "csv"]
+        for folder in folders:
+            if folder.exists():
+                files += [f for f in _tables(folder) if f.stem[:10] in wanted]
+    if device in (None, DEFAULT_DEVICE):
+        for d in days:
+            folder = data_dir / d / "csv"
+            if folder.exists():
+                files += _tables(folder)
+    return files
+
+
+def _timed_partial(path: Path) -> tuple[dict, float]:
+    t0 = time.perf_counter()
+    partial = csv_partial(path)
+    return partial, time.perf_counter() - t0
+
+
+def _cached_partials(files: list[Path]) -> dict[str, dict]:
+    out: dict[str, dict] = {}
+    missing: list[tuple[Path, int, int]] = []
+    for f in files:
+        st = f.stat()
+        with _PARTIALS_LOCK:
+            hit = _PARTIALS.get(str(f))
+            if hit and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+                _PARTIALS.move_to_end(str(f))
+        if hit and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+            out[str(f)] = hit[2]
+        elif st.st_size:
+            missing.append((f, st.st_mtime_ns, st.st_size))
+
+    paths = [m[0] for m in missing]
+    if len(paths) > 1:
+        computed = list(_pool().map(_timed_partial, paths))
+    else:
+        computed = [_timed_partial(p) for p in paths]
+    for (f, mtime, size), (partial, seconds) in zip(missing, computed):
+        # timed in the worker, recorded here where /metrics can see it
+        PANDAS_SECONDS.observe(seconds, "csv_partial")
+        with _PARTIALS_LOCK:
+            _PARTIALS[str(f)] = (mtime, size, partial)
+            _PARTIALS.move_to_end(str(f))
+            while len(_PARTIALS) > PARTIALS_CACHE_SIZE:
+                _PARTIALS.popitem(last=False)
+        out[str(f)] = partial
+    return out
+
+
+def merge_partials(partials: list[dict]) -> dict:
+    insects = 0
+    columns: dict[str, list[float]] = defaultdict(lambda: [0, 0.0])
+    for p in partials:
+        insects += p["insects"]
+        for col, (n, total) in p["columns"].items():
+            columns[col][0] += n
+            columns[col][1] += total
+    averages = {col: total / n for col, (n, total) in columns.items() if n}
+    return {"insects": insects, "averages": averages}
+
+
+def month_days(year_month: str) -> list[str]:
+    target = _dt.datetime.strptime(year_month, "%Y-%m")
+    start = _dt.date(target.year, target.month, 1)
+    next_month = (start.replace(day=28) + _dt.timedelta(days=4)).replace(day=1)
+    return [(start + _dt.timedelta(days=i)).isoformat()
+            for i in range((next_month - start).days)]
+
+
+def merge_by_device(data_dir: Path, partials: dict[str, dict]) -> dict[str, dict]:
+    """Per-trap view of cached partials (keyed by file path)."""
+    grouped: dict[str, list[dict]] = defaultdict(list)
+    for path, partial in partials.items():
+        grouped[file_device(data_dir, Path(path))].append(partial)
+    return {dev: merge_partials(ps) for dev, ps in sorted(grouped.items())}
+
+
+def recap_days(data_dir: Path, days: list[str], device: str | None = None) -> dict:
+    """
+    Each (device, day) file is reduced on its own, in parallel, then merged
+    into the fleet-wide figures and a per-device breakdown.
+    """
+    files = csv_files_for_days(data_dir, days, device)
+    partials = _cached_partials(files)
+    return {
+        **merge_partials(list(partials.values())),
+        "files": len(files),
+        "devices": merge_by_device(data_dir, partials),
     }
-    return {"insects": insects_total, "averages": averages}
 
+
+def monthly_recap(data_dir: Path, year_month: str, device: str | None = None) -> dict:
+    return recap_days(data_dir, month_days(year_month), device)
+
+
+def range_recap(data_dir: Path, first: str, last: str, device: str | None = None) -> dict:
+    """Per-month recaps from *first* to *last* (YYYY-MM, inclusive) + overall."""
+    start = _dt.datetime.strptime(first, "%Y-%m").date()
+    stop = _dt.datetime.strptime(last, "%Y-%m").date()
+    months: list[str] = []
+    while start <= stop:
+        months.append(start.strftime("%Y-%m"))
+        start = (start.replace(day=28) + _dt.timedelta(days=4)).replace(day=1)
+
+    files = {ym: csv_files_for_days(data_dir, month_days(ym), device) for ym in months}
+    partials = _cached_partials([f for fs in files.values() for f in fs])
+    return {
+        **merge_partials(list(partials.values())),
+        "devices": merge_by_device(data_dir, partials),
+        "months": {
+            ym: merge_partials([partials[str(f)] for f in fs if str(f) in partials])
+            for ym, fs in files.items()
+        },
+    }
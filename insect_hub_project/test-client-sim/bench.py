@@ -0,0 +1,279 @@
+"""
+Repeatable micro-benchmarks for the hub's heavy paths, on generated data.
+
+    python bench.py --months 2 --devices 4 --out bench.json
+    python bench.py --months 2 --devices 4 --out new.json --compare bench.json
+
+Data is generated deterministically (--seed) under --workdir in the hub's
+layout, so two runs with the same parameters measure the same work.  The
+hub's endpoints are timed through a started app (pool, spool, catalog
+reconciled, rollups rebuilt); the baseline_* entries time the directory
+scans they replaced, for reference.  Each
+benchmark runs --repeat times; the JSON keeps every run plus min/median/mean.
+With --compare, medians are checked against an earlier file and the exit
+status is 1 when one got slower by more than --tolerance.
+"""
+import argparse, json, os, platform, random, shutil, statistics, subprocess, sys, tempfile, time, datetime as _dt
+from collections import defaultdict
+from pathlib import Path
+
+import pandas as pd
+from pandas.errors import EmptyDataError
+
+HUB_DIR = Path(__file__).resolve().parent.parent     # insect_hub_project/
+sys.path.insert(0, str(HUB_DIR))
+
+COLUMNS = ["timestamp", "Temperature", "Humidity", "Light", "insects"]
+
+
+def generate(data_dir: Path, months: int, devices: int, rows_per_day: int,
+             images_per_day: int, seed: int) -> dict:
+    """Fill data_dir with the last *months* months of CSV, JPEG and log files."""
+    from insect_hub.utils import DEFAULT_DEVICE, ensure_day_dirs
+
+    rnd = random.Random(seed)
+    today = _dt.date.today()
+    first = (today.replace(day=1) - _dt.timedelta(days=31 * (months - 1))).replace(day=1)
+    names = [DEFAULT_DEVICE] + [f"trap-{i:02d}" for i in range(1, devices)]
+    image = b"\xff\xd8" + rnd.randbytes(30_000) + b"\xff\xd9"
+    step = 86400 // rows_per_day
+    n_files = 0
+
+    day = first
+    while day <= today:
+        stamp = day.isoformat()
+        midnight = _dt.datetime.combine(day, _dt.time(), _dt.timezone.utc)
+        for dev in names:
+            part = ensure_day_dirs(data_dir, stamp, dev)
+            with open(part / "csv" / f"{stamp}.csv", "w") as f:
+                f.write(",".join(COLUMNS) + "\n")
+                for i in range(rows_per_day):
+                    ts = midnight + _dt.timedelta(seconds=i * step)
+                    f.write(f"{ts.isoformat()},{rnd.uniform(10, 30):.2f},{rnd.uniform(30, 90):.1f},"
+                            f"{rnd.randint(0, 1000)},{rnd.randint(0, 3)}\n")
+            for i in range(images_per_day):
+                (part / "img" / f"{stamp}T{i:04d}.jpg").write_bytes(image + i.to_bytes(4, "big"))
+            (part / "log" / f"{stamp}.log").write_text(
+                "".join(f"{stamp} 12:00:{i % 60:02d} [INFO] main: tick {i}\n" for i in range(200)))
+            n_files += 2 + images_per_day
+        day += _dt.timedelta(days=1)
+    return {"first_day": first.isoformat(), "last_day": today.isoformat(), "files": n_files}
+
+
+def measure(fn, repeat: int, setup=None) -> dict:
+    runs, extra = [], None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        extra = fn()
+        runs.append(time.perf_counter() - t0)
+    out = {"runs": runs, "min": min(runs), "median": statistics.median(runs),
+           "mean": statistics.fmean(runs)}
+    if isinstance(extra, int):                      # bytes produced
+        out["bytes"] = extra
+        out["mb_per_s"] = extra / out["median"] / 1e6
+    return out
+
+
+# Baselines only: the directory scans the hub answered /data and the 3-day
+# summary with before the file catalog and the rollup tables.  They do not
+# run hub code, so a regression of the hub never shows in them.
+
+def build_nested_tree(data_dir: Path) -> dict:
+    """
+    Return  {year: {month: [file-names]}}
+    """
+    tree: dict[str, dict[str, list[str]]] = {}
+    for year_dir in data_dir.glob("*"):
+        if not year_dir.is_dir():
+            continue
+        for month_dir in year_dir.glob("*"):
+            if not month_dir.is_dir():
+                continue
+            csv_files = sorted((month_dir / "csv").glob("*.csv"))
+            if csv_files:
+                tree.setdefault(year_dir.name, {})[month_dir.name] = [
+                    f.name for f in csv_files
+                ]
+    return dict(sorted(tree.items()))
+
+
+def stats_last_3_days(data_dir: Path) -> dict:
+    """Aggregate insect count & numeric averages over the last three calendar days.
+
+    Works with both folder layouts:
+        new  -> data/YYYY/MM/csv/…
+        old  -> data/YYYY-MM-DD/csv/…
+    """
+    today = _dt.date.today()
+    days  = [(today - _dt.timedelta(days=i)).isoformat() for i in range(3)]
+
+    numeric_cols: dict[str, list[float]] = defaultdict(list)
+    insects_total = 0
+
+    for d in days:
+        year, month, _ = d.split("-")
+
+        for csv_folder in (
+            data_dir / year / month / "csv",  # new layout
+            data_dir / d / "csv",             # legacy layout
+        ):
+            if not csv_folder.exists():
+                continue
+
+            for csv_file in csv_folder.glob("*.csv"):
+                # Skip zero-byte files outright
+                if csv_file.stat().st_size == 0:
+                    continue
+
+                try:
+                    df = pd.read_csv(
+                        csv_file,
+                        engine="python",       # tolerant of ragged rows
+                        on_bad_lines="skip",   # pandas ≥1.3
+                    )
+                except EmptyDataError:
+                    # File has no rows / only whitespace
+                    continue
+
+                # 1) insect count  (first column containing “insect”)
+                insect_cols = [c for c in df.columns if "insect" in c.lower()]
+                if insect_cols:
+                    insects_total += int(df[insect_cols[0]].sum())
+
+                # 2) numeric averages
+                for col in df.select_dtypes(include=["number"]).columns:
+                    numeric_cols[col].extend(df[col].dropna().tolist())
+
+    # Final averages
+    averages = {
+        col: statistics.mean(vals) for col, vals in numeric_cols.items() if vals
+    }
+    return {"insects": insects_total, "averages": averages}
+
+
+def run_benchmarks(workdir: Path, repeat: int) -> dict:
+    os.chdir(workdir)                               # the hub uses ./data
+    os.environ.setdefault("COMPACT_INTERVAL_H", "0")    # the generated months stay as generated
+    from fastapi.testclient import TestClient
+    from insect_hub import utils
+    from insect_hub.main import app
+    from insect_hub.manage import rebuild_rollups
+
+    data_dir = Path("data")
+    rebuild_rollups(data_dir)                       # what ingest would have recorded
+    auth = {"Authorization": f"Bearer {os.getenv('API_TOKEN', 'very-secret-and-difficult-token')}"}
+    today = _dt.date.today()
+    month = today.strftime("%Y-%m")
+
+    def clear_cache():
+        utils._PARTIALS.clear()
+
+    results = {}
+    with TestClient(app) as client:                 # lifespan: pool, spool, thumbnailer, …
+        client.post("/api/catalog/reconcile", headers=auth).raise_for_status()
+
+        def get(url: str, headers: dict = auth):
+            client.get(url, headers=headers).raise_for_status()
+
+        def download(url: str) -> int:
+            with client.stream("GET", url, headers=auth) as resp:
+                resp.raise_for_status()
+                return sum(len(c) for c in resp.iter_bytes())
+
+        benches = [
+            ("summary_3d", lambda: get("/api/summary/3d"), None),
+            ("data_page", lambda: get("/data", {}), None),
+            ("tree", lambda: get("/api/tree"), None),
+            ("monthly_recap_cold", lambda: utils.monthly_recap(data_dir, month), clear_cache),
+            ("monthly_recap_warm", lambda: utils.monthly_recap(data_dir, month), None),
+            ("zip_day", lambda: download(f"/download/{today.isoformat()}"), None),
+            ("zip_month", lambda: download(f"/download/{today:%Y/%m}"), None),
+            ("baseline_stats_3d", lambda: stats_last_3_days(data_dir), None),
+            ("baseline_tree_scan", lambda: build_nested_tree(data_dir), None),
+        ]
+        for name, fn, setup in benches:
+            fn()                                    # warm-up (imports, page cache)
+            results[name] = measure(fn, repeat, setup)
+            r = results[name]
+            rate = f"  {r['mb_per_s']:.1f} MB/s" if "mb_per_s" in r else ""
+            print(f"{name:<22} median {r['median'] * 1000:9.1f} ms  min {r['min'] * 1000:9.1f} ms{rate}")
+    return results
+
+
+def compare(old: dict, new: dict, tolerance: float) -> bool:
+    """Print median changes; True when something regressed beyond *tolerance*."""
+    regressed = False
+    print(f"\n{'benchmark':<22}{'before ms':>11}{'after ms':>11}{'change':>9}")
+    for name, r in new["results"].items():
+        if name not in old.get("results", {}):
+            continue
+        before, after = old["results"][name]["median"], r["median"]
+        change = (after - before) / before
+        flag = ""
+        if change > tolerance:
+            flag, regressed = "  REGRESSION", True
+        print(f"{name:<22}{before * 1000:>11.1f}{after * 1000:>11.1f}{change:>+9.1%}{flag}")
+    if old.get("params") != new.get("params"):
+        print("note: the two runs used different parameters")
+    return regressed
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HUB_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--months", type=int, default=2)
+    ap.add_argument("--devices", type=int, default=2)
+    ap.add_argument("--rows-per-day", type=int, default=1440)
+    ap.add_argument("--images-per-day", type=int, default=20)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--workdir", type=Path, help="keep generated data here (default: temporary)")
+    ap.add_argument("--out", type=Path, help="write results JSON here")
+    ap.add_argument("--compare", type=Path, help="earlier results JSON to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown, 0.10 = 10%%")
+    args = ap.parse_args(argv)
+
+    params = {k: getattr(args, k) for k in ("months", "devices", "rows_per_day", "images_per_day", "repeat", "seed")}
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix="insect-bench-"))
+    workdir = workdir.resolve()
+    out = args.out.resolve() if args.out else None          # run_benchmarks chdirs
+    previous = args.compare.resolve() if args.compare else None
+    try:
+        if not (workdir / "data").exists():
+            t0 = time.perf_counter()
+            info = generate(workdir / "data", args.months, args.devices,
+                            args.rows_per_day, args.images_per_day, args.seed)
+            print(f"generated {info['files']} files in {time.perf_counter() - t0:.1f} s")
+        result = {
+            "meta": {
+                "timestamp": _dt.datetime.now().isoformat(timespec="seconds"),
+                "git": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "params": params,
+            "results": run_benchmarks(workdir, args.repeat),
+        }
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if out:
+        out.write_text(json.dumps(result, indent=2))
+    if previous:
+        return int(compare(json.loads(previous.read_text()), result, args.tolerance))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
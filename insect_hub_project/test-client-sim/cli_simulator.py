@@ -1,16 +1,33 @@
-import argparse, csv, random, datetime as _dt, time, requests, io
+"""
+Device simulator and fleet load generator for the hub.
+
+    # one device, forever (the original simulator)
+    python cli_simulator.py --server http://localhost:8000 --token T
+
+    # 200 traps + dashboard and download readers for 5 minutes
+    python cli_simulator.py --server http://localhost:8000 --token T load \\
+        --devices 200 --readers 20 --downloaders 2 --duration 300 --json load.json
+
+`load` runs every simulated trap and reader as a coroutine on one asyncio
+loop (httpx).  Traps upload CSV/JPEG/log payloads of realistic size; some of
+them drop off the network now and then and come back with their backlog in
+one burst, like a Pi after an outage.  At the end p50/p95/p99 latency and
+throughput are reported per endpoint.
+"""
+import argparse, asyncio, csv, json, math, os, random, datetime as _dt, time, requests, io
 
 UTC = _dt.timezone.utc
 
-def make_csv() -> io.BytesIO:
+def make_csv(rows: int | None = None, start: _dt.datetime | None = None) -> io.BytesIO:
     buf = io.StringIO()
     w = csv.writer(buf)
     w.writerow(["timestamp", "sensor1", "insects"])
-    for _ in range(random.randint(5, 20)):
-        now = _dt.datetime.now(UTC).isoformat()
-        w.writerow([now, round(random.uniform(20, 30), 2), random.randint(0, 5)])
+    now = start or _dt.datetime.now(UTC)
+    for i in range(rows or random.randint(5, 20)):
+        ts = now + _dt.timedelta(seconds=i) if start else _dt.datetime.now(UTC)
+        w.writerow([ts.isoformat(), round(random.uniform(20, 30), 2), random.randint(0, 5)])
     bio = io.BytesIO(buf.getvalue().encode())
-    bio.name = f"{_dt.datetime.now(UTC).isoformat()}.csv"
+    bio.name = f"{now.isoformat()}.csv"
     return bio
 
 def blank_jpeg(name: str) -> io.BytesIO:
@@ -25,13 +42,175 @@ def blank_jpeg(name: str) -> io.BytesIO:
     bio.name = name
     return bio
 
-if __name__ == "__main__":
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--server", default="http://localhost:8000")
-    ap.add_argument("--token", default="secret-token")
-    ap.add_argument("--interval", type=int, default=30)
-    args = ap.parse_args()
+# Load generator ----------------------------------------------------------
+
+LEVELS = ["INFO"] * 40 + ["WARNING"] * 3 + ["ERROR"]
+
+def noise_jpegs(sizes_kb: tuple[int, ...] = (40, 80, 150)) -> list[bytes]:
+    """A few real JPEGs of camera-like sizes, encoded once up front."""
+    try:
+        from PIL import Image
+    except ImportError:             # fall back to a padded blank frame
+        raw = blank_jpeg("x.jpg").getvalue()
+        return [raw + os.urandom(kb * 1024) for kb in sizes_kb]
+    out = []
+    for kb in sizes_kb:
+        side = int((kb * 1024 / 0.9) ** 0.5)          # ~0.9 byte/pixel for noise at q=75
+        im = Image.effect_noise((side, side), 60).convert("RGB")
+        buf = io.BytesIO()
+        im.save(buf, "JPEG", quality=75)
+        out.append(buf.getvalue())
+    return out
+
+def unique_jpeg(bases: list[bytes]) -> bytes:
+    # bytes after EOI are ignored by decoders but make every photo distinct,
+    # so the hub's content dedupe does not swallow them
+    return random.choice(bases) + os.urandom(16)
+
+def sim_log(lines: int, device: str) -> bytes:
+    now = _dt.datetime.now()
+    return "".join(
+        f"{now:%Y-%m-%d %H:%M:%S},{random.randint(0, 999):03d} [{random.choice(LEVELS)}] "
+        f"{device}.sensor: reading {i} ok\n"
+        for i in range(lines)
+    ).encode()
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest rank
+    k = min(len(sorted_values), max(1, math.ceil(p / 100 * len(sorted_values))))
+    return sorted_values[k - 1]
+
+class Stats:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.bytes: dict[str, int] = {}
+
+    def add(self, label: str, seconds: float, nbytes: int, ok: bool):
+        self.latency.setdefault(label, []).append(seconds)
+        self.bytes[label] = self.bytes.get(label, 0) + nbytes
+        if not ok:
+            self.errors[label] = self.errors.get(label, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        out = {}
+        for label, values in sorted(self.latency.items()):
+            values.sort()
+            out[label] = {
+                "requests": len(values),
+                "errors": self.errors.get(label, 0),
+                "rps": len(values) / elapsed,
+                "mb_per_s": self.bytes[label] / elapsed / 1e6,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+        return out
+
+async def timed(stats: Stats, label: str, request, sent: int = 0) -> None:
+    t0 = time.perf_counter()
+    nbytes, ok = sent, False
+    try:
+        resp = await request
+        nbytes += len(resp.content)
+        ok = resp.status_code < 400
+    except Exception:
+        pass
+    stats.add(label, time.perf_counter() - t0, nbytes, ok)
 
+async def timed_stream(stats: Stats, client, label: str, url: str) -> None:
+    # downloads are streamed and discarded, like a browser saving the zip
+    t0 = time.perf_counter()
+    nbytes, ok = 0, False
+    try:
+        async with client.stream("GET", url) as resp:
+            async for chunk in resp.aiter_bytes():
+                nbytes += len(chunk)
+            ok = resp.status_code < 400
+    except Exception:
+        pass
+    stats.add(label, time.perf_counter() - t0, nbytes, ok)
+
+async def device(client, stats: Stats, name: str, args, jpegs: list[bytes], stop: float):
+    headers = {"X-Device-Id": name}
+    await asyncio.sleep(random.uniform(0, args.interval))      # stagger the fleet
+    backlog = 0
+    while time.monotonic() < stop:
+        if random.random() < args.outage_rate:
+            backlog += args.outage_cycles                      # offline, files pile up
+            await asyncio.sleep(min(args.outage_cycles * args.interval, max(0, stop - time.monotonic())))
+            continue
+        for _ in range(backlog + 1):                           # catch up oldest first
+            files = [("csv", ("chunk.csv", make_csv(args.rows, _dt.datetime.now(UTC)).getvalue(), "text/csv"))]
+            for i in range(random.randint(0, args.images)):
+                files.append(("images", (f"{name}-{time.time_ns()}-{i}.jpg", unique_jpeg(jpegs), "image/jpeg")))
+            if random.random() < 0.5:
+                files.append(("log", ("app.log", sim_log(args.log_lines, name), "text/plain")))
+            sent = sum(len(part[1][1]) for part in files)
+            await timed(stats, "POST /api/upload", client.post("/api/upload", files=files, headers=headers), sent)
+        backlog = 0
+        await asyncio.sleep(args.interval * random.uniform(0.9, 1.1))
+
+READER_ENDPOINTS = [
+    ("GET /api/summary/3d", "/api/summary/3d"),
+    ("GET /api/devices", "/api/devices"),
+    ("GET /api/gallery", "/api/gallery?limit=60"),
+    ("GET /api/tree", "/api/tree"),
+    ("GET /", "/"),
+]
+
+async def reader(client, stats: Stats, args, stop: float):
+    while time.monotonic() < stop:
+        label, url = random.choice(READER_ENDPOINTS)
+        await timed(stats, label, client.get(url))
+        await asyncio.sleep(random.expovariate(1 / args.think))
+
+async def downloader(client, stats: Stats, args, stop: float):
+    while time.monotonic() < stop:
+        today = _dt.date.today()
+        if random.random() < 0.5:
+            await timed_stream(stats, client, "GET /download/{day}", f"/download/{today.isoformat()}")
+        else:
+            await timed_stream(stats, client, "GET /download/{month}", f"/download/{today:%Y/%m}")
+        await asyncio.sleep(random.expovariate(1 / (args.think * 5)))
+
+async def run_load(args) -> dict:
+    import httpx
+
+    jpegs = noise_jpegs()
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.devices + args.readers + args.downloaders)
+    async with httpx.AsyncClient(
+        base_url=args.server,
+        headers={"Authorization": f"Bearer {args.token}"},
+        timeout=args.timeout,
+        limits=limits,
+    ) as client:
+        t0 = time.monotonic()
+        stop = t0 + args.duration
+        await asyncio.gather(
+            *(device(client, stats, f"sim-{i:04d}", args, jpegs, stop) for i in range(args.devices)),
+            *(reader(client, stats, args, stop) for _ in range(args.readers)),
+            *(downloader(client, stats, args, stop) for _ in range(args.downloaders)),
+        )
+        elapsed = time.monotonic() - t0
+    return {
+        "params": {k: v for k, v in vars(args).items() if k not in ("token", "func")},
+        "elapsed_s": elapsed,
+        "endpoints": stats.report(elapsed),
+    }
+
+def print_report(result: dict):
+    print(f"{'endpoint':<26}{'reqs':>7}{'err':>5}{'req/s':>8}{'MB/s':>8}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for label, r in result["endpoints"].items():
+        print(f"{label:<26}{r['requests']:>7}{r['errors']:>5}{r['rps']:>8.1f}{r['mb_per_s']:>8.2f}"
+              f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}")
+
+def single_device(args):
     while True:
         csv_file = make_csv()
         images = [
@@ -53,3 +232,34 @@ if __name__ == "__main__":
         )
         print("Upload status:", resp.status_code, resp.text)
         time.sleep(args.interval)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--server", default="http://localhost:8000")
+    ap.add_argument("--token", default="secret-token")
+    ap.add_argument("--interval", type=float, default=30, help="seconds between uploads")
+    sub = ap.add_subparsers(dest="cmd")
+
+    lp = sub.add_parser("load", help="simulate a fleet of traps plus readers")
+    lp.add_argument("--devices", type=int, default=50)
+    lp.add_argument("--readers", type=int, default=5, help="dashboard/API pollers")
+    lp.add_argument("--downloaders", type=int, default=1, help="concurrent zip downloads")
+    lp.add_argument("--duration", type=float, default=60, help="seconds")
+    lp.add_argument("--rows", type=int, default=300, help="CSV rows per upload")
+    lp.add_argument("--images", type=int, default=4, help="max images per upload")
+    lp.add_argument("--log-lines", type=int, default=100)
+    lp.add_argument("--outage-rate", type=float, default=0.02, help="chance per cycle to go offline")
+    lp.add_argument("--outage-cycles", type=int, default=5, help="cycles missed per outage")
+    lp.add_argument("--think", type=float, default=1.0, help="mean reader pause, seconds")
+    lp.add_argument("--timeout", type=float, default=60)
+    lp.add_argument("--json", help="write the results to this file")
+    args = ap.parse_args()
+
+    if args.cmd == "load":
+        result = asyncio.run(run_load(args))
+        print_report(result)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(result, f, indent=2)
+    else:
+        single_device(args)
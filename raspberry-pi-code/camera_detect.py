@@ -1,5 +1,5 @@
-import threading
-from picamera2 import Picamera2
+import threading, queue, os, json
+from collections import deque
 import cv2, logging, time
 
 from datetime import datetime, timezone
@@ -7,90 +7,286 @@ from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
-from config import IMG_DIR, FRAME_WIDTH, FRAME_HEIGHT, FPS, MOTION_MIN_AREA
+from config import (IMG_DIR, FRAME_WIDTH, FRAME_HEIGHT, MOTION_MIN_AREA, FRAME_SOURCE,
+                    DETECT_WIDTH, DETECT_HEIGHT, DETECT_ROI, DETECT_TIMING_INTERVAL,
+                    PRE_TRIGGER_FRAMES, POST_TRIGGER_FRAMES, SAVE_QUEUE_SIZE,
+                    CAPTURE_MODE, CROP_PADDING)
+from frame_sources import FrameSource, open_source
+
+class StageTimer:
+    """Mean time per pipeline stage, logged every `interval` seconds.
+    With keep=True every sample is also kept (for percentiles in replay_bench)."""
+    def __init__(self, interval: float, keep: bool = False):
+        self.interval = interval
+        self.samples = {} if keep else None
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.frames = 0
+        self.started = time.monotonic()
+
+    def add(self, stage: str, seconds: float):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+        if self.samples is not None:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def frame_done(self):
+        self.frames += 1
+        elapsed = time.monotonic() - self.started
+        if not self.interval or elapsed < self.interval:
+            return
+        stages = ", ".join(f"{k} {v / self.frames * 1000:.1f} ms" for k, v in self.totals.items())
+        logger.info("Detection %.1f fps - per frame: %s", self.frames / elapsed, stages)
+        self.reset()
+        return True
+
+def detection_region(roi=DETECT_ROI):
+    """ROI as (x, y, w, h) clamped to the frame, or the whole frame."""
+    if roi is None:
+        return 0, 0, FRAME_WIDTH, FRAME_HEIGHT
+    x, y, w, h = roi
+    x, y = max(0, min(x, FRAME_WIDTH - 1)), max(0, min(y, FRAME_HEIGHT - 1))
+    return x, y, min(w, FRAME_WIDTH - x), min(h, FRAME_HEIGHT - y)
+
+class ImageWriter(threading.Thread):
+    """
+    Encodes and writes frames off the capture thread.  The queue is bounded:
+    when the SD card falls behind, the newest frames are dropped (and
+    counted) so the capture loop never waits and the start of a burst is kept.
+    """
+    def __init__(self, maxsize: int = SAVE_QUEUE_SIZE, out_dir: Path = IMG_DIR, outbox=None):
+        super().__init__(daemon=True, name="image-writer")
+        self.out_dir = out_dir
+        self.outbox = outbox # saved images are queued there for the Uploader
+        self.queue = queue.Queue(maxsize)
+        self.saved = self.dropped = self.failed = 0
+
+    def submit(self, timestamp: datetime, frame, boxes=None, event=None) -> bool:
+        """Queue a frame; with *boxes* only their padded crops are saved."""
+        try:
+            self.queue.put_nowait((timestamp, frame, boxes, event))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        self.queue.put(None) # after what is already queued
+        self.join()
+
+    def write(self, timestamp: datetime, frame, boxes=None, event=None) -> bool:
+        stem = timestamp.isoformat().replace(':','-') # give the YYYY-MM-DD-HH-SS format
+        if boxes is None:
+            return self.save(self.out_dir / f"{stem}.jpg", frame)
+        height, width = frame.shape[:2]
+        for i, (x, y, w, h, area) in enumerate(boxes):
+            x0, y0 = max(0, x - CROP_PADDING), max(0, y - CROP_PADDING)
+            x1, y1 = min(width, x + w + CROP_PADDING), min(height, y + h + CROP_PADDING)
+            sidecar = {
+                "event": event,
+                "timestamp": timestamp.isoformat(),
+                "bbox": [x, y, w, h], # of the motion, in full-frame pixels
+                "crop": [x0, y0, x1 - x0, y1 - y0], # of the saved image
+                "area": area,
+                "frame_size": [width, height],
+            }
+            if not self.save(self.out_dir / f"{stem}-c{i}.jpg", frame[y0:y1, x0:x1], sidecar):
+                return False
+        return True
+
+    def save(self, path: Path, image, sidecar: dict | None = None) -> bool:
+        ok, buf = cv2.imencode(".jpg", image)
+        if not ok:
+            return False
+        # written aside and enqueued once in place, so the sender never sees a half written file
+        data = buf.tobytes()
+        tmp = path.with_suffix(".part")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        if sidecar is not None:
+            # after the image it describes, before the sender is told about either
+            tmp = path.with_suffix(".json.part")
+            tmp.write_text(json.dumps(sidecar))
+            os.replace(tmp, path.with_suffix(".json"))
+        if self.outbox is not None:
+            self.outbox.enqueue("image", path, len(data))
+        return True
+
+    def run(self):
+        while (item := self.queue.get()) is not None:
+            try:
+                if self.write(*item):
+                    self.saved += 1
+                else:
+                    self.failed += 1
+                    logger.error("JPEG encoding failed")
+            except OSError:
+                self.failed += 1
+                logger.exception("Image write failed")
 
 class MotionDetector(threading.Thread):
     RECONNECT_DELAY = 600
     WARMUP = 50 #let model settle and train the given background
     COOLDOWN = 1 #in seconds
     VAR_THRESHOLD = 44 #increase if false positive
-    def __init__(self, stop_event: threading.Event, camera_index : int = 0):
+    def __init__(self, stop_event: threading.Event, *,
+                 source: FrameSource | None = None,
+                 var_threshold: float | None = None,
+                 min_area: float = MOTION_MIN_AREA,
+                 detect_size: tuple = (DETECT_WIDTH, DETECT_HEIGHT),
+                 roi=DETECT_ROI,
+                 writer: "ImageWriter | None" = None,
+                 timer: StageTimer | None = None,
+                 outbox=None):
+        # the keyword arguments default to config.py; replay_bench overrides them
         super().__init__(daemon=True)
         self.stop_event = stop_event #if need to shutdown
-        self.camera = None
-        self.back_sub = cv2.createBackgroundSubtractorMOG2(history = 600, varThreshold=self.VAR_THRESHOLD, detectShadows=False)
+        self.source = source or open_source(FRAME_SOURCE)
+        self.opened = False
+        self.back_sub = cv2.createBackgroundSubtractorMOG2(history = 600, varThreshold=self.VAR_THRESHOLD if var_threshold is None else var_threshold, detectShadows=False)
         self.last_save = 0.0
 
+        # detection runs on the ROI shrunk by DETECT_WIDTH/FRAME_WIDTH, in grayscale
+        self.roi = detection_region(roi)
+        sx, sy = detect_size[0] / FRAME_WIDTH, detect_size[1] / FRAME_HEIGHT
+        _, _, w, h = self.roi
+        self.detect_size = (max(1, round(w * sx)), max(1, round(h * sy)))
+        self.scale = (sx, sy)
+        self.min_area = min_area * sx * sy # MOTION_MIN_AREA stays in full-frame pixels
+        self.timer = timer or StageTimer(DETECT_TIMING_INTERVAL)
+
+        self.writer = writer or ImageWriter(outbox=outbox)
+        self.ring = deque(maxlen=PRE_TRIGGER_FRAMES) # (timestamp, frame, boxes) before a detection
+        self.post_left = 0 # frames still to save after the last detection
+        self.crop = CAPTURE_MODE == "crop"
+        self.event = None # trigger time and boxes of the current burst
+        self.event_boxes = []
+
+    def prepare(self, frame):
+        """Crop to the ROI, downscale and convert to gray for the background model."""
+        x, y, w, h = self.roi
+        small = cv2.resize(frame[y:y + h, x:x + w], self.detect_size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def detect(self, frame) -> list:
+        """Boxes (x, y, w, h, area) of the moving blobs, in full-frame pixels."""
+        t0 = time.perf_counter()
+        small = self.prepare(frame)
+        t1 = time.perf_counter()
+        fg = self.back_sub.apply(small)
+        t2 = time.perf_counter()
+        _, thr = cv2.threshold(fg, 200,255,cv2.THRESH_BINARY)
+        contours, _ = cv2.findContours(thr,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
+        sx, sy = self.scale
+        rx, ry, _, _ = self.roi
+        boxes = []
+        for c in contours:
+            area = cv2.contourArea(c)
+            if area >= self.min_area:
+                x, y, w, h = cv2.boundingRect(c)
+                boxes.append((rx + int(x / sx), ry + int(y / sy),
+                              int(round(w / sx)), int(round(h / sy)), round(area / (sx * sy))))
+        t3 = time.perf_counter()
+        self.timer.add("prepare", t1 - t0)
+        self.timer.add("subtract", t2 - t1)
+        self.timer.add("contours", t3 - t2)
+        return boxes
+
     def openCamera(self):
         while not self.stop_event.is_set():
             try:
-                self.camera = Picamera2()
-                config = self.camera.create_preview_configuration(
-                    main={"format": "RGB888", "size": (FRAME_WIDTH, FRAME_HEIGHT)},
-                    controls={"FrameRate": FPS},
-                )
-                self.camera.configure(config)
-                self.camera.start()
-
-                for _ in range(self.WARMUP):
-                    self.back_sub.apply(self.camera.capture_array())
+                self.source.open()
+                self.warm_up()
+                self.opened = True
                 logger.info("Camera initialised")
                 
                 return
             except Exception as e:
                 logger.info("Camera start failed: %s - retrying in %d s",
                             e, self.RECONNECT_DELAY)
-                self.camera = None
+                self.source.close()
+                if self.source.exhausted:
+                    return
                 self.stop_event.wait(self.RECONNECT_DELAY)
+    def warm_up(self):
+        for _ in range(self.WARMUP):
+            frame = self.source.read()
+            if frame is None:
+                raise OSError("no frames during warm-up")
+            self.back_sub.apply(self.prepare(frame))
+
     def grabfromCamera(self):
-        try:
-            return self.camera.capture_array()
-        except Exception:
-            return None
-
-    def pictureCapture(self, frame):
-        timestamp = datetime.now(timezone.utc) #save it in utc stamp
-        name = f"{timestamp.isoformat()}.jpg".replace(':','-') # give the YYYY-MM-DD-HH-SS format
-        path = IMG_DIR / name 
-        if not cv2.imwrite(str(path), frame):
-            logger.debug(f"Image pris le {timestamp}: %s", path)
-            return False
-        
-        return True
+        return self.source.read()
+
+    def submit(self, timestamp, frame, boxes):
+        if not self.crop:
+            self.writer.submit(timestamp, frame)
+        else:
+            # frames without motion of their own are cut where the trigger was
+            self.writer.submit(timestamp, frame, boxes or self.event_boxes, self.event)
+
+    def pictureCapture(self, timestamp, frame, boxes: list):
+        """Queue the burst around a detection: ring, trigger frame, then POST_TRIGGER_FRAMES more."""
+        now = timestamp.timestamp() # capture time, so replays keep the same bursts
+        if boxes and not self.post_left and now - self.last_save >= self.COOLDOWN:
+            self.event, self.event_boxes = timestamp.isoformat(), boxes
+            for item in self.ring:
+                self.submit(*item)
+            self.ring.clear()
+            self.submit(timestamp, frame, boxes)
+            self.post_left = POST_TRIGGER_FRAMES
+            self.last_save = now
+            logger.debug("Motion at %s, burst queued", timestamp)
+        elif self.post_left:
+            self.submit(timestamp, frame, boxes)
+            self.post_left -= 1
+        elif PRE_TRIGGER_FRAMES:
+            self.ring.append((timestamp, frame, boxes))
+
+    def process(self, timestamp, frame) -> list:
+        """One frame through detection and the burst logic; returns its boxes."""
+        boxes = self.detect(frame)
+        t0 = time.perf_counter()
+        self.pictureCapture(timestamp, frame, boxes) # full resolution
+        self.timer.add("queue", time.perf_counter() - t0)
+        if self.timer.frame_done():
+            logger.info("Image writer: %d saved, %d dropped, %d failed, %d queued",
+                        self.writer.saved, self.writer.dropped, self.writer.failed,
+                        self.writer.queue.qsize())
+        return boxes
 
     def run(self):
+        self.writer.start()
         while not self.stop_event.is_set():
             #prevent various takes
             try:
-                if self.camera is None:
+                if not self.opened:
                     self.openCamera() # try to reopen 
+                    if not self.opened:
+                        break # stopping, or a recording too short to warm up on
 
+                t0 = time.perf_counter()
                 frame = self.grabfromCamera()
+                timestamp = datetime.now(timezone.utc) #save it in utc stamp
+                self.timer.add("grab", time.perf_counter() - t0)
                 if frame is None:
+                    if self.source.exhausted:
+                        logger.info("Frame source finished")
+                        break
                     logger.error("Camera read failed - retrying in %d s",
                                  self.RECONNECT_DELAY)
-                    if self.camera: #if it exists
-                        self.camera.close()
-                    self.camera = None
+                    self.source.close()
+                    self.opened = False
+                    self.ring.clear() # stale once the camera is back
                     self.stop_event.wait(self.RECONNECT_DELAY)
                     continue
 
-                fg = self.back_sub.apply(frame)
-                _, thr = cv2.threshold(fg, 200,255,cv2.THRESH_BINARY)
-                contours, _ = cv2.findContours(thr,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
-                
-                if any(cv2.contourArea(c) >= MOTION_MIN_AREA for c in contours):
-                    now = time.time()
-                    if now - self.last_save >= self.COOLDOWN:
-                        if self.pictureCapture(frame):
-                            logger.debug("Image saved")
-                        else:
-                            logger.error("imwrite failed")
-                        self.last_save = now
+                self.process(timestamp, frame)
 
             except Exception:
                 logger.exception("Camera error")
         
-        if self.camera:
-            self.camera.close()
+        self.source.close()
+        self.writer.close()
 
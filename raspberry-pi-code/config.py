@@ -4,29 +4,52 @@ W_DIR = Path.cwd()
 
 #Server configs
 AUTH_TOKEN = "very-secret-and-difficult-token"
+DEVICE_ID = "default" # this trap's name on the hub (letters, digits, - and _), one per device
 SERVER_URL = 'http://insectes.citi.insa-lyon.fr/allinon/api/upload'
-TCP_RETRY_DELAY = 15
-UPLOAD_INTERVAL = 300
+TCP_RETRY_DELAY = 15 # first retry after a failed cycle, doubled (with jitter) on each failure...
+UPLOAD_BACKOFF_MAX = 900 # ...up to this
+UPLOAD_INTERVAL = 300 # between cycles once the outbox is empty; a backlog is sent back-to-back
+UPLOAD_PARALLEL = 2 # batches in flight while draining a backlog
+UPLOAD_MAX_BPS = 0 # cap on the upload rate in bytes/s, shared by the transfers in flight, 0 = none
 INITIAL_UPLOAD_WAIT_PERIOD = 300  # x min wait on boot
+RESUMABLE_UPLOADS = True # chunked uploads that continue after a dropped link
+UPLOAD_CHUNK_SIZE = 256 * 1024 # bytes per acknowledged chunk
+UPLOAD_COMPRESSION = True # gzip/zstd the CSV and log parts once the hub says it accepts them
 
 
 #Arduino configs
 SERIAL_PORT = '/dev/ttyACM0' #to find?
 BAUD_RATE = 9600
+CSV_FLUSH_ROWS = 30 # buffered rows written and fsynced together...
+CSV_FLUSH_INTERVAL = 60 # ...or after this many seconds, the most a crash can lose
 
 #Storage Paths
 DATA_DIR = Path(f'{W_DIR}/data')
 IMG_DIR = DATA_DIR/"images"
 LOG_FILE = Path(f'{W_DIR}/logs/app.log') 
+LOG_OUTBOX_DIR = DATA_DIR/"logs" # log segments cut from LOG_FILE, waiting for upload
+OUTBOX_DB = DATA_DIR/"outbox.db" # what is waiting to be uploaded (see outbox.py)
+UPLOAD_BATCH_BYTES = 4 * 1024 * 1024 # per request: one CSV, images up to this, one log segment
+UPLOAD_BATCH_FILES = 200
 
 #Camera settings
+FRAME_SOURCE = "picamera" # or "video:<file>", "images:<dir>", "synthetic" (see frame_sources.py)
 FRAME_WIDTH = 640
 FRAME_HEIGHT = 480
 FPS = 15
 MOTION_MIN_AREA = 50 # in pxiels
+DETECT_WIDTH = 320 # motion detection runs on a downscaled grayscale copy,
+DETECT_HEIGHT = 240 # saved images stay FRAME_WIDTH x FRAME_HEIGHT
+DETECT_ROI = None # (x, y, w, h) in full-frame pixels to watch, None = whole frame
+DETECT_TIMING_INTERVAL = 600 # s between per-stage timing lines in the log, 0 = off
+PRE_TRIGGER_FRAMES = 5 # frames before a detection saved with it
+POST_TRIGGER_FRAMES = 5 # frames after it
+SAVE_QUEUE_SIZE = 16 # frames waiting for the JPEG writer; newer ones are dropped when full
+CAPTURE_MODE = "frame" # "frame" saves whole frames, "crop" only the boxes around the motion
+CROP_PADDING = 16 # pixels added around each box in crop mode
 
 
 #Create directories if not exist
 
-for p in (DATA_DIR, IMG_DIR, LOG_FILE.parent):
+for p in (DATA_DIR, IMG_DIR, LOG_FILE.parent, LOG_OUTBOX_DIR):
     p.mkdir(parents=True, exist_ok=True)
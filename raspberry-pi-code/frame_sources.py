@@ -0,0 +1,167 @@
+"""
+Where MotionDetector gets its frames from.
+
+    picamera            the Pi camera (the default, FRAME_SOURCE in config.py)
+    video:<file>        a recording, e.g. video:clips/bees.mp4
+    images:<dir>        every .jpg/.png in a folder, in name order
+    synthetic[:<n>]     generated frames with an "insect" crossing now and then
+
+Every source hands out BGR frames of FRAME_WIDTH x FRAME_HEIGHT (recordings
+of another size are resized), so the detector does not care which one it
+reads.  read() returns None when no frame could be had; `exhausted` tells a
+finished recording apart from a camera that dropped out.
+"""
+import logging
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from config import FRAME_WIDTH, FRAME_HEIGHT, FPS
+
+logger = logging.getLogger(__name__)
+
+class FrameSource(ABC):
+    exhausted = False
+
+    def __init__(self, width: int = FRAME_WIDTH, height: int = FRAME_HEIGHT):
+        self.size = (width, height)
+
+    def open(self):
+        pass
+
+    @abstractmethod
+    def read(self):
+        """The next frame, or None."""
+
+    def close(self):
+        pass
+
+    def fit(self, frame):
+        if frame is None or (frame.shape[1], frame.shape[0]) == self.size:
+            return frame
+        return cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+
+class PicameraSource(FrameSource):
+    def __init__(self, width: int = FRAME_WIDTH, height: int = FRAME_HEIGHT, fps: int = FPS):
+        super().__init__(width, height)
+        self.fps = fps
+        self.camera = None
+
+    def open(self):
+        from picamera2 import Picamera2 # only on the Pi
+        self.camera = Picamera2()
+        config = self.camera.create_preview_configuration(
+            main={"format": "RGB888", "size": self.size},
+            controls={"FrameRate": self.fps},
+        )
+        self.camera.configure(config)
+        self.camera.start()
+
+    def read(self):
+        try:
+            return self.camera.capture_array()
+        except Exception:
+            return None
+
+    def close(self):
+        if self.camera:
+            self.camera.close()
+        self.camera = None
+
+class VideoFileSource(FrameSource):
+    def __init__(self, path, width: int = FRAME_WIDTH, height: int = FRAME_HEIGHT):
+        super().__init__(width, height)
+        self.path = Path(path)
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(str(self.path))
+        if not self.capture.isOpened():
+            raise OSError(f"cannot open video {self.path}")
+        self.exhausted = False
+
+    def read(self):
+        ok, frame = self.capture.read()
+        if not ok:
+            self.exhausted = True
+            return None
+        return self.fit(frame)
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+        self.capture = None
+
+class ImageDirSource(FrameSource):
+    SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+    def __init__(self, path, width: int = FRAME_WIDTH, height: int = FRAME_HEIGHT):
+        super().__init__(width, height)
+        self.path = Path(path)
+        self.files = []
+
+    def open(self):
+        self.files = sorted(p for p in self.path.iterdir() if p.suffix.lower() in self.SUFFIXES)
+        if not self.files:
+            raise OSError(f"no images in {self.path}")
+        self.exhausted = False
+
+    def read(self):
+        while self.files:
+            frame = cv2.imread(str(self.files.pop(0)))
+            if frame is not None:
+                return self.fit(frame)
+        self.exhausted = True
+        return None
+
+class SyntheticSource(FrameSource):
+    """
+    A still, slightly noisy scene; every `period` frames a dark blob the size
+    of a small insect crosses it for `visit` frames.  `last_truth` says
+    whether the frame just read had one, to score the detector against.
+    """
+    def __init__(self, frames: int = 3000, width: int = FRAME_WIDTH, height: int = FRAME_HEIGHT,
+                 period: int = 150, visit: int = 30, noise: int = 4, seed: int = 1):
+        super().__init__(width, height)
+        self.frames, self.period, self.visit, self.noise = frames, period, visit, noise
+        self.rng = np.random.default_rng(seed)
+        ramp = np.linspace(90, 170, width, dtype=np.float32)
+        self.background = np.repeat(np.tile(ramp, (height, 1))[:, :, None], 3, axis=2).astype(np.int16)
+        self.index = 0
+        self.last_truth = False
+
+    def open(self):
+        self.index = 0
+        self.exhausted = False
+
+    def read(self):
+        if self.index >= self.frames:
+            self.exhausted = True
+            return None
+        i, self.index = self.index, self.index + 1
+        noise = self.rng.integers(-self.noise, self.noise + 1, self.background.shape[:2], dtype=np.int16)
+        frame = np.clip(self.background + noise[:, :, None], 0, 255).astype(np.uint8)
+        step = i % self.period
+        self.last_truth = i >= self.period and step < self.visit
+        if self.last_truth:
+            width, height = self.size
+            visit = i // self.period
+            x = int(width * 0.1 + step / self.visit * width * 0.8)
+            y = int(height * (0.2 + 0.6 * ((visit * 37) % 10) / 10))
+            cv2.ellipse(frame, (x, y), (9, 5), 0, 0, 360, (30, 30, 30), -1)
+        return frame
+
+def open_source(spec: str) -> FrameSource:
+    """Build a source from a FRAME_SOURCE string (see the module docstring)."""
+    kind, _, arg = spec.partition(":")
+    if kind == "picamera":
+        return PicameraSource()
+    if kind == "video" and arg:
+        return VideoFileSource(arg)
+    if kind == "images" and arg:
+        return ImageDirSource(arg)
+    if kind == "synthetic":
+        return SyntheticSource(int(arg)) if arg else SyntheticSource()
+    raise ValueError(f"unknown frame source {spec!r}")
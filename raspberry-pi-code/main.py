@@ -4,9 +4,10 @@ from datetime import datetime, timezone
 from pathlib import Path
 
 from config import LOG_FILE
-from serialRead import SerialReader
+from serialRead import SerialReader, RotatingCsvWriter
 from camera_detect import MotionDetector
 from sender import Uploader
+from outbox import Outbox
 from serialFilter import DedupFilter
 logging.basicConfig(
     level=logging.INFO,
@@ -25,10 +26,12 @@ def graceful_shutdown(signum, frame):
 signal.signal(signal.SIGINT, graceful_shutdown)
 signal.signal(signal.SIGTERM, graceful_shutdown)
 
+outbox = Outbox() # producers enqueue finished files, the Uploader drains it
+csv_writer = RotatingCsvWriter(outbox=outbox) # shared: the Uploader seals the file it is about to send
 threads = [
-    SerialReader(stop_event),
-    MotionDetector(stop_event),
-    Uploader(stop_event)
+    SerialReader(stop_event, csv_writer),
+    MotionDetector(stop_event, outbox=outbox),
+    Uploader(stop_event, csv_writer, outbox)
 ]
 
 for t in threads:
@@ -0,0 +1,123 @@
+"""
+Durable queue of the files waiting to go to the hub.
+
+Producers enqueue what they finish (a sealed CSV segment, a saved image,
+a cut log segment) and the Uploader takes the oldest pending rows up to a
+byte budget, so a cycle costs O(batch) however big the backlog is: no
+directory rescans, no stat per file.  A row is deleted once the hub has
+the file (and the file is deleted); rows claimed by a cycle that never
+finished are pending again after a restart.
+
+    outbox(id, kind, path, size, created, state, attempts)
+        kind   csv | image | log
+        state  pending | sending
+"""
+import logging, sqlite3, threading, time
+from contextlib import contextmanager
+from pathlib import Path
+
+from config import OUTBOX_DB
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_state_kind ON outbox(state, kind, id);
+"""
+
+class Outbox:
+    def __init__(self, path: Path = OUTBOX_DB):
+        # one connection shared by the producer threads, behind a lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        with self.tx() as conn:
+            conn.execute("UPDATE outbox SET state = 'pending' WHERE state = 'sending'")
+
+    @contextmanager
+    def tx(self):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def enqueue(self, kind: str, path: Path, size: int | None = None):
+        if size is None:
+            size = path.stat().st_size
+        with self.tx() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO outbox(kind, path, size, created) VALUES(?, ?, ?, ?)",
+                (kind, str(path), size, time.time()))
+
+    def adopt(self, kind: str, paths):
+        """Enqueue files that were on disk before the outbox (one scan, at start-up)."""
+        rows = []
+        for p in paths:
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            rows.append((kind, str(p), st.st_size, st.st_mtime))
+        with self.tx() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO outbox(kind, path, size, created) VALUES(?, ?, ?, ?)", rows)
+            added = conn.total_changes - before
+        if added:
+            logger.info("Outbox adopted %d %s files already on disk", added, kind)
+
+    def claim(self, kind: str, budget: int, limit: int) -> list[sqlite3.Row]:
+        """
+        Oldest pending rows of *kind* whose sizes fit in *budget* bytes (the
+        first one always does, however big), marked as being sent.
+        """
+        with self.tx() as conn:
+            rows = conn.execute(
+                "SELECT * FROM outbox WHERE state = 'pending' AND kind = ? ORDER BY id LIMIT ?",
+                (kind, limit)).fetchall()
+            batch, total = [], 0
+            for row in rows:
+                if batch and total + row["size"] > budget:
+                    break
+                batch.append(row)
+                total += row["size"]
+            conn.executemany("UPDATE outbox SET state = 'sending' WHERE id = ?",
+                             [(r["id"],) for r in batch])
+        return batch
+
+    def done(self, ids: list[int]):
+        with self.tx() as conn:
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+
+    def release(self, ids: list[int]):
+        """Put rows back after a failed send."""
+        with self.tx() as conn:
+            conn.executemany(
+                "UPDATE outbox SET state = 'pending', attempts = attempts + 1 WHERE id = ?",
+                [(i,) for i in ids])
+
+    def pending(self, kind: str | None = None) -> int:
+        with self.lock:
+            if kind is None:
+                return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE state = 'pending'").fetchone()[0]
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE state = 'pending' AND kind = ?", (kind,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
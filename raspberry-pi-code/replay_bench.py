@@ -0,0 +1,167 @@
+"""
+Replay footage through the motion detector as fast as it will go.
+
+    python replay_bench.py video:clips/bees.mp4
+    python replay_bench.py images:/mnt/usb/frames --var-threshold 60 --min-area 80
+    python replay_bench.py synthetic:3000 --detect-size 160x120 --json out.json
+
+Runs the same prepare/subtract/contours/burst code as the trap, on any
+Linux box (no camera needed), and reports frames per second, per-stage
+latency and what was detected.  Frames are time-stamped at --fps, so
+COOLDOWN and the bursts behave as they would live.  Nothing is written
+unless --save is given.  With the synthetic source, whose frames come with
+the truth, detections are also scored per frame.
+"""
+import argparse, json, math, sys, threading, time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from config import FPS, MOTION_MIN_AREA, DETECT_WIDTH, DETECT_HEIGHT, DETECT_ROI
+from camera_detect import MotionDetector, ImageWriter, StageTimer
+from frame_sources import open_source
+
+class CountingWriter(ImageWriter):
+    """Counts the images a burst would save, without touching the disk."""
+    def submit(self, timestamp, frame, boxes=None, event=None) -> bool:
+        self.saved += 1 if boxes is None else len(boxes)
+        return True
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest rank
+    k = min(len(sorted_values), max(1, math.ceil(p / 100 * len(sorted_values))))
+    return sorted_values[k - 1]
+
+def replay(args) -> dict:
+    source = open_source(args.source)
+    writer = ImageWriter(maxsize=0, out_dir=args.save) if args.save else CountingWriter()
+    timer = StageTimer(0, keep=True)
+    detector = MotionDetector(
+        threading.Event(),
+        source=source,
+        var_threshold=args.var_threshold,
+        min_area=args.min_area,
+        detect_size=args.detect_size,
+        roi=args.roi,
+        writer=writer,
+        timer=timer,
+    )
+
+    source.open()
+    detector.warm_up()
+    writer.start()
+    start = datetime.now(timezone.utc)
+    frames = detections = 0
+    events = set()
+    score = {"hits": 0, "misses": 0, "false_alarms": 0}
+    t_start = time.perf_counter()
+    while args.limit is None or frames < args.limit:
+        t0 = time.perf_counter()
+        frame = source.read()
+        timer.add("grab", time.perf_counter() - t0)
+        if frame is None:
+            break
+        boxes = detector.process(start + timedelta(seconds=frames / args.fps), frame)
+        frames += 1
+        detections += bool(boxes)
+        if detector.event:
+            events.add(detector.event)
+        if hasattr(source, "last_truth"):
+            if boxes and source.last_truth:
+                score["hits"] += 1
+            elif source.last_truth:
+                score["misses"] += 1
+            elif boxes:
+                score["false_alarms"] += 1
+    elapsed = time.perf_counter() - t_start
+    writer.close()
+    source.close()
+
+    stages = {}
+    for stage, values in timer.samples.items():
+        values.sort()
+        stages[stage] = {
+            "mean_ms": sum(values) / frames * 1000 if frames else 0.0,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "max_ms": values[-1] * 1000,
+        }
+    result = {
+        "params": {
+            "source": args.source,
+            "var_threshold": MotionDetector.VAR_THRESHOLD if args.var_threshold is None else args.var_threshold,
+            "min_area": args.min_area,
+            "detect_size": list(args.detect_size),
+            "roi": list(args.roi) if args.roi else None,
+            "fps": args.fps,
+        },
+        "frames": frames,
+        "elapsed_s": elapsed,
+        "fps": frames / elapsed if elapsed else 0.0,
+        "realtime_factor": frames / elapsed / args.fps if elapsed else 0.0,
+        "stages": stages,
+        "motion_frames": detections,
+        "events": len(events),
+        "images": writer.saved,
+        "dropped": writer.dropped,
+    }
+    if hasattr(source, "last_truth"):
+        truth = score["hits"] + score["misses"]
+        flagged = score["hits"] + score["false_alarms"]
+        score["recall"] = score["hits"] / truth if truth else None
+        score["precision"] = score["hits"] / flagged if flagged else None
+        result["score"] = score
+    return result
+
+def print_report(r: dict):
+    print(f"{r['frames']} frames in {r['elapsed_s']:.2f} s: {r['fps']:.1f} fps "
+          f"({r['realtime_factor']:.1f}x real time at {r['params']['fps']} fps)")
+    print(f"{'stage':<10}{'mean ms':>9}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}")
+    for stage, s in r["stages"].items():
+        print(f"{stage:<10}{s['mean_ms']:>9.2f}{s['p50_ms']:>9.2f}{s['p95_ms']:>9.2f}{s['max_ms']:>9.2f}")
+    print(f"motion in {r['motion_frames']} frames, {r['events']} events, {r['images']} images "
+          f"({r['dropped']} dropped)")
+    if "score" in r:
+        s = r["score"]
+        fmt = lambda v: "n/a" if v is None else f"{v:.1%}"
+        print(f"vs truth: {s['hits']} hits, {s['misses']} misses, {s['false_alarms']} false alarms, "
+              f"recall {fmt(s['recall'])}, precision {fmt(s['precision'])}")
+
+def size(text: str) -> tuple:
+    w, _, h = text.partition("x")
+    return int(w), int(h)
+
+def rect(text: str) -> tuple:
+    x, y, w, h = (int(v) for v in text.split(","))
+    return x, y, w, h
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("source", help="video:<file>, images:<dir> or synthetic[:<frames>]")
+    ap.add_argument("--var-threshold", type=float, help=f"MOG2 varThreshold (default {MotionDetector.VAR_THRESHOLD})")
+    ap.add_argument("--min-area", type=float, default=MOTION_MIN_AREA, help="full-frame pixels")
+    ap.add_argument("--detect-size", type=size, default=(DETECT_WIDTH, DETECT_HEIGHT), help="WxH")
+    ap.add_argument("--roi", type=rect, default=DETECT_ROI, help="x,y,w,h in full-frame pixels")
+    ap.add_argument("--fps", type=float, default=FPS, help="frame rate the footage was taken at")
+    ap.add_argument("--limit", type=int, help="stop after this many frames")
+    ap.add_argument("--save", type=Path, help="write the burst images to this folder")
+    ap.add_argument("--json", type=Path, help="write the results here")
+    args = ap.parse_args(argv)
+    if args.save:
+        args.save.mkdir(parents=True, exist_ok=True)
+
+    result = replay(args)
+    print_report(result)
+    if args.json:
+        args.json.write_text(json.dumps(result, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,127 +1,449 @@
-import threading, logging, time
+import threading, logging, time, hashlib, json, shutil, gzip, io, random
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 from pathlib import Path
 from typing import List, Optional
 
 import requests 
 
-from config import AUTH_TOKEN, DATA_DIR, IMG_DIR, SERVER_URL, TCP_RETRY_DELAY, UPLOAD_INTERVAL, INITIAL_UPLOAD_WAIT_PERIOD, LOG_FILE
+try:
+    import zstandard
+except ImportError: # gzip only
+    zstandard = None
+
+from config import AUTH_TOKEN, DEVICE_ID, DATA_DIR, IMG_DIR, SERVER_URL, TCP_RETRY_DELAY, UPLOAD_INTERVAL, INITIAL_UPLOAD_WAIT_PERIOD, LOG_FILE, LOG_OUTBOX_DIR, RESUMABLE_UPLOADS, UPLOAD_CHUNK_SIZE, UPLOAD_BATCH_BYTES, UPLOAD_BATCH_FILES, UPLOAD_COMPRESSION, UPLOAD_BACKOFF_MAX, UPLOAD_PARALLEL, UPLOAD_MAX_BPS
+from outbox import Outbox
 
 logger = logging.getLogger(__name__)
 
-def timestamp_from_name(path : Path) -> datetime:
-    #extract ISO timestamp from filename
+API_URL = SERVER_URL.rsplit("/", 1)[0] # .../api
+
+# text parts compress 5-10x; JPEGs are sent as they are.  Both coders are
+# deterministic, so a resumed transfer re-encodes to the very same bytes.
+ENCODERS = {"gzip": lambda data: gzip.compress(data, compresslevel=6, mtime=0)}
+if zstandard is not None:
+    ENCODERS["zstd"] = lambda data: zstandard.ZstdCompressor(level=10).compress(data)
+TEXT_KINDS = ("csv", "log")
+
+def accepted_encoding(resp) -> Optional[str]:
+    """The first coding of the hub's Accept-Encoding we can produce, if any."""
+    if not UPLOAD_COMPRESSION:
+        return None
+    offered = [c.split(";")[0].strip().lower() for c in resp.headers.get("Accept-Encoding", "").split(",")]
+    return next((c for c in offered if c in ENCODERS), None)
+
+class ResumableUnsupported(Exception):
+    """The hub has no /api/uploads endpoints (older server)."""
+
+def session_file(path: Path) -> Path:
+    #sidecar remembering the hub session of an interrupted transfer
+    return path.with_name(path.name + ".session")
+
+def sidecar_file(img: Path) -> Path:
+    #crop metadata written next to the image in CAPTURE_MODE = "crop"
+    return img.with_suffix(".json")
+
+def crop_meta(img: Path) -> Optional[dict]:
     try:
-        return datetime.fromisoformat(path.stem)
-    except ValueError:
-        return datetime.fromtimestamp(path.stat().st_mtime)
-    
+        return json.loads(sidecar_file(img).read_text())
+    except (OSError, ValueError):
+        return None
+
+def purge(path: Path, kind: str):
+    path.unlink(missing_ok=True)
+    session_file(path).unlink(missing_ok=True)
+    if kind == "image":
+        sidecar_file(path).unlink(missing_ok=True)
+
+class Throttle:
+    """
+    Token bucket shared by every transfer in flight: UPLOAD_MAX_BPS on
+    average, in bursts of at most one second's worth.
+    """
+    PIECE = 16 * 1024
+
+    def __init__(self, rate: float = UPLOAD_MAX_BPS):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = rate
+        self.stamp = time.monotonic()
+
+    def take(self, n: int):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n # may go negative: later callers wait for this debt too
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def paced(self, body: bytes):
+        for i in range(0, len(body), self.PIECE):
+            piece = body[i:i + self.PIECE]
+            self.take(len(piece))
+            yield piece
+
+def backoff(failures: int) -> float:
+    """Exponential, capped, with jitter so a fleet back from an outage does not retry in step."""
+    delay = min(UPLOAD_BACKOFF_MAX, TCP_RETRY_DELAY * 2 ** (failures - 1))
+    return random.uniform(delay / 2, delay)
 
 class Uploader(threading.Thread):
-    LOG_MIN_SIZE = 0
-    
-    def __init__(self, stop_event: threading.Event):
+    def __init__(self, stop_event: threading.Event, csv_writer=None, outbox: Optional[Outbox] = None):
         super().__init__(daemon = True)
         self.stop_event = stop_event
-    
-    @staticmethod
-    def csv_finder() -> List[Path]: # annotations wise
-        return(sorted(DATA_DIR.glob("*.csv")))
-    
-    @staticmethod
-    def image_finder_b4range(cutoff : datetime) -> List[Path]:
-        return([img for img in IMG_DIR.glob("*.jpg") if timestamp_from_name(img) <= cutoff])
-    
+        self.csv_writer = csv_writer # SerialReader's RotatingCsvWriter, sealed on demand
+        self.outbox = outbox or Outbox()
+        self.resumable = RESUMABLE_UPLOADS
+        self.encoding = None # learnt from the hub's responses, only set by negotiate()
+        self.encoding_lock = threading.Lock()
+        self.headers = {"Authorization": f"Bearer {AUTH_TOKEN}", "X-Device-Id": DEVICE_ID}
+        # one keep-alive connection per transfer in flight, instead of a handshake per request
+        self.http = requests.Session()
+        self.http.headers.update(self.headers)
+        self.http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=UPLOAD_PARALLEL))
+        self.http.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=UPLOAD_PARALLEL))
+        self.throttle = Throttle()
+        self.failures = 0
+
+    def adopt_leftovers(self):
+        # the only directory scan: files from before the outbox, or whose
+        # producer died between writing them and enqueueing them
+        self.outbox.adopt("csv", sorted(DATA_DIR.glob("*.csv")))
+        self.outbox.adopt("image", sorted(IMG_DIR.glob("*.jpg")))
+        self.outbox.adopt("log", sorted(LOG_OUTBOX_DIR.glob("*.log")))
+
+    def cut_log(self):
+        """Move what was logged since the last cycle into a segment in the outbox."""
+        handlers = [h for h in logging.getLogger().handlers
+                    if isinstance(h, logging.FileHandler) and Path(h.baseFilename) == LOG_FILE]
+        segment = LOG_OUTBOX_DIR / f"{datetime.now():%Y-%m-%dT%H-%M-%S}.log"
+        # hold the handlers' locks so no line lands between the copy and the truncate
+        for h in handlers:
+            h.acquire()
+        try:
+            for h in handlers:
+                h.flush()
+            if not LOG_FILE.exists() or LOG_FILE.stat().st_size == 0:
+                return
+            shutil.copyfile(LOG_FILE, segment)
+            with LOG_FILE.open("w"):
+                pass
+        finally:
+            for h in handlers:
+                h.release()
+        self.outbox.enqueue("log", segment)
+
+    def send_body(self, method: str, url: str, timeout: float, **kw) -> requests.Response:
+        """A request whose body goes through the bandwidth cap."""
+        req = self.http.prepare_request(requests.Request(method, url, **kw))
+        if self.throttle.rate and req.body:
+            body = req.body if isinstance(req.body, bytes) else req.body.encode()
+            req.body = self.throttle.paced(body) # Content-Length is already set
+        return self.http.send(req, timeout=timeout)
+
+    def negotiate(self, resp) -> Optional[str]:
+        """
+        The coding the hub's response offers, which later requests use. Each
+        transfer works on its own copy, so one batch changing it never
+        changes what another one sent.
+        """
+        encoding = accepted_encoding(resp)
+        with self.encoding_lock:
+            self.encoding = encoding
+        return encoding
+
     @staticmethod
-    def image_finder() -> List[Path]:
-        return(sorted(IMG_DIR.glob("*.jpg")))
+    def text_part(path: Path, ctype: str, encoding: Optional[str]) -> tuple:
+        if encoding is None:
+            return (path.name, path.open("rb"), ctype)
+        return (path.name, ENCODERS[encoding](path.read_bytes()), ctype,
+                {"Content-Encoding": encoding})
 
-    def sender(self, csv_path: Optional[Path], images : List[Path]) -> bool:
+    def sender(self, csv_path: Optional[Path], images : List[Path], log_path: Optional[Path] = None,
+               encoding: Optional[str] = None) -> bool:
         files = []
         #files = [("csv", (csv_path.name, csv_path.open('rb'), "text/csv"))]
         if csv_path is not None:
-            files.append(("csv", (csv_path.name, csv_path.open('rb'), "text/csv")))
+            files.append(("csv", self.text_part(csv_path, "text/csv", encoding)))
+        crops = {}
         for img in images:
             files.append(("images", (img.name, img.open("rb"), "image/jpeg")))
+            meta = crop_meta(img)
+            if meta is not None:
+                crops[img.name] = meta
 
-        headers = {"Authorization": f"Bearer {AUTH_TOKEN}"}
-        
-        try: 
-            for h in logging.getLogger().handlers:
-                try:
-                    h.flush()
-                except Exception:
-                    pass
-            if LOG_FILE.exists() and LOG_FILE.stat().st_size >= self.LOG_MIN_SIZE:
-                files.append(("log", (LOG_FILE.name, LOG_FILE.open("rb"), "text/plain")))
-        except Exception as exc:
-            logger.warning("Could not attach log file: %s",exc)
+        if log_path is not None:
+            files.append(("log", self.text_part(log_path, "text/plain", encoding)))
 
         if not files:
             return True
         
         try:
-            resp = requests.post(
+            resp = self.send_body(
+                "POST",
                 SERVER_URL,
                 files=files,
-                headers={"Authorization": f"Bearer {AUTH_TOKEN}"},
+                data={"crops": json.dumps(crops)} if crops else None,
                 timeout=30,
             )
             logger.info("POST %s → %d", SERVER_URL, resp.status_code)
+            offered = self.negotiate(resp)
             if resp.ok:
-                # truncate log so only fresh lines go next time
-                try:
-                    LOG_FILE.touch(exist_ok=True)
-                    with LOG_FILE.open("w"):
-                        pass
-
-                except Exception as exc:
-                    logger.warning("Log-truncate failed: %s", exc)
                 return True
+            if resp.status_code == 415 and encoding is not None and encoding != offered:
+                logger.warning("Hub refused %s parts, sending again with %s", encoding, offered or "none")
+                return self.sender(csv_path, images, log_path, offered)
             
             logger.error("Server rejected upload: %d %s",
                          resp.status_code, resp.text[:200])
         except requests.RequestException as exc:
             logger.error("Network error: %s", exc)
-            time.sleep(TCP_RETRY_DELAY)        # back-off
+        finally:
+            for _, part in files:
+                if hasattr(part[1], "close"):
+                    part[1].close()
         return False
     
-    def upload_cycle(self):
-        csvs = self.csv_finder()
-        
-        if csvs:
-            csv_path = csvs[0]
-            cutoff = timestamp_from_name(csv_path)
-            images = self.image_finder_b4range(cutoff)
-            
-            if self.sender(csv_path,images):
-                csv_path.unlink(missing_ok=True)
-                for img in images:
-                    img.unlink(missing_ok=True)
-                logger.info("Uploaded and purged %s (+%d images)",csv_path.name, len(images))
-        #cutoff = timestamp_from_name(csv_path)
-        #images = self.image_finder_b4range(cutoff)
-
-        else:
-            images = self.image_finder()
-            if images and self.sender(None, images):
-                #if self.sender(csv_path, images):
-                #csv_path.unlink(missing_ok=True)
-                for img in images:
-                    img.unlink(missing_ok=True)
-                logger.info("Uploaded & purged %s independant (+%d images)", len(images))
-            elif self.sender(None, []):
-                logger.info("Uploaded log only")
-    
-    
+    def resumable_send(self, path: Path, kind: str) -> bool:
+        """
+        Send one file in UPLOAD_CHUNK_SIZE chunks. The hub session id (and
+        the coding of the bytes sent) is kept in a sidecar file, so an
+        interrupted transfer continues from the last byte the hub
+        acknowledged instead of starting over.
+        """
+        state = session_file(path)
+        offset = 0
+        source = None
+        try:
+            status = None
+            encoding = fallback = self.encoding if kind in TEXT_KINDS else None
+            if state.exists():
+                sid, _, encoding = state.read_text().strip().partition(" ")
+                encoding = encoding or None
+                resp = self.http.get(f"{API_URL}/uploads/{sid}", timeout=30)
+                if resp.status_code != 404:
+                    resp.raise_for_status()
+                    status = resp.json()
+                if encoding is not None and encoding not in ENCODERS: # a coder we no longer have
+                    encoding = fallback
+                    status = None
+            if encoding is None:
+                source, size = path.open("rb"), path.stat().st_size
+            else:
+                data = ENCODERS[encoding](path.read_bytes())
+                source, size = io.BytesIO(data), len(data)
+            if status is not None and status["size"] != size:
+                status = None # the file changed since, start over
+            if status is None:
+                body = {"kind": kind, "filename": path.name, "size": size}
+                if encoding is not None:
+                    body["encoding"] = encoding
+                if kind == "image" and (meta := crop_meta(path)) is not None:
+                    body["crop"] = meta
+                resp = self.http.post(
+                    f"{API_URL}/uploads",
+                    json=body,
+                    timeout=30,
+                )
+                if resp.status_code in (404, 405):
+                    raise ResumableUnsupported()
+                self.negotiate(resp)
+                if resp.status_code == 415 and encoding is not None:
+                    # the hub lost a coder: forget the session, next attempt uses what it offers now
+                    logger.warning("Hub refused %s for %s", encoding, path.name)
+                    state.unlink(missing_ok=True)
+                    return False
+                resp.raise_for_status()
+                status = resp.json()
+                state.write_text(status["sid"] if encoding is None else f"{status['sid']} {encoding}")
+
+            sid, offset, size = status["sid"], status["offset"], status["size"]
+            if not status["done"]:
+                while offset < size:
+                    source.seek(offset)
+                    chunk = source.read(min(UPLOAD_CHUNK_SIZE, size - offset))
+                    if not chunk:
+                        logger.error("%s shrank during upload, restarting it", path.name)
+                        state.unlink(missing_ok=True)
+                        return False
+                    resp = self.send_body(
+                        "PUT",
+                        f"{API_URL}/uploads/{sid}",
+                        params={"offset": offset},
+                        data=chunk,
+                        timeout=30,
+                    )
+                    if resp.status_code == 409:
+                        # the hub has a different idea of the offset, ask it
+                        resp = self.http.get(f"{API_URL}/uploads/{sid}", timeout=30)
+                    resp.raise_for_status()
+                    offset = resp.json()["offset"]
+
+            resp = self.http.post(f"{API_URL}/uploads/{sid}/finalize", timeout=60)
+            resp.raise_for_status()
+            state.unlink(missing_ok=True)
+            return True
+
+        except requests.RequestException as exc:
+            logger.error("Upload of %s stopped at byte %d: %s", path.name, offset, exc)
+        finally:
+            if source is not None:
+                source.close()
+        return False
+
+    def finish(self, rows: list, unsent: set):
+        """The hub has these: delete the files and their outbox rows."""
+        for row in rows:
+            purge(Path(row["path"]), row["kind"])
+        self.outbox.done([r["id"] for r in rows])
+        unsent.difference_update(r["id"] for r in rows)
+
+    def skip_known(self, images: list, unsent: set):
+        """
+        Hash handshake: send the sha256 of every image row of the batch and
+        finish the ones the hub already stores (e.g. the reply to an earlier
+        POST was lost), so only those it still needs stay *unsent*.
+        """
+        if not images:
+            return
+        hashes = []
+        for row in images:
+            h = hashlib.sha256()
+            with open(row["path"], "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    h.update(chunk)
+            hashes.append((h.hexdigest(), row))
+        try:
+            resp = self.http.post(
+                f"{API_URL}/images/missing",
+                json={"hashes": sorted({sha for sha, _ in hashes})},
+                timeout=30,
+            )
+            if not resp.ok: # older hub: send everything
+                return
+            missing = set(resp.json()["missing"])
+        except requests.RequestException as exc:
+            logger.warning("Image handshake failed: %s", exc)
+            return
+
+        known = [row for sha, row in hashes if sha not in missing]
+        self.finish(known, unsent)
+        if known:
+            logger.info("Hub already had %d images, purged them", len(known))
+
+    def claim_batch(self, with_text: bool = True) -> list:
+        """
+        The next request's worth: the oldest CSV and log segment (unless
+        *with_text* is False), images up to the byte budget.  Empty only when
+        nothing is pending.
+        """
+        while True:
+            rows = [r for kind in TEXT_KINDS for r in self.outbox.claim(kind, 0, 1)] if with_text else []
+            budget = UPLOAD_BATCH_BYTES - sum(r["size"] for r in rows)
+            rows += self.outbox.claim("image", max(0, budget), UPLOAD_BATCH_FILES)
+            # files deleted behind our back are dropped from the queue
+            gone = [r["id"] for r in rows if not Path(r["path"]).exists()]
+            if gone:
+                logger.warning("%d queued files no longer exist, dropped them", len(gone))
+                self.outbox.done(gone)
+            if len(gone) < len(rows) or not rows:
+                return [r for r in rows if r["id"] not in gone]
+
+    def resumable_batch(self, rows: list, unsent: set) -> bool:
+        for row in rows:
+            if not self.resumable_send(Path(row["path"]), row["kind"]):
+                return False
+            self.finish([row], unsent)
+        logger.info("Uploaded and purged %d files", len(rows))
+        return True
+
+    def multipart_batch(self, rows: list, unsent: set) -> bool:
+        first = lambda kind: next((Path(r["path"]) for r in rows if r["kind"] == kind), None)
+        csv_path, log_path = first("csv"), first("log")
+        images = [Path(r["path"]) for r in rows if r["kind"] == "image"]
+        if not self.sender(csv_path, images, log_path, self.encoding):
+            return False
+        self.finish(rows, unsent)
+        logger.info("Uploaded and purged %s (+%d images)",
+                    csv_path.name if csv_path else "no CSV", len(images))
+        return True
+
+    def send_batch(self, rows: list) -> bool:
+        """Send one claimed batch; False when the send failed (the unsent rows are pending again)."""
+        unsent = {r["id"] for r in rows}
+        try:
+            self.skip_known([r for r in rows if r["kind"] == "image"], unsent)
+            rows = [r for r in rows if r["id"] in unsent]
+            if not rows:
+                return True
+            if self.resumable:
+                try:
+                    return self.resumable_batch(rows, unsent)
+                except ResumableUnsupported:
+                    logger.warning("Hub has no resumable uploads, using multipart")
+                    self.resumable = False
+                    rows = [r for r in rows if r["id"] in unsent]
+            return self.multipart_batch(rows, unsent)
+        finally:
+            # whatever way the send ended, each row not done goes back exactly once
+            if unsent:
+                self.outbox.release(sorted(unsent))
+
+    def drain(self) -> bool:
+        """
+        Send batches back-to-back, UPLOAD_PARALLEL in flight, until the
+        outbox is empty (True) or a send failed (False).  Only one of them
+        carries CSV and log segments, so the hub appends segments to the day
+        files in order; images go alongside.
+        """
+        ok = True
+        with ThreadPoolExecutor(UPLOAD_PARALLEL, thread_name_prefix="upload") as pool:
+            inflight = set()
+            text_batch = None
+            while ok and not self.stop_event.is_set():
+                while len(inflight) < UPLOAD_PARALLEL and (rows := self.claim_batch(text_batch is None)):
+                    future = pool.submit(self.send_batch, rows)
+                    if any(r["kind"] in TEXT_KINDS for r in rows):
+                        text_batch = future
+                    inflight.add(future)
+                if not inflight:
+                    break
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                if text_batch in done:
+                    text_batch = None
+                ok = all(f.result() for f in done)
+            # a failure stops new batches, the ones in flight finish
+            ok = all([f.result() for f in inflight]) and ok
+        return ok
+
+    def upload_cycle(self) -> bool:
+        if self.csv_writer is not None and not self.outbox.pending("csv"):
+            # hand over the rows written so far; while a sealed file is still
+            # pending the open one keeps growing instead of piling up files
+            self.csv_writer.seal()
+        self.cut_log()
+        return self.drain()
+
     def run(self):
-        
+        self.adopt_leftovers()
         self.stop_event.wait(INITIAL_UPLOAD_WAIT_PERIOD)
         while not self.stop_event.is_set():
             try:
-                
-                self.upload_cycle()
+                ok = self.upload_cycle()
             except Exception:
                 logger.exception("unexpected error in upload cycle, retrying")
-            self.stop_event.wait(UPLOAD_INTERVAL)
+                ok = False
+            if ok:
+                self.failures = 0
+                delay = UPLOAD_INTERVAL
+            else:
+                self.failures += 1
+                delay = backoff(self.failures)
+                logger.info("Upload failed %d time(s) in a row, next try in %.0f s", self.failures, delay)
+            self.stop_event.wait(delay)
+        self.http.close()
     
@@ -1,4 +1,4 @@
-import csv, logging, threading, serial, time 
+import csv, logging, os, threading, serial, time 
 
 from datetime import datetime, timezone
 from serial.serialutil import SerialException
@@ -6,17 +6,111 @@ from pathlib import Path
 from zoneinfo import ZoneInfo
 #Import configuration
 
-from config import SERIAL_PORT, BAUD_RATE, DATA_DIR
+from config import SERIAL_PORT, BAUD_RATE, DATA_DIR, CSV_FLUSH_ROWS, CSV_FLUSH_INTERVAL
 
 logger = logging.getLogger(__name__)
 
+HEADER = ["timestamp", "Temperature [C] ","Humidity ", "Light ", "Voltage L.Sensor "]
+
+def fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class RotatingCsvWriter:
+    """
+    Long-lived writer for the sensor rows.
+
+    Rows go to DATA_DIR/<day>.csv.open, which stays open.  They are buffered
+    and written + fsynced every CSV_FLUSH_ROWS rows or CSV_FLUSH_INTERVAL
+    seconds, so a crash loses at most one interval.  The file is sealed
+    (flushed, closed and renamed to <day>T<HH-MM-SS>.csv) at the Paris day
+    boundary and whenever the Uploader asks for it, and only then put in the
+    outbox, so the Uploader never reads a file that is still being appended to.
+    """
+    SUFFIX = ".csv.open"
+
+    def __init__(self, directory: Path = DATA_DIR, flush_rows: int = CSV_FLUSH_ROWS,
+                 flush_interval: float = CSV_FLUSH_INTERVAL, outbox=None):
+        self.directory = directory
+        self.outbox = outbox
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock() # seal() comes from the Uploader thread
+        self.file = self.writer = self.path = self.day = None
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.recover()
+
+    def recover(self):
+        # segments left open by a crash or power cut: keep what reached the card
+        for path in sorted(self.directory.glob(f"*{self.SUFFIX}")):
+            self._rename(path)
+
+    def write(self, timestamp: datetime, fields: list):
+        with self.lock:
+            if self.file is not None and timestamp.date() != self.day:
+                self._seal()
+            if self.file is None:
+                self._open(timestamp)
+            self.writer.writerow([f"{timestamp}"] + fields)
+            self.pending += 1
+            if self.pending >= self.flush_rows:
+                self._flush()
+
+    def tick(self):
+        """Called between serial reads: flush rows that waited too long."""
+        with self.lock:
+            if self.pending and time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def seal(self):
+        with self.lock:
+            if self.file is not None:
+                self._seal()
+
+    def close(self):
+        self.seal()
+
+    def _open(self, timestamp: datetime):
+        self.day = timestamp.date()
+        self.path = self.directory / f"{timestamp:%Y-%m-%dT%H-%M-%S}{self.SUFFIX}"
+        self.file = self.path.open("a", newline="", buffering=64 * 1024)
+        self.writer = csv.writer(self.file, delimiter =";")
+        self.writer.writerow(HEADER)
+        self.pending += 1
+
+    def _flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def _seal(self):
+        self._flush()
+        self.file.close()
+        path = self._rename(self.path)
+        logger.info("CSV segment ready for upload: %s", path.name)
+        self.file = self.writer = self.path = None
+
+    def _rename(self, path: Path) -> Path:
+        final = path.with_name(path.name[:-len(self.SUFFIX)] + ".csv")
+        os.replace(path, final)
+        fsync_dir(self.directory)
+        if self.outbox is not None:
+            self.outbox.enqueue("csv", final)
+        return final
+
 class SerialReader(threading.Thread):
     PARIS = ZoneInfo("Europe/Paris") 
     RECONNECT_DELAY = 600
-    def __init__(self, stop_event: threading.Event):
+    def __init__(self, stop_event: threading.Event, csv_writer: RotatingCsvWriter | None = None):
         super().__init__(daemon = True)
         self.stop_event = stop_event
         self.ser = None
+        self.csv_writer = csv_writer or RotatingCsvWriter()
         logger.info("Started SerialReader Module")
         
 
@@ -29,13 +123,6 @@ class SerialReader(threading.Thread):
                 logger.error("Serial communication errored out: %s - retrying in %d ", e, self.RECONNECT_DELAY)
                 self.ser = None
                 
-    @staticmethod
-    def create_path_csv(timestamp : datetime) -> Path:
-        """
-                Inputs: timestamp with the format of date time to return the 'name' of                the csv in a Path object format to use as a file name
-        """
-        return DATA_DIR / f"{timestamp.date().isoformat()}.csv"
-        
     def run(self):
         while not self.stop_event.is_set():
             if self.ser is None:
@@ -47,30 +134,22 @@ class SerialReader(threading.Thread):
             try:
 
                 line = self.ser.readline().decode("ascii", errors="ignore").strip()
+                self.csv_writer.tick()
                 
                 if not line:
                     continue # if nothing aight
                 
                 timestamp = datetime.now(self.PARIS)
-                csv_path = self.create_path_csv(timestamp)
-                new_file = not csv_path.exists()
-                
-                with csv_path.open("a", newline="") as file:
-                    writer = csv.writer(file, delimiter =";")
-                    if new_file:
-                        starting_line = ["Temperature [C] ","Humidity ", "Light ", "Voltage L.Sensor "]
-                        writer.writerow(["timestamp"] + starting_line)
-
-                    writer.writerow([f"{timestamp}"] + line.split(';'))
-                    
-                    logger.info('Ligne serial ecrit')
+                self.csv_writer.write(timestamp, line.split(';'))
 
             except SerialException as exc:
                 logger.exception("Echec lors de la lecture du serial arduino ")
                 logger.error("Serial read error %s - reconnecting", exc )
                 self.ser.close()
                 self.ser = None
+                self.csv_writer.seal() # nothing buffered sits out the reconnect delay
                 self.stop_event.wait(self.RECONNECT_DELAY)
         
         if self.ser:
             self.ser.close()
+        self.csv_writer.close() # flush + fsync what is buffered